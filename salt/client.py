@@ -29,9 +29,7 @@ The data structure needs to be:
 # This means that the primary client to build is, the LocalClient
 
 import os
-import re
 import sys
-import glob
 import time
 import datetime
 import getpass
@@ -41,8 +39,11 @@ import zmq
 
 # Import salt modules
 import salt.config
+import salt.jobcache
 import salt.payload
 import salt.utils
+import salt.utils.event
+import salt.utils.minions
 from salt.exceptions import SaltClientError, SaltInvocationError
 
 # Try to import range from https://github.com/ytoolshed/range
@@ -75,6 +76,9 @@ class LocalClient(object):
         self.serial = salt.payload.Serial(self.opts)
         self.key = self.__read_master_key()
         self.salt_user = self.__get_user()
+        self.event = salt.utils.event.MasterEvent(self.opts['sock_dir'])
+        self.job_cache = salt.jobcache.get_job_cache(self.opts)
+        self.ckminions = salt.utils.minions.CkMinions(self.opts)
 
     def __read_master_key(self):
         '''
@@ -107,53 +111,6 @@ class LocalClient(object):
           return None
         return user
 
-    def _check_glob_minions(self, expr):
-        '''
-        Return the minions found by looking via globs
-        '''
-        cwd = os.getcwd()
-        try:
-            os.chdir(os.path.join(self.opts['pki_dir'], 'minions'))
-        except OSError:
-            err = ('The Salt Master has not been set up on this system, '
-                   'a salt-master needs to be running to use the salt command')
-            sys.stderr.write(err)
-            sys.exit(2)
-        ret = set(glob.glob(expr))
-        os.chdir(cwd)
-        return ret
-
-    def _check_list_minions(self, expr):
-        '''
-        Return the minions found by looking via a list
-        '''
-        ret = []
-        for fn_ in os.listdir(os.path.join(self.opts['pki_dir'], 'minions')):
-            if fn_ in expr:
-                if fn_ not in ret:
-                    ret.append(fn_)
-        return ret
-
-    def _check_pcre_minions(self, expr):
-        '''
-        Return the minions found by looking via regular expressions
-        '''
-        ret = set()
-        cwd = os.getcwd()
-        os.chdir(os.path.join(self.opts['pki_dir'], 'minions'))
-        reg = re.compile(expr)
-        for fn_ in os.listdir('.'):
-            if reg.match(fn_):
-                ret.add(fn_)
-        os.chdir(cwd)
-        return ret
-
-    def _check_grain_minions(self, expr):
-        '''
-        Return the minions found by looking via a list
-        '''
-        return os.listdir(os.path.join(self.opts['pki_dir'], 'minions'))
-
     def _convert_range_to_list(self, tgt):
         range = seco.range.Range(self.opts['range_server'])
         try:
@@ -188,10 +145,7 @@ class LocalClient(object):
         arg = condition_kwarg(arg, kwarg)
         if timeout is None:
             timeout = self.opts['timeout']
-        jid = salt.utils.prep_jid(
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
+        jid = self.job_cache.prep_jid()
         pub_data = self.pub(
             tgt,
             fun,
@@ -224,10 +178,7 @@ class LocalClient(object):
         arg = condition_kwarg(arg, kwarg)
         if timeout is None:
             timeout = self.opts['timeout']
-        jid = salt.utils.prep_jid(
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
+        jid = self.job_cache.prep_jid()
         pub_data = self.pub(
             tgt,
             fun,
@@ -269,10 +220,7 @@ class LocalClient(object):
         arg = condition_kwarg(arg, kwarg)
         if timeout is None:
             timeout = self.opts['timeout']
-        jid = salt.utils.prep_jid(
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
+        jid = self.job_cache.prep_jid()
         pub_data = self.pub(
             tgt,
             fun,
@@ -309,10 +257,7 @@ class LocalClient(object):
         arg = condition_kwarg(arg, kwarg)
         if timeout is None:
             timeout = self.opts['timeout']
-        jid = salt.utils.prep_jid(
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
+        jid = self.job_cache.prep_jid()
         pub_data = self.pub(
             tgt,
             fun,
@@ -347,10 +292,7 @@ class LocalClient(object):
         arg = condition_kwarg(arg, kwarg)
         if timeout is None:
             timeout = self.opts['timeout']
-        jid = salt.utils.prep_jid(
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
+        jid = self.job_cache.prep_jid()
         pub_data = self.pub(
             tgt,
             fun,
@@ -367,6 +309,41 @@ class LocalClient(object):
         return (self.get_returns(pub_data['jid'],
                 pub_data['minions'], timeout))
 
+    def _iter_job_returns(self, jid, wait=0.5):
+        '''
+        Generate the returns for a job as they come in. Each iteration yields
+        a dict of the new returns, the dict is empty if nothing arrived
+        within wait seconds so that the caller can check its timeouts
+        '''
+        found = set()
+        self.event.subscribe(jid)
+        try:
+            # Pick up the returns which landed before the subscription
+            ret = self.job_cache.get_returns(jid, found)
+            found.update(ret)
+            last_check = time.time()
+            yield ret
+            while True:
+                ret = {}
+                event = self.event.get_event(wait)
+                if event:
+                    tag, data = event
+                    if tag == jid and data.get('id') not in found:
+                        ret[data['id']] = {'ret': data.get('return')}
+                        if 'out' in data:
+                            ret[data['id']]['out'] = data['out']
+                if time.time() - last_check > 1:
+                    # Events are dropped when the bus is backed up, make sure
+                    # that no returns were missed, even while the events of
+                    # other jobs keep arriving
+                    found.update(ret)
+                    ret.update(self.job_cache.get_returns(jid, found))
+                    last_check = time.time()
+                found.update(ret)
+                yield ret
+        finally:
+            self.event.unsubscribe(jid)
+
     def get_cli_returns(
             self,
             jid,
@@ -386,40 +363,18 @@ class LocalClient(object):
             timeout = self.opts['timeout']
         fret = {}
         inc_timeout = timeout
-        jid_dir = salt.utils.jid_dir(
-                jid,
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
         start = int(time.time())
-        found = set()
-        wtag = os.path.join(jid_dir, 'wtag*')
         # Check to see if the jid is real, if not return the empty dict
-        if not os.path.isdir(jid_dir):
+        if not self.job_cache.jid_exists(jid):
+            self.event.unsubscribe(jid)
             yield {}
+            return
         # Wait for the hosts to check in
-        while True:
-            for fn_ in os.listdir(jid_dir):
-                ret = {}
-                if fn_.startswith('.'):
-                    continue
-                if fn_ not in found:
-                    retp = os.path.join(jid_dir, fn_, 'return.p')
-                    outp = os.path.join(jid_dir, fn_, 'out.p')
-                    if not os.path.isfile(retp):
-                        continue
-                    while fn_ not in ret:
-                        try:
-                            ret_data = self.serial.load(open(retp, 'r'))
-                            ret[fn_] = {'ret': ret_data}
-                            if os.path.isfile(outp):
-                                ret[fn_]['out'] = self.serial.load(open(outp, 'r'))
-                        except:
-                            pass
-                    found.add(fn_)
-                    fret.update(ret)
-                    yield ret
-            if glob.glob(wtag) and not int(time.time()) > start + timeout + 1:
+        for ret in self._iter_job_returns(jid):
+            for id_ in ret:
+                fret[id_] = ret[id_]
+                yield {id_: ret[id_]}
+            if self.job_cache.has_wtag(jid) and not int(time.time()) > start + timeout + 1:
                 # The timeout +1 has not been reached and there is still a
                 # write tag for the syndic
                 continue
@@ -440,7 +395,6 @@ class LocalClient(object):
                     timeout += inc_timeout
                     continue
                 break
-            time.sleep(0.01)
 
     def get_iter_returns(self, jid, minions, timeout=None):
         '''
@@ -449,55 +403,35 @@ class LocalClient(object):
         '''
         if timeout is None:
             timeout = self.opts['timeout']
-        jid_dir = salt.utils.jid_dir(
-                jid,
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
         start = 999999999999
         gstart = int(time.time())
         found = set()
-        wtag = os.path.join(jid_dir, 'wtag*')
         # Check to see if the jid is real, if not return the empty dict
-        if not os.path.isdir(jid_dir):
+        if not self.job_cache.jid_exists(jid):
+            self.event.unsubscribe(jid)
             yield {}
-        # Wait for the hosts to check in
-        while True:
-            for fn_ in os.listdir(jid_dir):
-                ret = {}
-                if fn_.startswith('.'):
-                    continue
-                if fn_ not in found:
-                    retp = os.path.join(jid_dir, fn_, 'return.p')
-                    outp = os.path.join(jid_dir, fn_, 'out.p')
-                    if not os.path.isfile(retp):
-                        continue
-                    while fn_ not in ret:
-                        try:
-                            ret_data = self.serial.load(open(retp, 'r'))
-                            ret[fn_] = {'ret': ret_data}
-                            if os.path.isfile(outp):
-                                ret[fn_]['out'] = self.serial.load(open(outp, 'r'))
-                        except:
-                            pass
-                    found.add(fn_)
-                    yield ret
-            if ret and start == 999999999999:
+            return
+        # Wait for the hosts to check in, the short wait keeps this iterator
+        # responsive for callers which interleave several jobs
+        for ret in self._iter_job_returns(jid, 0.02):
+            for id_ in ret:
+                found.add(id_)
+                yield {id_: ret[id_]}
+            if found and start == 999999999999:
                 start = int(time.time())
-            if glob.glob(wtag) and not int(time.time()) > start + timeout + 1:
+            if self.job_cache.has_wtag(jid) and not int(time.time()) > start + timeout + 1:
                 # The timeout +1 has not been reached and there is still a
                 # write tag for the syndic
                 continue
-            if len(ret) >= len(minions):
+            if len(found) >= len(minions):
                 break
             if int(time.time()) > start + timeout:
                 break
-            if int(time.time()) > gstart + timeout and not ret:
+            if int(time.time()) > gstart + timeout and not found:
                 # No minions have replied within the specified global timeout,
                 # return an empty dict
                 break
             yield None
-            time.sleep(0.02)
 
     def get_returns(self, jid, minions, timeout=None):
         '''
@@ -506,38 +440,23 @@ class LocalClient(object):
         '''
         if timeout is None:
             timeout = self.opts['timeout']
-        jid_dir = salt.utils.jid_dir(
-                jid,
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
         start = 999999999999
         gstart = int(time.time())
         ret = {}
-        wtag = os.path.join(jid_dir, 'wtag*')
         # If jid == 0, there is no payload
         if int(jid) == 0:
             return ret
         # Check to see if the jid is real, if not return the empty dict
-        if not os.path.isdir(jid_dir):
+        if not self.job_cache.jid_exists(jid):
+            self.event.unsubscribe(jid)
             return ret
         # Wait for the hosts to check in
-        while True:
-            for fn_ in os.listdir(jid_dir):
-                if fn_.startswith('.'):
-                    continue
-                if fn_ not in ret:
-                    retp = os.path.join(jid_dir, fn_, 'return.p')
-                    if not os.path.isfile(retp):
-                        continue
-                    while fn_ not in ret:
-                        try:
-                            ret[fn_] = self.serial.load(open(retp, 'r'))
-                        except:
-                            pass
+        for new in self._iter_job_returns(jid):
+            for id_ in new:
+                ret[id_] = new[id_]['ret']
             if ret and start == 999999999999:
                 start = int(time.time())
-            if glob.glob(wtag) and not int(time.time()) > start + timeout + 1:
+            if self.job_cache.has_wtag(jid) and not int(time.time()) > start + timeout + 1:
                 # The timeout +1 has not been reached and there is still a
                 # write tag for the syndic
                 continue
@@ -551,7 +470,6 @@ class LocalClient(object):
                 # No minions have replied within the specified global timeout,
                 # return an empty dict
                 return ret
-            time.sleep(0.02)
 
     def get_full_returns(self, jid, minions, timeout=None):
         '''
@@ -560,39 +478,19 @@ class LocalClient(object):
         '''
         if timeout is None:
             timeout = self.opts['timeout']
-        jid_dir = salt.utils.jid_dir(
-                jid,
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
         start = 999999999999
         gstart = int(time.time())
         ret = {}
-        wtag = os.path.join(jid_dir, 'wtag*')
         # Check to see if the jid is real, if not return the empty dict
-        if not os.path.isdir(jid_dir):
+        if not self.job_cache.jid_exists(jid):
+            self.event.unsubscribe(jid)
             return ret
         # Wait for the hosts to check in
-        while True:
-            for fn_ in os.listdir(jid_dir):
-                if fn_.startswith('.'):
-                    continue
-                if fn_ not in ret:
-                    retp = os.path.join(jid_dir, fn_, 'return.p')
-                    outp = os.path.join(jid_dir, fn_, 'out.p')
-                    if not os.path.isfile(retp):
-                        continue
-                    while fn_ not in ret:
-                        try:
-                            ret_data = self.serial.load(open(retp, 'r'))
-                            ret[fn_] = {'ret': ret_data}
-                            if os.path.isfile(outp):
-                                ret[fn_]['out'] = self.serial.load(open(outp, 'r'))
-                        except:
-                            pass
+        for new in self._iter_job_returns(jid):
+            ret.update(new)
             if ret and start == 999999999999:
                 start = int(time.time())
-            if glob.glob(wtag) and not int(time.time()) > start + timeout + 1:
+            if self.job_cache.has_wtag(jid) and not int(time.time()) > start + timeout + 1:
                 # The timeout +1 has not been reached and there is still a
                 # write tag for the syndic
                 continue
@@ -604,38 +502,18 @@ class LocalClient(object):
                 # No minions have replied within the specified global timeout,
                 # return an empty dict
                 return ret
-            time.sleep(0.02)
 
     def find_cmd(self, cmd):
         '''
         Hunt through the old salt calls for when cmd was run, return a dict:
         {'<jid>': <return_obj>}
         '''
-        job_dir = os.path.join(self.opts['cachedir'], 'jobs')
         ret = {}
-        for jid in os.listdir(job_dir):
-            jid_dir = salt.utils.jid_dir(
-                    jid,
-                    self.opts['cachedir'],
-                    self.opts['hash_type']
-                    )
-            loadp = os.path.join(jid_dir, '.load.p')
-            if os.path.isfile(loadp):
-                try:
-                    load = self.serial.load(open(loadp, 'r'))
-                    if load['fun'] == cmd:
-                        # We found a match! Add the return values
-                        ret[jid] = {}
-                        for host in os.listdir(jid_dir):
-                            host_dir = os.path.join(jid_dir, host)
-                            retp = os.path.join(host_dir, 'return.p')
-                            if not os.path.isfile(retp):
-                                continue
-                            ret[jid][host] = self.serial.load(open(retp))
-                except:
-                    continue
-            else:
-                continue
+        for jid, load in self.job_cache.find_jobs(fun=cmd):
+            # We found a match! Add the return values
+            ret[jid] = {}
+            for host, data in self.job_cache.get_returns(jid).items():
+                ret[jid][host] = data['ret']
         return ret
 
     def check_minions(self, expr, expr_form='glob'):
@@ -645,14 +523,12 @@ class LocalClient(object):
         match the regex, this will then be used to parse the returns to
         make sure everyone has checked back in.
         '''
-        return {'glob': self._check_glob_minions,
-                'pcre': self._check_pcre_minions,
-                'list': self._check_list_minions,
-                'grain': self._check_grain_minions,
-                'grain_pcre': self._check_grain_minions,
-                'exsel': self._check_grain_minions,
-                'compound': self._check_grain_minions,
-                }[expr_form](expr)
+        if not os.path.isdir(self.ckminions.minion_dir):
+            err = ('The Salt Master has not been set up on this system, '
+                   'a salt-master needs to be running to use the salt command')
+            sys.stderr.write(err)
+            sys.exit(2)
+        return self.ckminions.check_minions(expr, expr_form)
 
     def pub(self, tgt, fun, arg=(), expr_form='glob',
             ret='', jid='', timeout=5):
@@ -730,6 +606,11 @@ class LocalClient(object):
 
         package = salt.payload.format_payload( 'clear', **payload_kwargs)
 
+        # Subscribe to the job returns before the job is sent out, so that no
+        # returns can be missed
+        if jid:
+            self.event.subscribe(jid)
+
         # Prep zmq
         context = zmq.Context()
         socket = context.socket(zmq.REQ)
@@ -752,6 +633,8 @@ class LocalClient(object):
             except zmq.core.error.ZMQError:
                 time.sleep(0.01)
         if not payload:
+            if jid:
+                self.event.unsubscribe(jid)
             return {'jid': '0', 'minions': []}
         return {'jid': payload['load']['jid'],
                 'minions': minions}
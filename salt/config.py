@@ -148,6 +148,12 @@ def minion_config(path):
                 'base': ['/srv/pillar'],
                 },
             'hash_type': 'md5',
+            'file_window': 4,
+            'file_chunk_size': 1048576,
+            'file_delta_threshold': 1048576,
+            'file_diff_max_size': 1048576,
+            'compression': 'zlib',
+            'compression_threshold': 4096,
             'external_nodes': '',
             'disable_modules': [],
             'disable_returners': [],
@@ -160,6 +166,8 @@ def minion_config(path):
             'open_mode': False,
             'multiprocessing': True,
             'sub_timeout': 60,
+            'return_timeout': 60,
+            'return_batch': 0,
             'log_file': '/var/log/salt/minion',
             'log_level': 'warning',
             'log_granular_levels': {},
@@ -209,12 +217,16 @@ def master_config(path):
     '''
     opts = {'interface': '0.0.0.0',
             'publish_port': '4505',
+            'publish_topics': False,
             'user': 'root',
             'worker_threads': 5,
+            'worker_threads_max': 0,
+            'file_worker_threads': 1,
             'sock_dir': os.path.join(tempfile.gettempdir(), '.salt-unix'),
             'ret_port': '4506',
             'timeout': 5,
             'keep_jobs': 24,
+            'job_cache': 'local',
             'root_dir': '/',
             'pki_dir': '/etc/salt/pki',
             'cachedir': '/var/cache/salt',
@@ -228,10 +240,14 @@ def master_config(path):
                 'base': ['/srv/pillar'],
                 },
             'file_buffer_size': 1048576,
+            'file_index_interval': 10,
+            'compression': 'zlib',
+            'compression_threshold': 4096,
             'hash_type': 'md5',
             'conf_file': path,
             'open_mode': False,
             'auto_accept': False,
+            'auth_rate': 0,
             'renderer': 'yaml_jinja',
             'failhard': False,
             'state_top': 'top.sls',
@@ -8,12 +8,14 @@ authenticating peers
 import os
 import sys
 import hmac
+import zlib
 import hashlib
 import logging
-import tempfile
+import time
+import threading
 
 # Import Cryptography libs
-from M2Crypto import RSA
+from M2Crypto import RSA, BIO
 from Crypto.Cipher import AES
 
 # Import zeromq libs
@@ -26,6 +28,18 @@ from salt.exceptions import AuthenticationError
 
 log = logging.getLogger(__name__)
 
+# The compression which can be applied to messages
+COMPRESSION = ('zlib',)
+
+# The sessions with the masters, the crypticles holding their current AES
+# keys, shared by everything in a process which talks to a master
+SESSIONS = {}
+SESSION_LOCK = threading.Lock()
+
+# The public keys loaded from disk, by path, with the stat of the file they
+# were loaded from
+PUB_KEYS = {}
+
 
 def foo_pass(self, data=''):
     '''
@@ -51,6 +65,60 @@ def gen_keys(keydir, keyname, keysize):
     return key
 
 
+def load_pub_key(path):
+    '''
+    Return the public key object for the key stored at path, the key is kept
+    in memory and only read and parsed again when the file changes
+    '''
+    stat = os.stat(path)
+    stamp = (stat.st_mtime, stat.st_size, stat.st_ino)
+    cached = PUB_KEYS.get(path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    with open(path, 'r') as fp_:
+        pub = RSA.load_pub_key_bio(BIO.MemoryBuffer(fp_.read()))
+    PUB_KEYS[path] = (stamp, pub)
+    return pub
+
+
+def session_key(opts):
+    '''
+    Return the key of the session with the master in the opts
+    '''
+    return (opts['master_uri'], opts['id'])
+
+
+def set_session(opts, crypticle):
+    '''
+    Share a crypticle made by signing in with the master, the clients in
+    this process, and in processes forked from it, use it from then on
+    '''
+    with SESSION_LOCK:
+        SESSIONS[session_key(opts)] = crypticle
+
+
+def compression(opts):
+    '''
+    Return the compression configured in the opts, an empty string if it is
+    turned off or is not supported
+    '''
+    comp = opts.get('compression')
+    if comp not in COMPRESSION:
+        if comp:
+            log.warning('Unsupported compression {0}'.format(comp))
+        return ''
+    return comp
+
+
+def can_compress(opts, offered):
+    '''
+    Return True if messages to a peer can be compressed, the peer offers the
+    compression it understands
+    '''
+    comp = compression(opts)
+    return bool(comp) and comp in offered
+
+
 class MasterKeys(dict):
     '''
     The Master Keys class is used to manage the public key pair used for
@@ -102,6 +170,10 @@ class Auth(object):
         self.opts = opts
         self.serial = salt.payload.Serial(self.opts)
         self.rsa_path = os.path.join(self.opts['pki_dir'], 'minion.pem')
+        self.priv_key = None
+        # The seconds the master asked the minion to wait before signing in
+        # again, when it is too busy to serve the sign in
+        self.retry_after = None
         if 'syndic_master' in self.opts:
             self.mpub = 'syndic_master.pub'
         elif 'alert_master' in self.opts:
@@ -111,16 +183,18 @@ class Auth(object):
 
     def get_priv_key(self):
         '''
-        Returns a private key object for the minion
+        Returns a private key object for the minion, the key is only read
+        from disk once
         '''
-        key = None
+        if self.priv_key is not None:
+            return self.priv_key
         try:
-            key = RSA.load_key(self.rsa_path, callback=foo_pass)
+            self.priv_key = RSA.load_key(self.rsa_path, callback=foo_pass)
             log.debug('Loaded minion key: {0}'.format(self.rsa_path))
         except:
             log.info('Generating minion key: {0}'.format(self.rsa_path))
-            key = gen_keys(self.opts['pki_dir'], 'minion', 4096)
-        return key
+            self.priv_key = gen_keys(self.opts['pki_dir'], 'minion', 4096)
+        return self.priv_key
 
     def minion_sign_in_payload(self):
         '''
@@ -130,14 +204,13 @@ class Auth(object):
         '''
         payload = {}
         key = self.get_priv_key()
-        tmp_pub = tempfile.mktemp()
-        key.save_pub_key(tmp_pub)
+        bio = BIO.MemoryBuffer()
+        key.save_pub_key_bio(bio)
         payload['enc'] = 'clear'
         payload['load'] = {}
         payload['load']['cmd'] = '_auth'
         payload['load']['id'] = self.opts['id']
-        payload['load']['pub'] = open(tmp_pub, 'r').read()
-        os.remove(tmp_pub)
+        payload['load']['pub'] = bio.read()
         return payload
 
     def decrypt_aes(self, aes):
@@ -163,11 +236,8 @@ class Auth(object):
 
         Returns a bool
         '''
-        tmp_pub = tempfile.mktemp()
-        open(tmp_pub, 'w+').write(master_pub)
         m_pub_fn = os.path.join(self.opts['pki_dir'], self.mpub)
-        pub = RSA.load_pub_key(tmp_pub)
-        os.remove(tmp_pub)
+        pub = RSA.load_pub_key_bio(BIO.MemoryBuffer(master_pub))
         if os.path.isfile(m_pub_fn) and not self.opts['open_mode']:
             local_master_pub = open(m_pub_fn).read()
             if not master_pub == local_master_pub:
@@ -197,7 +267,16 @@ class Auth(object):
         payload = self.serial.dumps(self.minion_sign_in_payload())
         socket.send(payload)
         payload = self.serial.loads(socket.recv())
+        self.retry_after = None
         if 'load' in payload:
+            if 'retry_after' in payload['load']:
+                self.retry_after = payload['load']['retry_after']
+                log.info(
+                    'The Salt Master is busy, this salt minion will wait for '
+                    '%s seconds before attempting to re-authenticate',
+                    self.retry_after
+                )
+                return 'retry'
             if 'ret' in payload['load']:
                 if not payload['load']['ret']:
                     log.critical(
@@ -228,6 +307,10 @@ class Auth(object):
             sys.exit(42)
         auth['aes'] = self.decrypt_aes(payload['aes'])
         auth['publish_port'] = payload['publish_port']
+        # Older masters do not advertise the compression they understand
+        auth['compress'] = can_compress(
+                self.opts, payload.get('compression', []))
+        auth['publish_topics'] = payload.get('publish_topics', False)
         return auth
 
 
@@ -240,13 +323,18 @@ class Crypticle(object):
     '''
 
     PICKLE_PAD = 'pickle::'
+    ZLIB_PAD = 'zlib::'
     AES_BLOCK_SIZE = 16
     SIG_SIZE = hashlib.sha256().digest_size
 
-    def __init__(self, opts, key_string, key_size=192):
+    def __init__(self, opts, key_string, key_size=192, compress=False):
         self.keys = self.extract_keys(key_string, key_size)
         self.key_size = key_size
         self.serial = salt.payload.Serial(opts)
+        # Compress the messages sent with this crypticle, only set when the
+        # receiver is known to understand compressed messages
+        self.compress = compress
+        self.compress_threshold = opts.get('compression_threshold', 4096)
 
     @classmethod
     def generate_key_string(cls, key_size=192):
@@ -288,17 +376,29 @@ class Crypticle(object):
         data = cypher.decrypt(data)
         return data[:-ord(data[-1])]
 
-    def dumps(self, obj):
+    def dumps(self, obj, compress=None):
         '''
-        Serialize and encrypt a python object
+        Serialize and encrypt a python object, messages over the compression
+        threshold are compressed first when the receiver can decompress them
         '''
-        return self.encrypt(self.PICKLE_PAD + self.serial.dumps(obj))
+        data = self.serial.dumps(obj)
+        if compress is None:
+            compress = self.compress
+        if compress and len(data) >= self.compress_threshold:
+            zdata = zlib.compress(data, 1)
+            # Data which is already compressed does not shrink, send it as is
+            if len(zdata) < len(data):
+                return self.encrypt(self.ZLIB_PAD + zdata)
+        return self.encrypt(self.PICKLE_PAD + data)
 
     def loads(self, data):
         '''
         Decrypt and un-serialize a python object
         '''
         data = self.decrypt(data)
+        if data.startswith(self.ZLIB_PAD):
+            return self.serial.loads(
+                    zlib.decompress(data[len(self.ZLIB_PAD):]))
         # simple integrity check to verify that we got meaningful data
         if not data.startswith(self.PICKLE_PAD):
             return {}
@@ -308,11 +408,54 @@ class Crypticle(object):
 class SAuth(Auth):
     '''
     Set up an object to maintain the standalone authentication session
-    with the salt master
+    with the salt master. The session is shared by every SAuth in the
+    process, so the file client, the pillar and the state system do not
+    each sign in, the minion only signs in again when the master's AES key
+    has changed
     '''
     def __init__(self, opts):
         super(SAuth, self).__init__(opts)
-        self.crypticle = self.__authenticate()
+        self.session = session_key(opts)
+        if self.session not in SESSIONS:
+            self.authenticate()
+
+    @property
+    def crypticle(self):
+        '''
+        The crypticle of the current session
+        '''
+        return SESSIONS[self.session]
+
+    def authenticate(self, stale=None):
+        '''
+        Sign in with the master and replace the session. Pass the crypticle
+        which the master failed to authenticate, the session is not replaced
+        when another client has replaced it already
+        '''
+        with SESSION_LOCK:
+            if SESSIONS.get(self.session) is not stale:
+                return
+            SESSIONS[self.session] = self.__authenticate()
+
+    def request(self, socket, payload, load):
+        '''
+        Encrypt the load into the payload, send it over the REQ socket and
+        return the decrypted reply. When the master cannot read the load its
+        AES key has changed, the minion signs in again and the load is sent
+        once more
+        '''
+        for attempt in range(2):
+            crypticle = self.crypticle
+            payload['load'] = crypticle.dumps(load)
+            socket.send(self.serial.dumps(payload))
+            reply = self.serial.loads(socket.recv())
+            try:
+                return crypticle.loads(reply)
+            except AuthenticationError:
+                if attempt:
+                    raise
+                log.info('The master AES key has changed, signing in again')
+                self.authenticate(crypticle)
 
     def __authenticate(self):
         '''
@@ -322,11 +465,14 @@ class SAuth(Auth):
         revolving master aes key.
         '''
         creds = self.sign_in()
+        while creds == 'retry' and self.retry_after:
+            time.sleep(self.retry_after)
+            creds = self.sign_in()
         if creds == 'retry':
             log.error('Failed to authenticate with the master, verify this'\
                 + ' minion\'s public key has been accepted on the salt master')
             sys.exit(2)
-        return Crypticle(self.opts, creds['aes'])
+        return Crypticle(self.opts, creds['aes'], compress=creds['compress'])
 
     def gen_token(self, clear_tok):
         '''
@@ -14,6 +14,12 @@ class SaltClientError(SaltException):
     '''
     pass
 
+class SaltReqTimeoutError(SaltException):
+    '''
+    Thrown when a request to the master timed out after all of the retries
+    '''
+    pass
+
 class SaltMasterError(SaltException):
     '''
     Problem reading the master root key
@@ -3,14 +3,15 @@ Classes that manage file clients
 '''
 # Import python libs
 import BaseHTTPServer
+import collections
 import contextlib
 import logging
-import hashlib
 import os
 import shutil
 import stat
 import string
 import subprocess
+import tempfile
 import urllib2
 import urlparse
 
@@ -22,13 +23,22 @@ import zmq
 from salt.exceptions import MinionError
 import salt.client
 import salt.crypt
+import salt.fileserver
 import salt.loader
 import salt.utils
 import salt.payload
+import salt.utils.delta
 import salt.utils.templates
 
 log = logging.getLogger(__name__)
 
+# Seconds to wait on the master for a chunk of a file before asking again
+CHUNK_TIMEOUT = 60
+
+# The caches of the hashes of the files on the minion by path and process,
+# shared by the file clients and the file states of a process
+HASH_CACHES = {}
+
 
 def get_file_client(opts):
     '''
@@ -44,6 +54,50 @@ def get_file_client(opts):
         return RemoteClient(opts)
 
 
+def hash_cache(opts):
+    '''
+    Return the cache of the hashes of the files on the minion, it is keyed on
+    the size, mtime and inode of each file so files which have not changed
+    are not read again to hash them. The cache is read in once per process
+    '''
+    path = os.path.join(opts['cachedir'], 'filehashes.p')
+    # Keyed on the process too, the jobs forked off the minion read in the
+    # hashes saved by the jobs before them
+    key = (path, os.getpid())
+    if key not in HASH_CACHES:
+        HASH_CACHES[key] = salt.fileserver.HashCache(opts, path)
+    return HASH_CACHES[key]
+
+
+@contextlib.contextmanager
+def hash_batch(opts):
+    '''
+    Save the hashes of the files on the minion once for a batch of files,
+    such as a directory being cached or a state run. The hashes of the files
+    which are gone are dropped
+    '''
+    hashes = hash_cache(opts)
+    hashes.batch += 1
+    try:
+        yield hashes
+    finally:
+        hashes.batch -= 1
+        if not hashes.batch:
+            hashes.prune(
+                    [path for path in hashes.cache if os.path.isfile(path)])
+            hashes.save()
+
+
+def save_hashes(opts):
+    '''
+    Save the hashes of the files on the minion unless a batch is running,
+    the batch saves them when it ends
+    '''
+    hashes = hash_cache(opts)
+    if not hashes.batch:
+        hashes.save()
+
+
 class Client(object):
     '''
     Base class for Salt file interactions
@@ -92,7 +146,12 @@ class Client(object):
         destdir = os.path.dirname(dest)
         cumask = os.umask(stat.S_IRWXG | stat.S_IRWXO)
         if not os.path.isdir(destdir):
-            os.makedirs(destdir)
+            try:
+                os.makedirs(destdir)
+            except OSError:
+                # Another process made it first
+                if not os.path.isdir(destdir):
+                    raise
         yield dest
         os.umask(cumask)
 
@@ -103,38 +162,45 @@ class Client(object):
         '''
         return self.get_url(path, '', True, env)
 
-    def cache_files(self, paths, env='base'):
+    def get_files(self, files, env='base', prefix=''):
         '''
-        Download a list of files stored on the master and put them in the
-        minion file cache
+        Get a list of files, the files are pairs of a url and a destination,
+        an empty destination caches the file. Returns the local paths of the
+        files in the same order
         '''
         ret = []
-        for path in paths:
-            ret.append(self.cache_file(path, env))
+        for url, dest in files:
+            ret.append(self.get_url(url, dest, True, env))
         return ret
 
+    def cache_files(self, paths, env='base'):
+        '''
+        Download a list of files stored on the master and put them in the
+        minion file cache, only the files under the prefix the paths share
+        are looked up on the master
+        '''
+        prefix = os.path.commonprefix(
+                [path[7:] for path in paths if path.startswith('salt://')])
+        return self.get_files([(path, '') for path in paths], env, prefix)
+
     def cache_master(self, env='base'):
         '''
         Download and cache all files on a master in a specified environment
         '''
-        ret = []
-        for path in self.file_list(env):
-            ret.append(self.cache_file('salt://{0}'.format(path), env))
-        return ret
+        return self.get_files(
+                [('salt://{0}'.format(path), '') for path in self.file_list(env)],
+                env)
 
     def cache_dir(self, path, env='base'):
         '''
         Download all of the files in a subdir of the master
         '''
-        ret = []
         path = self._check_proto(path)
-        for fn_ in self.file_list(env):
-            if fn_.startswith(path):
-                local = self.cache_file('salt://{0}'.format(fn_), env)
-                if not fn_.strip():
-                    continue
-                ret.append(local)
-        return ret
+        return self.get_files(
+                [('salt://{0}'.format(fn_), '') for fn_ in self.file_list(env)
+                 if fn_.startswith(path) and fn_.strip()],
+                env,
+                path)
 
     def cache_local_file(self, path, **kwargs):
         '''
@@ -230,14 +296,15 @@ class Client(object):
             prefix = separated[0]
 
         # Copy files from master
+        files = []
         for fn_ in self.file_list(env):
             if fn_.startswith(path):
                 # Remove the leading directories from path to derive
                 # the relative path on the minion.
                 minion_relpath = string.lstrip(fn_[len(prefix):],'/')
-                ret.append(self.get_file('salt://{0}'.format(fn_),
-                                         '%s/%s' % (dest,minion_relpath),
-                                         True, env))
+                files.append(('salt://{0}'.format(fn_),
+                              '%s/%s' % (dest,minion_relpath)))
+        ret.extend(self.get_files(files, env, path))
         # Replicate empty dirs from master
         for fn_ in self.file_list_emptydirs(env):
             if fn_.startswith(path):
@@ -379,7 +446,12 @@ class LocalClient(Client):
                 os.makedirs(destdir)
             else:
                 return False
-        shutil.copy(fnd['path'], dest)
+        # The master workers compile pillar data from the same cache at
+        # once, the copy is moved into place so it is never read half written
+        fd_, tmp = tempfile.mkstemp(dir=destdir)
+        os.close(fd_)
+        shutil.copy(fnd['path'], tmp)
+        os.rename(tmp, dest)
         return dest
 
     def file_list(self, env='base'):
@@ -432,17 +504,14 @@ class LocalClient(Client):
                 log.warning(err)
                 return ret
             else:
-                with open(path, 'rb') as f:
-                    ret['hsum'] = hashlib.md5(f.read()).hexdigest()
+                ret['hsum'] = salt.utils.get_hash(path, 'md5')
                 ret['hash_type'] = 'md5'
                 return ret
         path = self._find_file(path, env)['path']
         if not path:
             return {}
         ret = {}
-        with open(path, 'rb') as f:
-            ret['hsum'] = getattr(hashlib, self.opts['hash_type'])(
-                f.read()).hexdigest()
+        ret['hsum'] = salt.utils.get_hash(path, self.opts['hash_type'])
         ret['hash_type'] = self.opts['hash_type']
         return ret
 
@@ -501,29 +570,173 @@ class RemoteClient(Client):
         Client.__init__(self, opts)
         self.auth = salt.crypt.SAuth(opts)
         self.socket = self.__get_socket()
+        self.dealer = None
+        # The hash type of the master file server, learned from its replies
+        self.hash_type = opts.get('hash_type', 'md5')
+        self.hashes = hash_cache(opts)
+        # Cleared when the master turns out not to understand deltas
+        self.delta = True
 
     def __get_socket(self):
         '''
         Return the ZeroMQ socket to use
         '''
-        context = zmq.Context()
-        socket = context.socket(zmq.REQ)
+        self.context = zmq.Context()
+        socket = self.context.socket(zmq.REQ)
         socket.connect(self.opts['master_uri'])
         return socket
 
+    def __ask_compress(self, load):
+        '''
+        Ask the master to compress its reply, if it understands compression
+        '''
+        if self.auth.crypticle.compress:
+            load['compress'] = self.opts['compression']
+        return load
+
+    def __get_dealer(self):
+        '''
+        Return the socket used to keep several chunk requests in flight
+        '''
+        if self.dealer is None:
+            self.dealer = self.context.socket(zmq.DEALER)
+            self.dealer.linger = 0
+            self.dealer.connect(self.opts['master_uri'])
+        return self.dealer
+
+    def __get_chunks(self, files, env, chunk_size):
+        '''
+        Fetch files from the master keeping a window of chunk requests in
+        flight across all of them, the chunks are written at their offsets as
+        they arrive. The files map the path of each file on the master to its
+        local path, its size, the offset to start fetching it from and its
+        open handle if it has been started already. Returns the paths of the
+        files which could not be fetched
+        '''
+        dealer = self.__get_dealer()
+        poller = zmq.Poller()
+        poller.register(dealer, zmq.POLLIN)
+        load = self.__ask_compress({'cmd': '_serve_file',
+                                    'env': env,
+                                    'chunk_size': chunk_size})
+        todo = collections.deque()
+        left = {}
+        for path, info in files.items():
+            locs = range(info['start'], max(info['size'], 1), chunk_size)
+            left[path] = len(locs)
+            todo.extend([(path, loc) for loc in locs])
+        pending = set()
+        failed = set()
+        # The timeouts in a row, and whether chunks were requested again
+        tries = 0
+        resent = False
+        # The requests are tagged with the number of times the minion signed
+        # in again during the transfer, the master echoes the tag
+        renewals = [0]
+
+        def send(path, loc):
+            load['path'] = path
+            load['loc'] = loc
+            payload = {'enc': 'aes',
+                       'lane': 'file',
+                       'load': self.auth.crypticle.dumps(load)}
+            dealer.send_multipart(
+                    [str(renewals[0]), '', self.serial.dumps(payload)])
+            pending.add((path, loc))
+
+        def close(path):
+            fn_ = files[path].pop('fn', None)
+            if fn_:
+                fn_.close()
+
+        while todo or pending:
+            while todo and len(pending) < self.opts['file_window']:
+                path, loc = todo.popleft()
+                if path not in failed:
+                    send(path, loc)
+            if not poller.poll(CHUNK_TIMEOUT * 1000):
+                tries += 1
+                if tries > 3:
+                    failed.update([chunk[0] for chunk in pending])
+                    failed.update([chunk[0] for chunk in todo])
+                    break
+                resent = True
+                for chunk in list(pending):
+                    send(*chunk)
+                continue
+            frames = dealer.recv_multipart()
+            crypticle = self.auth.crypticle
+            try:
+                data = crypticle.loads(self.serial.loads(frames[-1]))
+            except salt.crypt.AuthenticationError:
+                if frames[0] != str(renewals[0]):
+                    # Sent before signing in again, it was sent again since
+                    continue
+                if renewals[0] >= 3:
+                    raise
+                # The master AES key has changed, sign in again and send the
+                # chunks in flight again
+                log.info('The master AES key has changed, signing in again')
+                self.auth.authenticate(crypticle)
+                renewals[0] += 1
+                for chunk in list(pending):
+                    send(*chunk)
+                continue
+            chunk = (data.get('path'), data.get('loc'))
+            if chunk not in pending:
+                # The reply to a chunk which was requested again
+                continue
+            pending.remove(chunk)
+            # The master is making progress, only give up after it stalls
+            tries = 0
+            path, loc = chunk
+            if path in failed:
+                continue
+            info = files[path]
+            if not data['dest']:
+                # The file was removed from the master during the transfer
+                failed.add(path)
+                close(path)
+                continue
+            if 'size' in data and data['size'] != info['size']:
+                # The file changed since its size was known
+                end = max(info['size'], 1)
+                end += -end % chunk_size
+                more = range(end, data['size'], chunk_size)
+                left[path] += len(more)
+                todo.extend([(path, more_loc) for more_loc in more])
+                info['size'] = data['size']
+            if not info.get('fn'):
+                info['fn'] = open(info['local'], 'w+')
+            info['fn'].seek(loc)
+            info['fn'].write(data['data'])
+            left[path] -= 1
+            if not left[path]:
+                info['fn'].truncate(info['size'])
+                close(path)
+        for path in files:
+            close(path)
+        if resent or failed:
+            # Replies to the chunks which were requested again may still be
+            # on their way, drop them with the socket
+            dealer.close()
+            self.dealer = None
+        return failed
+
     def get_file(self, path, dest='', makedirs=False, env='base'):
         '''
         Get a single file from the salt-master
         path must be a salt server location, aka, salt://path/to/file, if
         dest is ommited, then the downloaded file will be placed in the minion
-        cache
+        cache. If the destination already holds a copy of the file it is only
+        downloaded again when it differs from the file on the master
         '''
         path = self._check_proto(path)
-        payload = {'enc': 'aes'}
-        load = {'path': path,
-                'env': env,
-                'cmd': '_serve_file'}
-        fn_ = None
+        payload = {'enc': 'aes', 'lane': 'file'}
+        load = self.__ask_compress({'path': path,
+                                    'env': env,
+                                    'cmd': '_serve_file',
+                                    'chunk_size': self.opts['file_chunk_size']})
         if dest:
             destdir = os.path.dirname(dest)
             if not os.path.isdir(destdir):
@@ -531,54 +744,260 @@ class RemoteClient(Client):
                     os.makedirs(destdir)
                 else:
                     return False
-            fn_ = open(dest, 'w+')
+            local = dest
+        else:
+            local = os.path.join(self.opts['cachedir'], 'files', env, path)
+        if os.path.isfile(local):
+            # Send the hash of the local copy, the master does not send the
+            # file if it is the same
+            try:
+                load['hsum'] = self.hashes.get(local, form=self.hash_type)
+                load['hash_type'] = self.hash_type
+                save_hashes(self.opts)
+            except (IOError, OSError):
+                pass
+            threshold = self.opts['file_delta_threshold']
+            if self.delta and threshold \
+                    and os.path.getsize(local) >= threshold:
+                if self.__get_delta(path, local, env, load.get('hsum')):
+                    return local
+        fn_ = None
         while True:
             if not fn_:
                 load['loc'] = 0
             else:
                 load['loc'] = fn_.tell()
-            payload['load'] = self.auth.crypticle.dumps(load)
-            self.socket.send(self.serial.dumps(payload))
-            data = self.auth.crypticle.loads(self.serial.loads(self.socket.recv()))
+            data = self.auth.request(self.socket, payload, load)
+            if 'hash_type' in data:
+                # Hash the local copies the way the master does from now on
+                self.hash_type = data['hash_type']
+            if data.get('unchanged'):
+                log.debug(
+                    'File {0} is unchanged on the master, using {1}'.format(
+                        path, local))
+                return local
+            load.pop('hsum', None)
+            load.pop('hash_type', None)
             if not data['data']:
-                if not fn_ and data['dest']:
-                    # This is a 0 byte file on the master
-                    with self._cache_loc(data['dest'], env) as cache_dest:
-                        dest = cache_dest
-                        if not os.path.exists(cache_dest):
-                            with open(cache_dest, 'w+') as f:
-                                f.write(data['data'])
+                if not fn_:
+                    if dest:
+                        open(dest, 'w+').close()
+                    elif data['dest']:
+                        # This is a 0 byte file on the master
+                        with self._cache_loc(data['dest'], env) as cache_dest:
+                            dest = cache_dest
+                            open(cache_dest, 'w+').close()
                 break
             if not fn_:
-                with self._cache_loc(data['dest'], env) as cache_dest:
-                    dest = cache_dest
+                if dest:
                     fn_ = open(dest, 'w+')
+                else:
+                    with self._cache_loc(data['dest'], env) as cache_dest:
+                        dest = cache_dest
+                        fn_ = open(dest, 'w+')
             fn_.write(data['data'])
+            if 'size' in data and self.opts['file_window'] > 1:
+                # The master can serve the rest of the file in parallel
+                files = {path: {'local': dest,
+                                'size': data['size'],
+                                'start': data['chunk_size'],
+                                'fn': fn_}}
+                if self.__get_chunks(files, env, data['chunk_size']):
+                    log.error(
+                        'The master stopped serving {0}'.format(path))
+                    fn_.close()
+                    os.remove(dest)
+                    return False
+                break
         if fn_:
             fn_.close()
         return dest
 
+    def __get_range(self, path, env, loc, length):
+        '''
+        Return a range of a file on the master, it is fetched a chunk at a
+        time
+        '''
+        payload = {'enc': 'aes', 'lane': 'file'}
+        ret = []
+        got = 0
+        while got < length:
+            load = self.__ask_compress({'path': path,
+                                        'env': env,
+                                        'cmd': '_serve_file',
+                                        'loc': loc + got,
+                                        'chunk_size': length - got})
+            data = self.auth.request(self.socket, payload, load)
+            if not data.get('data'):
+                raise IOError('{0} changed on the master'.format(path))
+            ret.append(data['data'])
+            got += len(data['data'])
+        return ''.join(ret)
+
+    def __get_delta(self, path, local, env, hsum=None):
+        '''
+        Bring the local copy of a file up to date by fetching only the blocks
+        which differ from the copy on the master. The minion sends the
+        signatures of the blocks of its copy and the new copy is built from
+        the blocks it already has and the data the master sends. Returns
+        False when the whole file has to be fetched
+        '''
+        block = salt.utils.delta.block_size(os.path.getsize(local))
+        load = self.__ask_compress({
+                'path': path,
+                'env': env,
+                'cmd': '_file_delta',
+                'block_size': block,
+                'chunk_size': self.opts['file_chunk_size'],
+                'signatures': salt.utils.delta.signature(local, block)})
+        if hsum:
+            load['hsum'] = hsum
+            load['hash_type'] = self.hash_type
+        data = self.auth.request(
+                self.socket, {'enc': 'aes', 'lane': 'file'}, load)
+        if not isinstance(data, dict):
+            # The master does not serve deltas
+            self.delta = False
+            return False
+        if 'hsum' not in data:
+            return False
+        self.hash_type = data['hash_type']
+        if data.get('unchanged'):
+            log.debug(
+                'File {0} is unchanged on the master, using {1}'.format(
+                    path, local))
+            return True
+        if 'ops' not in data:
+            return False
+        fd_, tmp = tempfile.mkstemp(dir=os.path.dirname(local))
+        try:
+            with os.fdopen(fd_, 'w+b') as fp_:
+                salt.utils.delta.patch(
+                        local,
+                        data['ops'],
+                        block,
+                        fp_,
+                        lambda loc, length: self.__get_range(
+                            path, env, loc, length))
+            if salt.utils.get_hash(tmp, data['hash_type']) != data['hsum']:
+                raise IOError('{0} changed on the master'.format(path))
+            shutil.copymode(local, tmp)
+            os.rename(tmp, local)
+        except (IOError, OSError) as exc:
+            log.debug('Fetching all of {0}: {1}'.format(path, exc))
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return False
+        self.hashes.set(local, data['hsum'], form=data['hash_type'])
+        save_hashes(self.opts)
+        log.debug('Updated {0} from a delta of {1} bytes'.format(
+            local,
+            sum([len(op_) for op_ in data['ops'] if isinstance(op_, str)]
+                + [op_[1] for op_ in data['ops'] if isinstance(op_, list)])))
+        return True
+
+    def file_manifest(self, env='base', prefix=''):
+        '''
+        Return the hashes and sizes of the files on the master under a
+        prefix, None is returned if the master cannot send a manifest
+        '''
+        payload = {'enc': 'aes', 'lane': 'file'}
+        load = self.__ask_compress({'env': env,
+                                    'prefix': prefix,
+                                    'chunk_size': self.opts['file_chunk_size'],
+                                    'cmd': '_file_manifest'})
+        ret = self.auth.request(self.socket, payload, load)
+        if not isinstance(ret, dict) or 'files' not in ret:
+            return None
+        return ret
+
+    def get_files(self, files, env='base', prefix=''):
+        '''
+        Get a list of files from the master, the files are pairs of a url and
+        a destination, an empty destination caches the file. The hashes of
+        the files under the prefix are fetched with a single manifest request
+        and only the files which differ from the local copies are downloaded,
+        many of them at once, the hashes of the copies are saved once at the
+        end. Returns the local paths of the files in the same order
+        '''
+        with hash_batch(self.opts):
+            manifest = self.file_manifest(env, prefix)
+            if manifest is None:
+                return Client.get_files(self, files, env, prefix)
+            ret = []
+            fetch = {}
+            for url, dest in files:
+                if not url.startswith('salt://'):
+                    ret.append(self.get_url(url, dest, True, env))
+                    continue
+                path = self._check_proto(url)
+                info = manifest['files'].get(path)
+                if info is None or path in fetch:
+                    # Added since the manifest was made, or asked for twice
+                    ret.append(self.get_file(url, dest, True, env))
+                    continue
+                if dest:
+                    local = dest
+                    if not os.path.isdir(os.path.dirname(dest)):
+                        os.makedirs(os.path.dirname(dest))
+                else:
+                    with self._cache_loc(path, env) as cache_dest:
+                        local = cache_dest
+                ret.append(local)
+                if os.path.isfile(local):
+                    try:
+                        hsum = self.hashes.get(
+                                local, form=manifest['hash_type'])
+                        if hsum == info['hsum']:
+                            continue
+                    except (IOError, OSError):
+                        pass
+                fetch[path] = {'local': local,
+                               'size': info['size'],
+                               'start': 0,
+                               'index': len(ret) - 1}
+            if fetch:
+                log.debug('Fetching {0} of {1} files from the master'.format(
+                    len(fetch), len(files)))
+                failed = self.__get_chunks(fetch, env, manifest['chunk_size'])
+                for path, info in fetch.items():
+                    if path not in failed:
+                        # The copy now has the hash the master sent
+                        try:
+                            self.hashes.set(
+                                    info['local'],
+                                    manifest['files'][path]['hsum'],
+                                    form=manifest['hash_type'])
+                        except OSError:
+                            pass
+                        continue
+                    log.error('The master stopped serving {0}'.format(path))
+                    ret[info['index']] = False
+                    try:
+                        os.remove(info['local'])
+                    except OSError:
+                        pass
+            return ret
+
     def file_list(self, env='base'):
         '''
         List the files on the master
         '''
-        payload = {'enc': 'aes'}
-        load = {'env': env,
-                'cmd': '_file_list'}
-        payload['load'] = self.auth.crypticle.dumps(load)
-        self.socket.send(self.serial.dumps(payload))
-        return self.auth.crypticle.loads(self.serial.loads(self.socket.recv()))
+        payload = {'enc': 'aes', 'lane': 'file'}
+        load = self.__ask_compress({'env': env,
+                                    'cmd': '_file_list'})
+        return self.auth.request(self.socket, payload, load)
 
     def file_list_emptydirs(self, env='base'):
         '''
         List the empty dirs on the master
         '''
-        payload = {'enc': 'aes'}
+        payload = {'enc': 'aes', 'lane': 'file'}
         load = {'env': env,
                 'cmd': '_file_list_emptydirs'}
-        payload['load'] = self.auth.crypticle.dumps(load)
-        self.socket.send(self.serial.dumps(payload))
-        return self.auth.crypticle.loads(self.serial.loads(self.socket.recv()))
+        return self.auth.request(self.socket, payload, load)
 
     def hash_file(self, path, env='base'):
         '''
@@ -596,28 +1015,23 @@ class RemoteClient(Client):
                 return {}
             else:
                 ret = {}
-                with open(path, 'rb') as f:
-                    ret['hsum'] = hashlib.md5(f.read()).hexdigest()
+                ret['hsum'] = salt.utils.get_hash(path, 'md5')
                 ret['hash_type'] = 'md5'
                 return ret
-        payload = {'enc': 'aes'}
+        payload = {'enc': 'aes', 'lane': 'file'}
         load = {'path': path,
                 'env': env,
                 'cmd': '_file_hash'}
-        payload['load'] = self.auth.crypticle.dumps(load)
-        self.socket.send(self.serial.dumps(payload))
-        return self.auth.crypticle.loads(self.serial.loads(self.socket.recv()))
+        return self.auth.request(self.socket, payload, load)
 
     def list_env(self, path, env='base'):
         '''
         Return a list of the files in the file server's specified environment
         '''
-        payload = {'enc': 'aes'}
-        load = {'env': env,
-                'cmd': '_file_list'}
-        payload['load'] = self.auth.crypticle.dumps(load)
-        self.socket.send(self.serial.dumps(payload))
-        return self.auth.crypticle.loads(self.serial.loads(self.socket.recv()))
+        payload = {'enc': 'aes', 'lane': 'file'}
+        load = self.__ask_compress({'env': env,
+                                    'cmd': '_file_list'})
+        return self.auth.request(self.socket, payload, load)
 
     def master_opts(self):
         '''
@@ -625,9 +1039,7 @@ class RemoteClient(Client):
         '''
         payload = {'enc': 'aes'}
         load = {'cmd': '_master_opts'}
-        payload['load'] = self.auth.crypticle.dumps(load)
-        self.socket.send(self.serial.dumps(payload))
-        return self.auth.crypticle.loads(self.serial.loads(self.socket.recv()))
+        return self.auth.request(self.socket, payload, load)
 
     def ext_nodes(self):
         '''
@@ -637,6 +1049,4 @@ class RemoteClient(Client):
         payload = {'enc': 'aes'}
         load = {'cmd': '_ext_nodes',
                 'id': self.opts['id']}
-        payload['load'] = self.auth.crypticle.dumps(load)
-        self.socket.send(self.serial.dumps(payload))
-        return self.auth.crypticle.loads(self.serial.loads(self.socket.recv()))
+        return self.auth.request(self.socket, payload, load)
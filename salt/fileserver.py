@@ -0,0 +1,391 @@
+'''
+Keep an index of the files served by the master file server
+
+Finding a file, listing an environment or hashing a file used to stat and
+walk every file root on each request. The index maps the relative path of
+every file in an environment to the file it is served from, along with its
+size, mtime and hash. It is built and kept up to date by a single master
+process, which polls the file roots and writes the index out to the
+cachedir, the workers read it back in whenever it changes and answer file
+server requests with dictionary lookups.
+
+Files are hashed a block at a time and the hashes are cached by the path,
+size, mtime and inode of the file, so a file is only hashed again after it
+changes, including across restarts of the master.
+'''
+
+# Import python libs
+import os
+import time
+import tempfile
+import logging
+
+# Import salt libs
+import salt.payload
+import salt.utils
+
+log = logging.getLogger(__name__)
+
+
+def index_path(opts):
+    '''
+    Return the path of the file server index
+    '''
+    return os.path.join(opts['cachedir'], 'fileserver', 'index.p')
+
+
+def clear(opts):
+    '''
+    Remove an index left behind by a previous run of the master, it would be
+    trusted until the first refresh otherwise
+    '''
+    try:
+        os.remove(index_path(opts))
+    except OSError:
+        pass
+
+
+class HashCache(object):
+    '''
+    Cache the hashes of files by their path, the hashes are only used while
+    the size, mtime and inode of the file are unchanged so a file is only
+    read again after it changes. A cache given a path is persisted there so
+    it survives restarts, the master file index and the minion file client
+    both keep one
+    '''
+    def __init__(self, opts, path=None):
+        self.opts = opts
+        self.serial = salt.payload.Serial({'serial': 'msgpack'})
+        self.path = path
+        self.cache = {}
+        self.dirty = False
+        # The depth of the batches of files being worked on, the cache is
+        # saved when the outermost batch ends
+        self.batch = 0
+        if path:
+            self.load()
+
+    def load(self):
+        '''
+        Read the persisted hashes
+        '''
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as fp_:
+                self.cache = self.serial.load(fp_)
+        except Exception as exc:
+            log.error('Failed to read the file hash cache: {0}'.format(exc))
+            self.cache = {}
+
+    def save(self):
+        '''
+        Write the hashes out if they have changed
+        '''
+        if not self.path or not self.dirty:
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            # Several processes may save the cache at once, the last one wins
+            fd_, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path))
+            with os.fdopen(fd_, 'w+b') as fp_:
+                self.serial.dump(self.cache, fp_)
+            os.rename(tmp, self.path)
+            self.dirty = False
+        except (IOError, OSError) as exc:
+            log.error('Failed to write the file hash cache: {0}'.format(exc))
+
+    def _entry(self, path, stat):
+        '''
+        Return the hashes cached for a file by hash type, they are dropped if
+        the file has changed since they were cached
+        '''
+        key = [stat.st_size, stat.st_mtime, stat.st_ino]
+        cached = self.cache.get(path)
+        if not cached or list(cached[:3]) != key \
+                or not isinstance(cached[3], dict):
+            cached = self.cache[path] = key + [{}]
+        return cached[3]
+
+    def get(self, path, stat=None, form=None):
+        '''
+        Return the hash of a file, hashing it if it is not in the cache or
+        has changed. The hash type defaults to the hash_type option
+        '''
+        if stat is None:
+            stat = os.stat(path)
+        form = form or self.opts['hash_type']
+        hashes = self._entry(path, stat)
+        if form not in hashes:
+            hashes[form] = salt.utils.get_hash(path, form)
+            self.dirty = True
+        return hashes[form]
+
+    def cached_form(self, path, stat=None):
+        '''
+        Return the hash type the hash of an unchanged file is cached under,
+        such as the type of the master file server for a file it sent. The
+        hash_type option is preferred and used when no hash is cached
+        '''
+        if stat is None:
+            stat = os.stat(path)
+        hashes = self._entry(path, stat)
+        if self.opts['hash_type'] in hashes or not hashes:
+            return self.opts['hash_type']
+        return sorted(hashes)[0]
+
+    def set(self, path, hsum, stat=None, form=None):
+        '''
+        Record the hash of a file which is already known, such as a file
+        which has just been written out from a copy with that hash
+        '''
+        if stat is None:
+            stat = os.stat(path)
+        self._entry(path, stat)[form or self.opts['hash_type']] = hsum
+        self.dirty = True
+
+    def prune(self, paths):
+        '''
+        Drop the hashes of files which are no longer in the given paths
+        '''
+        for path in set(self.cache).difference(paths):
+            del self.cache[path]
+            self.dirty = True
+
+
+class FileIndex(object):
+    '''
+    The index of the files in all of the file server environments
+    '''
+    def __init__(self, opts):
+        self.opts = opts
+        self.serial = salt.payload.Serial({'serial': 'msgpack'})
+        self.path = index_path(opts)
+        self.index = {}
+        self.mtime = None
+        self.hashes = None
+        # The listing of every directory in the file roots, with the stat of
+        # the directory it was made with
+        self.dirs = {}
+
+    def _list_dir(self, path, listed):
+        '''
+        Return the subdirectories and the files in a directory, or None if it
+        is not a directory. The directory is only listed again when it has
+        changed since the last refresh
+        '''
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isdir(path):
+            return None
+        stamp = (stat.st_mtime, stat.st_ino)
+        cached = self.dirs.get(path)
+        # Changes made within the same tick of the clock leave the mtime
+        # alone, a directory changed in the last second is always listed
+        if cached and cached[0] == stamp and time.time() - stat.st_mtime > 1:
+            listed[path] = cached
+            return cached[1], cached[2]
+        dirs = []
+        fns = []
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return None
+        for name in names:
+            if os.path.isdir(os.path.join(path, name)):
+                dirs.append(name)
+            else:
+                fns.append(name)
+        listed[path] = (stamp, dirs, fns)
+        return dirs, fns
+
+    def _walk_root(self, root, listed):
+        '''
+        Walk a file root like os.walk following links, the listings of the
+        directories which have not changed are reused
+        '''
+        paths = [root]
+        while paths:
+            dirpath = paths.pop()
+            listing = self._list_dir(dirpath, listed)
+            if listing is None:
+                continue
+            dirs, fns = listing
+            yield dirpath, dirs, fns
+            paths.extend(
+                    [os.path.join(dirpath, dir_) for dir_ in reversed(dirs)])
+
+    def _walk_env(self, roots, listed):
+        '''
+        Walk the roots of an environment, a file found in more than one root
+        is served from the first root. The files are still stat'd so that
+        changes to their contents are picked up
+        '''
+        files = {}
+        emptydirs = []
+        for root in roots:
+            for dirpath, dirs, fns in self._walk_root(root, listed):
+                if not dirs and not fns:
+                    rel = os.path.relpath(dirpath, root)
+                    if rel not in emptydirs:
+                        emptydirs.append(rel)
+                for fn_ in fns:
+                    full = os.path.join(dirpath, fn_)
+                    rel = os.path.relpath(full, root)
+                    if rel in files:
+                        continue
+                    try:
+                        stat = os.stat(full)
+                    except OSError:
+                        # Removed during the walk or a dangling link
+                        continue
+                    try:
+                        hsum = self.hashes.get(full, stat)
+                    except IOError:
+                        continue
+                    files[rel] = {'path': full,
+                                  'size': stat.st_size,
+                                  'mtime': stat.st_mtime,
+                                  'ino': stat.st_ino,
+                                  'hash': hsum}
+        return {'files': files, 'emptydirs': emptydirs}
+
+    def refresh(self):
+        '''
+        Rescan the file roots and write the index out if anything changed,
+        only the directories which changed are listed again, returns True
+        when the index was written
+        '''
+        if self.hashes is None:
+            self.hashes = HashCache(
+                    self.opts,
+                    os.path.join(os.path.dirname(self.path), 'hashes.p'))
+        index = {}
+        listed = {}
+        for env, roots in self.opts['file_roots'].items():
+            index[env] = self._walk_env(roots, listed)
+        # The directories which are gone are dropped
+        self.dirs = listed
+        self.hashes.prune(
+                [entry['path'] for env in index.values()
+                 for entry in env['files'].values()])
+        self.hashes.save()
+        if index == self.index and os.path.isfile(self.path):
+            return False
+        self.index = index
+        self.write()
+        return True
+
+    def write(self):
+        '''
+        Write the index to the cachedir, the workers pick it up by its mtime
+        '''
+        i_dir = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(i_dir):
+                os.makedirs(i_dir)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w+b') as fp_:
+                self.serial.dump(
+                        {'hash_type': self.opts['hash_type'],
+                         'envs': self.index},
+                        fp_)
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as exc:
+            log.error('Failed to write the file server index: {0}'.format(exc))
+
+    def load(self):
+        '''
+        Read the index back in if it has been written since it was last
+        read, returns False when there is no index to use
+        '''
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            self.index = {}
+            self.mtime = None
+            return False
+        if mtime != self.mtime:
+            try:
+                with open(self.path, 'rb') as fp_:
+                    data = self.serial.load(fp_)
+            except Exception as exc:
+                log.error(
+                    'Failed to read the file server index: {0}'.format(exc))
+                return bool(self.index)
+            if data.get('hash_type') == self.opts['hash_type']:
+                self.index = data.get('envs', {})
+            else:
+                self.index = {}
+            self.mtime = mtime
+        return bool(self.index)
+
+    def find(self, path, env='base'):
+        '''
+        Return the index entry of a relative path, None is returned if the
+        environment is not indexed or the path is not in it
+        '''
+        if env not in self.index:
+            return None
+        return self.index[env]['files'].get(os.path.normpath(path))
+
+    def file_list(self, env='base'):
+        '''
+        Return the files in an environment, None if it is not indexed
+        '''
+        if env not in self.index:
+            return None
+        return sorted(self.index[env]['files'])
+
+    def file_list_emptydirs(self, env='base'):
+        '''
+        Return the empty directories in an environment, None if it is not
+        indexed
+        '''
+        if env not in self.index:
+            return None
+        return list(self.index[env]['emptydirs'])
+
+    def file_hash(self, path, env='base'):
+        '''
+        Return the hash of a file from the index, the file is stat'd to make
+        sure it has not changed since it was indexed. None is returned when
+        the hash needs to be computed
+        '''
+        entry = self.find(path, env)
+        if not entry:
+            return None
+        try:
+            stat = os.stat(entry['path'])
+        except OSError:
+            return None
+        if stat.st_size != entry['size'] \
+                or stat.st_mtime != entry['mtime'] \
+                or stat.st_ino != entry['ino']:
+            return None
+        return entry['hash']
+
+
+def update_index(opts):
+    '''
+    Keep the file server index up to date, this is run in its own process
+    by the master
+    '''
+    index = FileIndex(opts)
+    while True:
+        start = time.time()
+        try:
+            if index.refresh():
+                log.debug(
+                    'Refreshed the file server index in {0:.3f} seconds'
+                    .format(time.time() - start))
+        except Exception as exc:
+            log.error(
+                'Failed to refresh the file server index: {0}'.format(exc))
+        try:
+            time.sleep(opts['file_index_interval'])
+        except KeyboardInterrupt:
+            break
@@ -0,0 +1,748 @@
+'''
+The job cache stores the publications made by the master and the returns sent
+back by the minions.
+
+The backend is set with the ``job_cache`` option in the master config:
+
+local
+    The default, a directory per job under ``cachedir/jobs`` holding a
+    directory per returned minion
+
+sqlite
+    All jobs are kept in a single indexed database file, writes are a single
+    transaction and expiring jobs is a range delete. The jobs left under
+    ``cachedir/jobs`` by the local job cache are expired as before
+'''
+
+# Import python libs
+import os
+import errno
+import shutil
+import logging
+import threading
+import datetime
+import sqlite3
+
+# Import salt libs
+import salt.utils
+import salt.payload
+
+log = logging.getLogger(__name__)
+
+
+def get_job_cache(opts):
+    '''
+    Return the job cache backend set in the ``job_cache`` option
+    '''
+    backends = {'sqlite': SQLiteJobCache,
+                'local': LocalJobCache}
+    backend = opts.get('job_cache', 'local')
+    if backend not in backends:
+        log.error('Unknown job cache {0}, falling back to local'.format(
+            backend))
+        backend = 'local'
+    return backends[backend](opts)
+
+
+def gen_jid():
+    '''
+    Generate a new job id, job ids are sortable by the time they were made
+    '''
+    return '{0:%Y%m%d%H%M%S%f}'.format(datetime.datetime.now())
+
+
+def jid_cutoff(hours):
+    '''
+    Return the smallest job id which is younger than the given number of hours
+    '''
+    return '{0:%Y%m%d%H%M%S%f}'.format(
+            datetime.datetime.now() - datetime.timedelta(hours=hours))
+
+
+def time_to_jid(stamp):
+    '''
+    Convert a time stamp such as ``2012-06-01 14:30`` or a partial job id into
+    a job id which can be compared against the job ids in the cache
+    '''
+    digits = ''.join([char for char in str(stamp) if char.isdigit()])
+    return digits[:20].ljust(20, '0')
+
+
+def _extra_return(load):
+    '''
+    Log a return which is dropped because the minion already returned for
+    the job. The minions send a return again when the master is slow to
+    answer, so the first copy may well have been saved
+    '''
+    log.warning(
+            ('An extra return was detected from minion {0} for job {1}, it '
+            'was dropped. The minion may have sent it again after a timeout, '
+            'if not verify the minion, this could be a replay attack').format(
+                load['id'], load['jid']))
+
+
+class JobCache(object):
+    '''
+    The interface which all job cache backends need to provide
+    '''
+    def __init__(self, opts):
+        self.opts = opts
+        self.serial = salt.payload.Serial(self.opts)
+
+    def prep_jid(self):
+        '''
+        Generate a job id and register it in the cache
+        '''
+        raise NotImplementedError
+
+    def jid_exists(self, jid):
+        '''
+        Returns True if the job is present in the cache
+        '''
+        raise NotImplementedError
+
+    def save_load(self, jid, load):
+        '''
+        Save the publication load of a job
+        '''
+        raise NotImplementedError
+
+    def get_load(self, jid):
+        '''
+        Return the publication load of a job, an empty dict if it is unknown
+        '''
+        raise NotImplementedError
+
+    def save_return(self, load):
+        '''
+        Save a minion return, the load carries the jid, id, return and the
+        optional out. Returns False if the job is not known or if the minion
+        already returned for it
+        '''
+        raise NotImplementedError
+
+    def save_returns(self, loads):
+        '''
+        Save a list of minion return loads, returns the list of the loads
+        which were saved
+        '''
+        return [load for load in loads if self.save_return(load)]
+
+    def get_returns(self, jid, found=()):
+        '''
+        Return a dict of the returns for the job which are not in found, the
+        returns are dicts of the form {'ret': <return>, 'out': <outputter>}
+        '''
+        raise NotImplementedError
+
+    def list_jobs(self):
+        '''
+        Return a dict of all of the job loads keyed by jid
+        '''
+        raise NotImplementedError
+
+    def find_jobs(
+            self,
+            fun=None,
+            tgt=None,
+            minion=None,
+            start=None,
+            end=None,
+            limit=None,
+            offset=0):
+        '''
+        Return a list of (jid, load) tuples for the jobs which ran the given
+        function on the given target, which were returned by the given minion
+        and which were started between start and end, newest first. The
+        start and end are time stamps or job ids, end is exclusive.
+
+        This reads every job in the cache, backends override it with a
+        search over their job index
+        '''
+        ret = []
+        start = time_to_jid(start) if start else None
+        end = time_to_jid(end) if end else None
+        for jid, load in sorted(self.list_jobs().items(), reverse=True):
+            if start and jid < start or end and jid >= end:
+                continue
+            if fun and self._flatten(load.get('fun')) != fun:
+                continue
+            if tgt and self._flatten(load.get('tgt')) != tgt:
+                continue
+            if minion and minion not in self.get_returns(jid):
+                continue
+            ret.append((jid, load))
+        if limit:
+            return ret[offset:offset + limit]
+        return ret[offset:]
+
+    def _flatten(self, data):
+        '''
+        Multi function jobs and list targets are stored as comma delimited
+        strings so that they can be indexed
+        '''
+        if isinstance(data, (list, tuple)):
+            return ','.join([str(item) for item in data])
+        if data is None:
+            return None
+        return str(data)
+
+    def add_wtag(self, jid, id_):
+        '''
+        Flag that a syndic is writing returns for the job
+        '''
+        raise NotImplementedError
+
+    def del_wtag(self, jid, id_):
+        '''
+        Remove the syndic write flag
+        '''
+        raise NotImplementedError
+
+    def has_wtag(self, jid):
+        '''
+        Returns True if a syndic is writing returns for the job
+        '''
+        raise NotImplementedError
+
+    def clean_old_jobs(self):
+        '''
+        Remove the jobs older than the ``keep_jobs`` option, returns a dict
+        with the number of jobs and the number of bytes which were removed
+        '''
+        raise NotImplementedError
+
+
+class LocalJobCache(JobCache):
+    '''
+    Store the jobs in a directory tree under the cachedir
+    '''
+    def __init__(self, opts):
+        JobCache.__init__(self, opts)
+        self.job_dir = os.path.join(self.opts['cachedir'], 'jobs')
+        # The jobs are appended to an index file per hour, so that job
+        # searches only read the index files in the searched time window and
+        # expiring the jobs drops whole hours at a time
+        self.index_dir = os.path.join(self.job_dir, '.index')
+        # Marks that the jobs cached before the index was kept are indexed
+        self.index_mark = os.path.join(self.job_dir, '.indexed')
+        self.__indexed = False
+
+    def _jid_dir(self, jid):
+        return salt.utils.jid_dir(
+                jid,
+                self.opts['cachedir'],
+                self.opts['hash_type']
+                )
+
+    def prep_jid(self):
+        jid = salt.utils.prep_jid(
+                self.opts['cachedir'],
+                self.opts['hash_type']
+                )
+        self._index_job(jid, {})
+        return jid
+
+    def jid_exists(self, jid):
+        return os.path.isdir(self._jid_dir(jid))
+
+    def save_load(self, jid, load):
+        jid_dir = self._jid_dir(jid)
+        if not os.path.isdir(jid_dir):
+            os.makedirs(jid_dir)
+        self.serial.dump(
+                load,
+                open(os.path.join(jid_dir, '.load.p'), 'w+')
+                )
+        self._index_job(jid, load)
+
+    def _index_job(self, jid, load):
+        '''
+        Append the metadata of the job to the index file of the hour it was
+        started in, a single short append is atomic so the master workers can
+        write to the same file
+        '''
+        if not os.path.isdir(self.index_dir):
+            try:
+                os.makedirs(self.index_dir)
+            except OSError:
+                # Another worker made it first
+                pass
+        fields = [jid]
+        for key in ('fun', 'tgt', 'tgt_type', 'user'):
+            field = self._flatten(load.get(key)) or ''
+            fields.append(field.replace('\t', ' ').replace('\n', ' '))
+        with open(os.path.join(self.index_dir, jid[:10]), 'a') as fp_:
+            fp_.write('\t'.join(fields) + '\n')
+
+    def _read_index(self, bucket):
+        '''
+        Return the job metadata in an hourly index file, newest first. A job
+        is indexed without metadata when the job id is made and again with
+        it when the load is saved
+        '''
+        jobs = {}
+        try:
+            with open(os.path.join(self.index_dir, bucket), 'r') as fp_:
+                lines = fp_.readlines()
+        except (IOError, OSError):
+            return []
+        for line in lines:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 5:
+                continue
+            if fields[0] not in jobs or any(fields[1:]):
+                jobs[fields[0]] = fields
+        return sorted(jobs.values(), reverse=True)
+
+    def get_load(self, jid):
+        loadp = os.path.join(self._jid_dir(jid), '.load.p')
+        if not os.path.isfile(loadp):
+            return {}
+        return self.serial.load(open(loadp, 'rb'))
+
+    def save_return(self, load):
+        jid_dir = self._jid_dir(load['jid'])
+        if not os.path.isdir(jid_dir):
+            log.error(
+                'An inconsistency occurred, a job was received with a job id '
+                'that is not present on the master: %(jid)s', load
+            )
+            return False
+        hn_dir = os.path.join(jid_dir, load['id'])
+        try:
+            # Made in one step so that only one of the copies of a return
+            # which is sent again is saved
+            os.makedirs(hn_dir)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+            # The minion has already returned this jid, drop it
+            _extra_return(load)
+            return False
+        self.serial.dump(load['return'],
+                open(os.path.join(hn_dir, 'return.p'), 'w+'))
+        if 'out' in load:
+            self.serial.dump(load['out'],
+                    open(os.path.join(hn_dir, 'out.p'), 'w+'))
+        return True
+
+    def get_returns(self, jid, found=()):
+        ret = {}
+        jid_dir = self._jid_dir(jid)
+        if not os.path.isdir(jid_dir):
+            return ret
+        for fn_ in os.listdir(jid_dir):
+            if fn_.startswith('.') or fn_ in found:
+                continue
+            retp = os.path.join(jid_dir, fn_, 'return.p')
+            outp = os.path.join(jid_dir, fn_, 'out.p')
+            if not os.path.isfile(retp):
+                continue
+            try:
+                ret[fn_] = {'ret': self.serial.load(open(retp, 'rb'))}
+                if os.path.isfile(outp):
+                    ret[fn_]['out'] = self.serial.load(open(outp, 'rb'))
+            except Exception:
+                # The return is still being written, it will be picked up
+                # on the next read
+                ret.pop(fn_, None)
+        return ret
+
+    def list_jobs(self):
+        ret = {}
+        for top in os.listdir(self.job_dir):
+            t_path = os.path.join(self.job_dir, top)
+            if top.startswith('.') or not os.path.isdir(t_path):
+                continue
+            for final in os.listdir(t_path):
+                loadpath = os.path.join(t_path, final, '.load.p')
+                if not os.path.isfile(loadpath):
+                    continue
+                load = self.serial.load(open(loadpath, 'rb'))
+                ret[load['jid']] = load
+        return ret
+
+    def find_jobs(
+            self,
+            fun=None,
+            tgt=None,
+            minion=None,
+            start=None,
+            end=None,
+            limit=None,
+            offset=0):
+        ret = []
+        self._build_index()
+        if not os.path.isdir(self.index_dir):
+            return ret
+        start = time_to_jid(start) if start else None
+        end = time_to_jid(end) if end else None
+        for bucket in sorted(os.listdir(self.index_dir), reverse=True):
+            if start and bucket < start[:10] or end and bucket > end[:10]:
+                continue
+            for jid, j_fun, j_tgt, _, _ in self._read_index(bucket):
+                if start and jid < start or end and jid >= end:
+                    continue
+                if fun and j_fun != fun or tgt and j_tgt != tgt:
+                    continue
+                if minion and not os.path.isdir(
+                        os.path.join(self._jid_dir(jid), minion)):
+                    continue
+                load = self.get_load(jid)
+                if not load:
+                    # The job has been removed from the cache
+                    continue
+                if offset:
+                    offset -= 1
+                    continue
+                ret.append((jid, load))
+                if limit and len(ret) >= limit:
+                    return ret
+        return ret
+
+    def add_wtag(self, jid, id_):
+        wtag = os.path.join(self._jid_dir(jid), 'wtag_{0}'.format(id_))
+        with open(wtag, 'w+') as fp_:
+            fp_.write('')
+
+    def del_wtag(self, jid, id_):
+        wtag = os.path.join(self._jid_dir(jid), 'wtag_{0}'.format(id_))
+        if os.path.isfile(wtag):
+            os.remove(wtag)
+
+    def has_wtag(self, jid):
+        for fn_ in os.listdir(self._jid_dir(jid)):
+            if fn_.startswith('wtag'):
+                return True
+        return False
+
+    def _rm_job_dir(self, path):
+        '''
+        Remove a job directory, returns the number of bytes freed
+        '''
+        size = 0
+        for root, dirs, files in os.walk(path):
+            for fn_ in files:
+                try:
+                    size += os.lstat(os.path.join(root, fn_)).st_size
+                except OSError:
+                    pass
+        shutil.rmtree(path, ignore_errors=True)
+        return size
+
+    def _build_index(self):
+        '''
+        Index the jobs cached before the hourly index was kept, the whole job
+        tree is only walked once
+        '''
+        if self.__indexed or os.path.isfile(self.index_mark):
+            self.__indexed = True
+            return
+        if not os.path.isdir(self.job_dir):
+            return
+        indexed = set()
+        if os.path.isdir(self.index_dir):
+            for bucket in os.listdir(self.index_dir):
+                indexed.update(
+                        [fields[0] for fields in self._read_index(bucket)])
+        for top in os.listdir(self.job_dir):
+            t_path = os.path.join(self.job_dir, top)
+            if top.startswith('.') or not os.path.isdir(t_path):
+                continue
+            for final in os.listdir(t_path):
+                f_path = os.path.join(t_path, final)
+                jid_file = os.path.join(f_path, 'jid')
+                if not os.path.isfile(jid_file):
+                    continue
+                with open(jid_file, 'r') as fn_:
+                    jid = fn_.read()
+                if jid in indexed:
+                    continue
+                try:
+                    load = self.get_load(jid)
+                except Exception:
+                    load = {}
+                self._index_job(jid, load)
+        with open(self.index_mark, 'w+') as fp_:
+            fp_.write('')
+        self.__indexed = True
+
+    def clean_old_jobs(self):
+        cutoff = jid_cutoff(self.opts['keep_jobs'])
+        ret = {'jobs': 0, 'bytes': 0}
+        self._build_index()
+        if not os.path.isdir(self.index_dir):
+            return ret
+        # Only whole hours are dropped, the jobs in the hour the cutoff falls
+        # in are removed when that hour has passed
+        for bucket in sorted(os.listdir(self.index_dir)):
+            if bucket >= cutoff[:10]:
+                break
+            for fields in self._read_index(bucket):
+                jid_dir = self._jid_dir(fields[0])
+                if os.path.isdir(jid_dir):
+                    ret['bytes'] += self._rm_job_dir(jid_dir)
+                    ret['jobs'] += 1
+            bucket_path = os.path.join(self.index_dir, bucket)
+            ret['bytes'] += os.path.getsize(bucket_path)
+            os.remove(bucket_path)
+        return ret
+
+
+class SQLiteJobCache(JobCache):
+    '''
+    Store the jobs in an sqlite database, the database is opened in write
+    ahead log mode so that the master workers can write returns while the
+    clients read them
+    '''
+    def __init__(self, opts):
+        JobCache.__init__(self, opts)
+        self.db_path = os.path.join(self.opts['cachedir'], 'jobs.db')
+        # A connection per process and thread, sqlite connections can not be
+        # shared over a fork or between threads
+        self.__local = threading.local()
+        # The jobs kept by the local job cache before the switch to sqlite
+        self.legacy = LocalJobCache(opts)
+
+    @property
+    def conn(self):
+        '''
+        The sqlite connection for this process and thread
+        '''
+        local = self.__local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.conn = self.__connect()
+            local.pid = os.getpid()
+        return local.conn
+
+    def __connect(self):
+        '''
+        Open the database and make sure that the schema is in place
+        '''
+        conn = sqlite3.connect(
+                self.db_path,
+                timeout=self.opts.get('job_cache_timeout', 30)
+                )
+        conn.text_factory = str
+        # Only takes effect when the database is created, it lets the freed
+        # pages be returned after old jobs are removed
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS jids ('
+                         'jid TEXT PRIMARY KEY, '
+                         'fun TEXT, '
+                         'tgt TEXT, '
+                         'tgt_type TEXT, '
+                         'user TEXT, '
+                         'load BLOB)')
+            conn.execute('CREATE INDEX IF NOT EXISTS jids_fun '
+                         'ON jids (fun, jid)')
+            conn.execute('CREATE TABLE IF NOT EXISTS returns ('
+                         'jid TEXT, '
+                         'id TEXT, '
+                         'ret BLOB, '
+                         'out BLOB, '
+                         'PRIMARY KEY (jid, id))')
+            conn.execute('CREATE INDEX IF NOT EXISTS returns_id '
+                         'ON returns (id, jid)')
+            conn.execute('CREATE TABLE IF NOT EXISTS wtags ('
+                         'jid TEXT, '
+                         'id TEXT, '
+                         'PRIMARY KEY (jid, id))')
+        return conn
+
+    def prep_jid(self):
+        while True:
+            jid = gen_jid()
+            try:
+                with self.conn as conn:
+                    conn.execute(
+                        'INSERT INTO jids (jid) VALUES (?)', (jid,))
+                return jid
+            except sqlite3.IntegrityError:
+                continue
+
+    def jid_exists(self, jid):
+        cur = self.conn.execute('SELECT 1 FROM jids WHERE jid = ?', (jid,))
+        return cur.fetchone() is not None
+
+    def save_load(self, jid, load):
+        with self.conn as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO jids '
+                '(jid, fun, tgt, tgt_type, user, load) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (jid,
+                 self._flatten(load.get('fun')),
+                 self._flatten(load.get('tgt')),
+                 load.get('tgt_type', 'glob'),
+                 load.get('user'),
+                 buffer(self.serial.dumps(load))))
+
+    def get_load(self, jid):
+        cur = self.conn.execute('SELECT load FROM jids WHERE jid = ?', (jid,))
+        row = cur.fetchone()
+        if not row or row[0] is None:
+            return {}
+        return self.serial.loads(str(row[0]))
+
+    def save_return(self, load):
+        if not self.jid_exists(load['jid']):
+            log.error(
+                'An inconsistency occurred, a job was received with a job id '
+                'that is not present on the master: %(jid)s', load
+            )
+            return False
+        out = None
+        if 'out' in load:
+            out = buffer(self.serial.dumps(load['out']))
+        try:
+            with self.conn as conn:
+                conn.execute(
+                    'INSERT INTO returns (jid, id, ret, out) '
+                    'VALUES (?, ?, ?, ?)',
+                    (load['jid'],
+                     load['id'],
+                     buffer(self.serial.dumps(load['return'])),
+                     out))
+        except sqlite3.IntegrityError:
+            _extra_return(load)
+            return False
+        return True
+
+    def save_returns(self, loads):
+        saved = []
+        jids = {}
+        with self.conn as conn:
+            # All of the returns are written in a single transaction
+            for load in loads:
+                if load['jid'] not in jids:
+                    jids[load['jid']] = conn.execute(
+                            'SELECT 1 FROM jids WHERE jid = ?',
+                            (load['jid'],)).fetchone() is not None
+                if not jids[load['jid']]:
+                    log.error(
+                        'An inconsistency occurred, a job was received with '
+                        'a job id that is not present on the master: '
+                        '%(jid)s', load
+                    )
+                    continue
+                out = None
+                if 'out' in load:
+                    out = buffer(self.serial.dumps(load['out']))
+                try:
+                    conn.execute(
+                        'INSERT INTO returns (jid, id, ret, out) '
+                        'VALUES (?, ?, ?, ?)',
+                        (load['jid'],
+                         load['id'],
+                         buffer(self.serial.dumps(load['return'])),
+                         out))
+                except sqlite3.IntegrityError:
+                    _extra_return(load)
+                    continue
+                saved.append(load)
+        return saved
+
+    def get_returns(self, jid, found=()):
+        ret = {}
+        cur = self.conn.execute(
+                'SELECT id, ret, out FROM returns WHERE jid = ?',
+                (jid,))
+        for id_, ret_data, out in cur:
+            if id_ in found:
+                continue
+            ret[id_] = {'ret': self.serial.loads(str(ret_data))}
+            if out is not None:
+                ret[id_]['out'] = self.serial.loads(str(out))
+        return ret
+
+    def list_jobs(self):
+        ret = {}
+        cur = self.conn.execute(
+                'SELECT jid, load FROM jids WHERE load IS NOT NULL')
+        for jid, load in cur:
+            ret[jid] = self.serial.loads(str(load))
+        return ret
+
+    def find_jobs(
+            self,
+            fun=None,
+            tgt=None,
+            minion=None,
+            start=None,
+            end=None,
+            limit=None,
+            offset=0):
+        query = 'SELECT jid, load FROM jids WHERE load IS NOT NULL'
+        args = []
+        if fun:
+            query += ' AND fun = ?'
+            args.append(fun)
+        if tgt:
+            query += ' AND tgt = ?'
+            args.append(tgt)
+        if minion:
+            query += ' AND jid IN (SELECT jid FROM returns WHERE id = ?)'
+            args.append(minion)
+        if start:
+            query += ' AND jid >= ?'
+            args.append(time_to_jid(start))
+        if end:
+            query += ' AND jid < ?'
+            args.append(time_to_jid(end))
+        query += ' ORDER BY jid DESC'
+        if limit:
+            query += ' LIMIT ? OFFSET ?'
+            args.extend([int(limit), int(offset)])
+        elif offset:
+            query += ' LIMIT -1 OFFSET ?'
+            args.append(int(offset))
+        cur = self.conn.execute(query, args)
+        return [(jid, self.serial.loads(str(load))) for jid, load in cur]
+
+    def add_wtag(self, jid, id_):
+        with self.conn as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO wtags (jid, id) VALUES (?, ?)',
+                (jid, id_))
+
+    def del_wtag(self, jid, id_):
+        with self.conn as conn:
+            conn.execute(
+                'DELETE FROM wtags WHERE jid = ? AND id = ?',
+                (jid, id_))
+
+    def has_wtag(self, jid):
+        cur = self.conn.execute('SELECT 1 FROM wtags WHERE jid = ?', (jid,))
+        return cur.fetchone() is not None
+
+    def clean_old_jobs(self):
+        cutoff = jid_cutoff(self.opts['keep_jobs'])
+        if os.path.isdir(self.legacy.job_dir):
+            # The jobs left by the local job cache are not in the database,
+            # they are expired the way the local job cache expires them
+            ret = self.legacy.clean_old_jobs()
+        else:
+            ret = {'jobs': 0, 'bytes': 0}
+        with self.conn as conn:
+            # The job ids are the primary keys, so both the sizing and the
+            # deletes only visit the expired rows
+            jobs, size = conn.execute(
+                    'SELECT COUNT(*), IFNULL(SUM(LENGTH(load)), 0) '
+                    'FROM jids WHERE jid < ?', (cutoff,)).fetchone()
+            if not jobs:
+                return ret
+            ret['jobs'] += jobs
+            ret['bytes'] += size + conn.execute(
+                    'SELECT IFNULL(SUM(LENGTH(ret) + IFNULL(LENGTH(out), 0)), 0) '
+                    'FROM returns WHERE jid < ?', (cutoff,)).fetchone()[0]
+            conn.execute('DELETE FROM returns WHERE jid < ?', (cutoff,))
+            conn.execute('DELETE FROM wtags WHERE jid < ?', (cutoff,))
+            conn.execute('DELETE FROM jids WHERE jid < ?', (cutoff,))
+        # Hand the freed pages back to the filesystem
+        self.conn.execute('PRAGMA incremental_vacuum').fetchall()
+        return ret
@@ -6,19 +6,18 @@ involves preparing the three listeners and the workers needed by the master.
 # Import python modules
 import os
 import re
+import collections
 import time
-import shutil
+import random
 import logging
-import hashlib
-import tempfile
-import datetime
 import signal
 import multiprocessing
 import subprocess
+import traceback
+import sqlite3
 
 # Import zeromq
 import zmq
-from M2Crypto import RSA
 
 # Import Third Party Libs
 import yaml
@@ -27,13 +26,26 @@ import yaml
 import salt.crypt
 import salt.utils
 import salt.client
+import salt.fileserver
+import salt.jobcache
 import salt.payload
 import salt.pillar
 import salt.state
+import salt.utils.delta
+import salt.utils.event
+import salt.utils.minions
+import salt.utils.stats
 
 
 log = logging.getLogger(__name__)
 
+# The number of files a worker keeps open while serving them
+FILE_HANDLES = 32
+
+# How often the accepted minion keys are checked for changes to send out to
+# the cluster masters, in seconds
+CLUSTER_SYNC_INTERVAL = 10
+
 
 def clean_proc(proc, wait_for_kill=10):
     '''
@@ -119,40 +131,86 @@ class Master(SMaster):
         '''
         if self.opts['keep_jobs'] == 0:
             return
-        jid_root = os.path.join(self.opts['cachedir'], 'jobs')
+        job_cache = salt.jobcache.get_job_cache(self.opts)
+        total = {'jobs': 0, 'bytes': 0}
         while True:
-            cur = "{0:%Y%m%d%H}".format(datetime.datetime.now())
-
-            for top in os.listdir(jid_root):
-                t_path = os.path.join(jid_root, top)
-                for final in os.listdir(t_path):
-                    f_path = os.path.join(t_path, final)
-                    jid_file = os.path.join(f_path, 'jid')
-                    if not os.path.isfile(jid_file):
-                        continue
-                    with open(jid_file, 'r') as fn_:
-                        jid = fn_.read()
-                    if int(cur) - int(jid[:10]) > self.opts['keep_jobs']:
-                        shutil.rmtree(f_path)
+            try:
+                cleaned = job_cache.clean_old_jobs()
+            except Exception as exc:
+                log.error('Failed to clean old jobs: {0}'.format(exc))
+            else:
+                if cleaned['jobs']:
+                    total['jobs'] += cleaned['jobs']
+                    total['bytes'] += cleaned['bytes']
+                    log.info(
+                        ('Removed {0} old jobs, reclaiming {1} bytes, {2} '
+                         'jobs and {3} bytes since the master started').format(
+                             cleaned['jobs'],
+                             cleaned['bytes'],
+                             total['jobs'],
+                             total['bytes']))
             try:
                 time.sleep(60)
             except KeyboardInterrupt:
                 break
 
+    def _sync_cluster(self, clear_funcs):
+        '''
+        Send the keys out to the cluster masters when the accepted minion
+        keys change, the keys accepted between two checks are sent together
+        '''
+        minion_dir = os.path.join(self.opts['pki_dir'], 'minions')
+        last = None
+        while True:
+            try:
+                stamp = [os.stat(minion_dir).st_mtime]
+                for name in sorted(os.listdir(minion_dir)):
+                    stamp.append(
+                            os.stat(os.path.join(minion_dir, name)).st_mtime)
+                if stamp != last:
+                    clear_funcs._send_cluster()
+                    last = stamp
+            except Exception as exc:
+                log.error('Failed to send the cluster data: {0}'.format(exc))
+            try:
+                time.sleep(CLUSTER_SYNC_INTERVAL)
+            except KeyboardInterrupt:
+                break
+
     def start(self):
         '''
         Turn on the master server components
         '''
         log.warn('Starting the Salt Master')
+        salt.utils.stats.clear(self.opts)
+        salt.fileserver.clear(self.opts)
         clear_old_jobs_proc = multiprocessing.Process(
             target=self._clear_old_jobs)
         clear_old_jobs_proc.start()
-        aes_funcs = AESFuncs(self.opts, self.crypticle)
+        file_index_proc = None
+        if self.opts['file_index_interval']:
+            file_index_proc = multiprocessing.Process(
+                target=salt.fileserver.update_index,
+                args=(self.opts,))
+            file_index_proc.start()
+        event_pub = salt.utils.event.EventPublisher(self.opts)
+        event_pub.start()
+        # The workers share a single publish channel between the aes and
+        # clear functions
+        pub_channel = PubChannel(self.opts)
+        aes_funcs = AESFuncs(self.opts, self.crypticle, pub_channel)
         clear_funcs = ClearFuncs(
                 self.opts,
                 self.key,
                 self.master_key,
-                self.crypticle)
+                self.crypticle,
+                pub_channel)
+        sync_cluster_proc = None
+        if self.opts['cluster_masters']:
+            sync_cluster_proc = multiprocessing.Process(
+                target=self._sync_cluster,
+                args=(clear_funcs,))
+            sync_cluster_proc.start()
         reqserv = ReqServer(
                 self.opts,
                 self.crypticle,
@@ -172,6 +230,11 @@ class Master(SMaster):
             log.warn(('Caught signal {0}, stopping the Salt Master'
                 .format(signum)))
             clean_proc(clear_old_jobs_proc)
+            if file_index_proc:
+                clean_proc(file_index_proc)
+            if sync_cluster_proc:
+                clean_proc(sync_cluster_proc)
+            clean_proc(event_pub)
             clean_proc(reqserv.publisher)
             for proc in reqserv.work_procs:
                 clean_proc(proc)
@@ -187,6 +250,78 @@ class Master(SMaster):
             raise SystemExit('\nExiting on Ctrl-c')
 
 
+class PubChannel(object):
+    '''
+    The channel used by the master workers to hand publications to the
+    Publisher. The socket is connected once per process and kept open, so
+    publishing a job does not pay for a new context and connection
+    '''
+    def __init__(self, opts):
+        self.opts = opts
+        self.serial = salt.payload.Serial(opts)
+        self.pull_uri = 'ipc://{0}'.format(
+            os.path.join(self.opts['sock_dir'], 'publish_pull.ipc')
+            )
+        self.pid = None
+        self.context = None
+        self.pub_sock = None
+        # A master of masters has to send every job to its syndics
+        self.topics = bool(self.opts['publish_topics']) \
+                and not self.opts['order_masters']
+        self.ckminions = salt.utils.minions.CkMinions(self.opts)
+
+    def __prep_socket(self):
+        '''
+        ZeroMQ contexts can not be carried over a fork, the channel is made
+        before the master forks the workers, so the socket is connected
+        lazily by the process which uses it
+        '''
+        if self.pid == os.getpid():
+            return
+        self.context = zmq.Context(1)
+        self.pub_sock = self.context.socket(zmq.PUSH)
+        self.pub_sock.connect(self.pull_uri)
+        self.pid = os.getpid()
+
+    def targets(self, tgt, tgt_type='glob'):
+        '''
+        Return the ids of the minions a job should only be sent to, None is
+        returned when the job should be sent to every minion. Only the
+        targets which are matched on the minion id can be resolved by the
+        master, they are matched against the accepted keys the same way the
+        minions match them
+        '''
+        if not self.topics or tgt_type not in ('glob', 'pcre', 'list'):
+            return None
+        if tgt_type == 'list' and isinstance(tgt, basestring):
+            # The minions look for their id in the string
+            return None
+        ids = self.ckminions.ids()
+        minions = self.ckminions.check_minions(tgt, tgt_type)
+        if len(minions) * 2 > len(ids):
+            # Sending a copy to each minion only pays off for a few of them
+            return None
+        return minions
+
+    def send(self, payload, minions=None):
+        '''
+        Serialize the payload and send it to the Publisher. When publishing
+        under topics a job with a list of minions is only sent to them, a job
+        which matched no minions is not published at all
+        '''
+        self.__prep_socket()
+        package = self.serial.dumps(payload)
+        if not self.topics:
+            self.pub_sock.send(package)
+        elif minions is None:
+            self.pub_sock.send_multipart([salt.payload.topic(), package])
+        elif not minions:
+            log.debug('No minions matched, the job is not published')
+        else:
+            self.pub_sock.send_multipart(
+                    [salt.payload.topic(id_) for id_ in minions] + [package])
+
+
 class Publisher(multiprocessing.Process):
     '''
     The publishing interface, a simple zeromq publisher that sends out the
@@ -196,6 +331,17 @@ class Publisher(multiprocessing.Process):
         super(Publisher, self).__init__()
         self.opts = opts
 
+    def __forward(self, pub_sock, frames):
+        '''
+        Publish a package from the workers, a package sent under topics is
+        published once under each of them
+        '''
+        if len(frames) == 1:
+            pub_sock.send(frames[0])
+            return
+        for topic in frames[:-1]:
+            pub_sock.send_multipart([topic, frames[-1]])
+
     def run(self):
         '''
         Bind to the interface specified in the configuration file
@@ -213,8 +359,15 @@ class Publisher(multiprocessing.Process):
 
         try:
             while True:
-                package = pull_sock.recv()
-                pub_sock.send(package)
+                self.__forward(pub_sock, pull_sock.recv_multipart())
+                # When many publications arrive at once forward the whole
+                # backlog before going back to waiting on the socket
+                while True:
+                    try:
+                        frames = pull_sock.recv_multipart(zmq.NOBLOCK)
+                    except zmq.core.error.ZMQError:
+                        break
+                    self.__forward(pub_sock, frames)
         except KeyboardInterrupt:
             pub_sock.close()
             pull_sock.close()
@@ -224,9 +377,29 @@ class ReqServer(object):
     '''
     Starts up the master request server, minions send results to this
     interface.
+
+    The requests are handed out to the worker processes by a dispatcher
+    which only sends a request to a worker which is free. Cheap file server
+    requests have a lane of their own, so they do not queue up behind slow
+    commands such as pillar compiles, and the pool of general workers grows
+    when requests are kept waiting and shrinks again when it is idle. The
+    rate of minion sign ins is limited here, for all of the workers.
     '''
+    # The payload key used by the clients to ask for the file server lane
+    LANE_KEY = 'lane'
+    # Only small requests are inspected for a lane, the file server requests
+    # are all small while returns can be very large
+    LANE_PEEK_SIZE = 4096
+    # Seconds a request can wait before another worker is started
+    SCALE_UP_WAIT = 1
+    # Seconds a worker above the minimum can sit idle before it is stopped
+    SCALE_DOWN_IDLE = 60
+    # Seconds between writes of the dispatcher stats
+    STATS_INTERVAL = 10
+
     def __init__(self, opts, crypticle, key, mkey, aes_funcs, clear_funcs):
         self.opts = opts
+        self.serial = salt.payload.Serial(opts)
         self.aes_funcs = aes_funcs
         self.clear_funcs = clear_funcs
         self.master_key = mkey
@@ -234,13 +407,65 @@ class ReqServer(object):
         # Prepare the zeromq sockets
         self.uri = 'tcp://%(interface)s:%(ret_port)s' % self.opts
         self.clients = self.context.socket(zmq.ROUTER)
-        self.workers = self.context.socket(zmq.DEALER)
+        self.workers = self.context.socket(zmq.ROUTER)
         self.w_uri = 'ipc://{0}'.format(
             os.path.join(self.opts['sock_dir'], 'workers.ipc')
             )
         # Prepare the AES key
         self.key = key
         self.crypticle = crypticle
+        # The size of the worker pools
+        self.lane_size = {
+                'main': (
+                    int(self.opts['worker_threads']),
+                    max(int(self.opts['worker_threads']),
+                        int(self.opts['worker_threads_max'] or 0))),
+                'file': (
+                    int(self.opts['file_worker_threads']),
+                    int(self.opts['file_worker_threads'])),
+                }
+        self.work_procs = []
+        # The workers which have connected, keyed by identity
+        self.worker_info = {}
+        self.idle = {'main': collections.deque(), 'file': collections.deque()}
+        self.queue = {'main': collections.deque(), 'file': collections.deque()}
+        self.stats = {}
+        for lane in self.queue:
+            self.stats[lane] = {'requests': 0,
+                                'wait_total': 0.0,
+                                'wait_max': 0.0,
+                                'queue_depth': 0,
+                                'workers': 0,
+                                'busy': 0}
+        self.stats_path = os.path.join(
+                self.opts['cachedir'],
+                'stats',
+                'dispatcher.p')
+        # The state of the sign in admission control
+        self.auth_stamp = time.time()
+        self.auth_tokens = 0.0
+        self.auth_backlog = 0.0
+
+    def __start_worker(self, lane):
+        '''
+        Start a new worker process for the given lane
+        '''
+        proc = MWorker(self.opts,
+                self.master_key,
+                self.key,
+                self.crypticle,
+                self.aes_funcs,
+                self.clear_funcs,
+                lane)
+        proc.start()
+        log.info('Started Salt {0} worker process {1}'.format(lane, proc.pid))
+        self.work_procs.append(proc)
+
+    def __lane_procs(self, lane):
+        '''
+        Return the live worker processes which serve the given lane
+        '''
+        return [proc for proc in self.work_procs if proc.lane == lane]
 
     def __bind(self):
         '''
@@ -248,23 +473,211 @@ class ReqServer(object):
         '''
         log.info('Setting up the master communication server')
         self.clients.bind(self.uri)
-        self.work_procs = []
-
-        for ind in range(int(self.opts['worker_threads'])):
-            self.work_procs.append(MWorker(self.opts,
-                    self.master_key,
-                    self.key,
-                    self.crypticle,
-                    self.aes_funcs,
-                    self.clear_funcs))
+        self.workers.bind(self.w_uri)
 
-        for ind, proc in enumerate(self.work_procs):
-            log.info('Starting Salt worker process {0}'.format(ind))
-            proc.start()
+        for lane, size in self.lane_size.items():
+            for ind in range(size[0]):
+                self.__start_worker(lane)
 
-        self.workers.bind(self.w_uri)
+        self.__route()
 
-        zmq.device(zmq.QUEUE, self.clients, self.workers)
+    def __peek(self, package):
+        '''
+        Return the payload of a small request, an empty dict for a large or
+        malformed one
+        '''
+        if len(package) > self.LANE_PEEK_SIZE:
+            return {}
+        try:
+            payload = self.serial.loads(package)
+        except Exception:
+            return {}
+        if not isinstance(payload, dict):
+            return {}
+        return payload
+
+    def __get_lane(self, payload):
+        '''
+        Return the lane a request should be served in
+        '''
+        if payload.get(self.LANE_KEY) == 'file':
+            return 'file'
+        return 'main'
+
+    def __admit(self, payload):
+        '''
+        Admission control for sign ins, when the master restarts all of the
+        minions sign in at once. Returns 0 if the request can be served now,
+        or the number of seconds the minion should wait before signing in
+        again, spread over the time it takes to serve the minions turned away
+        '''
+        if not self.opts['auth_rate'] or payload.get('enc') != 'clear':
+            return 0
+        load = payload.get('load')
+        if not isinstance(load, dict) or load.get('cmd') != '_auth':
+            return 0
+        rate = float(self.opts['auth_rate'])
+        now = time.time()
+        elapsed = now - self.auth_stamp
+        self.auth_stamp = now
+        self.auth_tokens = min(max(rate, 1), self.auth_tokens + elapsed * rate)
+        self.auth_backlog = max(0, self.auth_backlog - elapsed * rate)
+        if self.auth_tokens >= 1:
+            self.auth_tokens -= 1
+            return 0
+        self.auth_backlog += 1
+        wait = round(1 + random.uniform(0, self.auth_backlog / rate), 1)
+        # Older minions wait for their acceptance_wait_time, as they do while
+        # their key is pending
+        log.info(
+            'Too many sign ins, asked {0} to wait {1} seconds'.format(
+                load.get('id'), wait))
+        return wait
+
+    def __route(self):
+        '''
+        Pass the client requests to free workers and the replies back to the
+        clients
+        '''
+        poller = zmq.Poller()
+        poller.register(self.clients, zmq.POLLIN)
+        poller.register(self.workers, zmq.POLLIN)
+        last_check = last_stats = time.time()
+        while True:
+            socks = dict(poller.poll(1000))
+            if socks.get(self.workers) == zmq.POLLIN:
+                self.__handle_worker(self.workers.recv_multipart())
+            if socks.get(self.clients) == zmq.POLLIN:
+                frames = self.clients.recv_multipart()
+                payload = self.__peek(frames[-1])
+                wait = self.__admit(payload)
+                if wait:
+                    self.clients.send_multipart(frames[:-1] + [
+                        self.serial.dumps(
+                            {'enc': 'clear',
+                             'load': {'ret': True, 'retry_after': wait}})])
+                else:
+                    lane = self.__get_lane(payload)
+                    self.queue[lane].append((time.time(), frames))
+            self.__dispatch()
+            now = time.time()
+            if now - last_check > 1:
+                self.__check_workers(now)
+                last_check = now
+            if now - last_stats > self.STATS_INTERVAL:
+                self.__write_stats()
+                last_stats = now
+
+    def __handle_worker(self, frames):
+        '''
+        Handle a message from a worker, either the worker announcing that it
+        is ready or the reply to a client request
+        '''
+        ident = frames[0]
+        body = frames[2:]
+        if body[0] == 'READY':
+            lane = body[1] if len(body) > 1 else 'main'
+            self.worker_info[ident] = {'lane': lane,
+                                       'since': time.time(),
+                                       'busy': False}
+            self.idle[lane].append(ident)
+            return
+        # Send the reply back to the client
+        self.clients.send_multipart(body)
+        info = self.worker_info.get(ident)
+        if info is None:
+            return
+        info['busy'] = False
+        info['since'] = time.time()
+        self.idle[info['lane']].append(ident)
+
+    def __dispatch(self):
+        '''
+        Hand the queued requests to the free workers, file server requests
+        are also served by free general workers
+        '''
+        now = time.time()
+        for lane, pools in (('file', ('file', 'main')), ('main', ('main',))):
+            queue = self.queue[lane]
+            while queue:
+                ident = None
+                for pool in pools:
+                    if self.idle[pool]:
+                        ident = self.idle[pool].popleft()
+                        break
+                if ident is None:
+                    break
+                start, frames = queue.popleft()
+                self.workers.send_multipart([ident, ''] + frames)
+                self.worker_info[ident]['busy'] = True
+                self.worker_info[ident]['since'] = now
+                wait = now - start
+                stats = self.stats[lane]
+                stats['requests'] += 1
+                stats['wait_total'] += wait
+                stats['wait_max'] = max(stats['wait_max'], wait)
+
+    def __check_workers(self, now):
+        '''
+        Replace dead workers and grow or shrink the pool of general workers
+        '''
+        for proc in list(self.work_procs):
+            if proc.is_alive():
+                continue
+            self.work_procs.remove(proc)
+            ident = str(proc.pid)
+            info = self.worker_info.pop(ident, None)
+            if info is None:
+                continue
+            if ident in self.idle[info['lane']]:
+                self.idle[info['lane']].remove(ident)
+            if info['busy']:
+                log.error(
+                    'Salt worker process {0} died while serving a '
+                    'request'.format(ident))
+        for lane, (min_size, max_size) in self.lane_size.items():
+            procs = self.__lane_procs(lane)
+            for ind in range(min_size - len(procs)):
+                self.__start_worker(lane)
+            queue = self.queue[lane]
+            if queue and now - queue[0][0] > self.SCALE_UP_WAIT \
+                    and len(procs) < max_size:
+                log.info(
+                    'Requests are waiting on the {0} workers, starting '
+                    'another worker'.format(lane))
+                self.__start_worker(lane)
+            elif len(procs) > min_size and self.idle[lane]:
+                ident = self.idle[lane][0]
+                if now - self.worker_info[ident]['since'] > self.SCALE_DOWN_IDLE:
+                    log.info('Stopping idle Salt worker process {0}'.format(
+                        ident))
+                    self.idle[lane].popleft()
+                    self.worker_info.pop(ident)
+                    self.workers.send_multipart([ident, '', 'STOP'])
+        # Collect the stopped workers
+        multiprocessing.active_children()
+
+    def __write_stats(self):
+        '''
+        Write out the dispatcher stats so that they can be read by the
+        manage runner
+        '''
+        for lane in self.queue:
+            stats = self.stats[lane]
+            stats['queue_depth'] = len(self.queue[lane])
+            stats['workers'] = len(self.__lane_procs(lane))
+            stats['busy'] = len([info for info in self.worker_info.values()
+                                  if info['lane'] == lane and info['busy']])
+        log.debug('Dispatcher stats: {0}'.format(self.stats))
+        try:
+            stats_dir = os.path.dirname(self.stats_path)
+            if not os.path.isdir(stats_dir):
+                os.makedirs(stats_dir)
+            tmp = self.stats_path + '.tmp'
+            self.serial.dump(self.stats, open(tmp, 'w+'))
+            os.rename(tmp, self.stats_path)
+        except (IOError, OSError) as exc:
+            log.error('Failed to write the dispatcher stats: {0}'.format(exc))
 
     def start_publisher(self):
         '''
@@ -292,34 +705,78 @@ class MWorker(multiprocessing.Process):
             key,
             crypticle,
             aes_funcs,
-            clear_funcs):
+            clear_funcs,
+            lane='main'):
         multiprocessing.Process.__init__(self)
         self.opts = opts
         self.serial = salt.payload.Serial(opts)
         self.crypticle = crypticle
         self.aes_funcs = aes_funcs
         self.clear_funcs = clear_funcs
+        self.lane = lane
+        # The command and the decryption time of the request being served
+        self.cmd = None
+        self.decrypt_time = 0.0
 
     def __bind(self):
         '''
         Bind to the local port
         '''
         context = zmq.Context(1)
-        socket = context.socket(zmq.REP)
+        socket = context.socket(zmq.REQ)
+        socket.setsockopt(zmq.IDENTITY, str(os.getpid()))
         w_uri = 'ipc://{0}'.format(
             os.path.join(self.opts['sock_dir'], 'workers.ipc')
             )
         log.info('Worker binding to socket {0}'.format(w_uri))
+        stats = salt.utils.stats.Stats(self.opts)
+        self.aes_funcs.stats = stats
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
         try:
             socket.connect(w_uri)
+            # Tell the dispatcher that this worker can take requests
+            socket.send_multipart(['READY', self.lane])
 
             while True:
-                package = socket.recv()
-                payload = self.serial.loads(package)
-                ret = self.serial.dumps(self._handle_payload(payload))
-                socket.send(ret)
+                if not poller.poll(salt.utils.stats.DUMP_INTERVAL * 1000):
+                    stats.maybe_dump()
+                    continue
+                frames = socket.recv_multipart()
+                if frames == ['STOP']:
+                    break
+                # The frames are the address of the client and the request
+                start = time.time()
+                self.cmd = None
+                self.decrypt_time = 0.0
+                error = False
+                try:
+                    payload = self.serial.loads(frames[-1])
+                    ret = self._handle_payload(payload)
+                except Exception:
+                    log.error(
+                        'Error serving request {0}: {1}'.format(
+                            self.cmd,
+                            traceback.format_exc()))
+                    ret = {}
+                    error = True
+                ser_start = time.time()
+                ret = self.serial.dumps(ret)
+                socket.send_multipart(frames[:-1] + [ret])
+                done = time.time()
+                stats.record(
+                        self.cmd or 'unknown',
+                        done - start,
+                        bytes_in=len(frames[-1]),
+                        bytes_out=len(ret),
+                        error=error,
+                        decrypt=self.decrypt_time,
+                        serialize=done - ser_start)
+                stats.maybe_dump()
         except KeyboardInterrupt:
-            socket.close()
+            pass
+        stats.dump()
+        socket.close()
 
     def _handle_payload(self, payload):
         '''
@@ -341,6 +798,7 @@ class MWorker(multiprocessing.Process):
         Take care of a cleartext command
         '''
         log.info('Clear payload received with command %(cmd)s', load)
+        self.cmd = load['cmd']
         return getattr(self.clear_funcs, load['cmd'])(load)
 
     def _handle_pub(self, load):
@@ -353,14 +811,18 @@ class MWorker(multiprocessing.Process):
         '''
         Handle a command sent via an aes key
         '''
+        start = time.time()
         try:
             data = self.crypticle.loads(load)
         except:
             return ''
+        finally:
+            self.decrypt_time = time.time() - start
         if 'cmd' not in data:
             log.error('Received malformed command {0}'.format(data))
             return {}
         log.info('AES payload received with command {0}'.format(data['cmd']))
+        self.cmd = data['cmd']
         return self.aes_funcs.run_func(data['cmd'], data)
 
     def run(self):
@@ -376,12 +838,30 @@ class AESFuncs(object):
     '''
     # The AES Functions:
     #
-    def __init__(self, opts, crypticle):
+    def __init__(self, opts, crypticle, pub_channel=None):
         self.opts = opts
         self.serial = salt.payload.Serial(opts)
         self.crypticle = crypticle
+        if pub_channel is None:
+            pub_channel = PubChannel(self.opts)
+        self.pub_channel = pub_channel
         # Make a client
         self.local = salt.client.LocalClient(self.opts['conf_file'])
+        # Create the event manager used to announce returns
+        self.event = salt.utils.event.MasterEvent(self.opts['sock_dir'])
+        self.job_cache = salt.jobcache.get_job_cache(self.opts)
+        # The file server index is kept up to date by the master, files which
+        # are not in it yet are looked up on disk
+        self.file_index = salt.fileserver.FileIndex(self.opts)
+        self.file_hashes = salt.fileserver.HashCache(self.opts)
+        # The open handles of the files being served, oldest first
+        self.file_handles = collections.OrderedDict()
+        self.compression = salt.crypt.compression(self.opts)
+        # The grains of the minions, grain targets are resolved against them
+        self.grains = salt.utils.minions.GrainsCache(self.opts)
+        # The request statistics of the worker serving these functions, set
+        # by the worker once it has started
+        self.stats = None
 
     def __find_file(self, path, env='base'):
         '''
@@ -391,6 +871,12 @@ class AESFuncs(object):
                'rel': ''}
         if env not in self.opts['file_roots']:
             return fnd
+        if self.file_index.load():
+            entry = self.file_index.find(path, env)
+            if entry:
+                fnd['path'] = entry['path']
+                fnd['rel'] = path
+                return fnd
         for root in self.opts['file_roots'][env]:
             full = os.path.join(root, path)
             if os.path.isfile(full):
@@ -405,13 +891,12 @@ class AESFuncs(object):
         The string needs to decrypt as 'salt' with the minion public key
         '''
         pub_path = os.path.join(self.opts['pki_dir'], 'minions', id_)
-        with open(pub_path, 'r') as fp_:
-            minion_pub = fp_.read()
-        tmp_pub = tempfile.mktemp()
-        with open(tmp_pub, 'w+') as fp_:
-            fp_.write(minion_pub)
-        pub = RSA.load_pub_key(tmp_pub)
-        os.remove(tmp_pub)
+        try:
+            pub = salt.crypt.load_pub_key(pub_path)
+        except (IOError, OSError):
+            log.error('The key of salt minion {0} has not been accepted'.format(
+                id_))
+            return False
         if pub.public_decrypt(token, 5) == 'salt':
             return True
         log.error('Salt minion claiming to be {0} has attempted to'
@@ -457,23 +942,190 @@ class AESFuncs(object):
         return ret
 
 
+    def __hash_file(self, path, env, full):
+        '''
+        Return the hash of a file found on the file server, the hash from the
+        file index is used when the file has not changed since it was indexed
+        '''
+        hsum = None
+        if self.file_index.load():
+            hsum = self.file_index.file_hash(path, env)
+        if hsum is None:
+            try:
+                hsum = self.file_hashes.get(full)
+            except (IOError, OSError):
+                return ''
+        return hsum
+
     def _serve_file(self, load):
         '''
-        Return a chunk from a file based on the data received
+        Return a chunk from a file based on the data received. The first
+        chunk carries the hash type of the file server, if the minion sends
+        the hash of its cached copy and it matches the file is not sent
         '''
         ret = {'data': '',
                'dest': ''}
         if 'path' not in load or 'loc' not in load or 'env' not in load:
             return ret
+        # Tell the minion which chunk this is, so that it can keep several
+        # chunks, of several files, in flight
+        ret['path'] = load['path']
+        ret['loc'] = load['loc']
         fnd = self.__find_file(load['path'], load['env'])
         if not fnd['path']:
             return ret
         ret['dest'] = fnd['rel']
-        with open(fnd['path'], 'rb') as fp_:
+        if load['loc'] == 0:
+            ret['hash_type'] = self.opts['hash_type']
+            if load.get('hsum') \
+                    and load.get('hash_type') == self.opts['hash_type']:
+                hsum = self.__hash_file(load['path'], load['env'], fnd['path'])
+                if hsum and hsum == load['hsum']:
+                    ret['unchanged'] = True
+                    if self.stats:
+                        self.stats.incr('file_unchanged')
+                        try:
+                            self.stats.incr(
+                                    'file_bytes_saved',
+                                    os.path.getsize(fnd['path']))
+                        except OSError:
+                            pass
+                    return ret
+        chunk_size = self.__chunk_size(load)
+        try:
+            fp_, size = self.__open_file(fnd['path'])
             fp_.seek(load['loc'])
-            ret['data'] = fp_.read(self.opts['file_buffer_size'])
+            ret['data'] = fp_.read(chunk_size)
+        except (IOError, OSError):
+            # The file was removed since the index was refreshed
+            ret['dest'] = ''
+            return ret
+        # Tell the minion how big the file is, so that it can request the
+        # rest of the file without waiting on each chunk
+        if load['loc'] == 0:
+            ret['size'] = size
+            ret['chunk_size'] = chunk_size
         return ret
 
+    def __chunk_size(self, load):
+        '''
+        Return the size of the file chunks to serve, the minion can ask for
+        smaller chunks than the file_buffer_size
+        '''
+        chunk_size = self.opts['file_buffer_size']
+        if load.get('chunk_size'):
+            chunk_size = max(1, min(int(load['chunk_size']), chunk_size))
+        return chunk_size
+
+    def _file_manifest(self, load):
+        '''
+        Return the hash and size of all of the files in an environment, or
+        of the files under a prefix, and the empty directories. The minion
+        works out which files it needs to download from a single request
+        '''
+        ret = {'files': {},
+               'emptydirs': [],
+               'hash_type': self.opts['hash_type'],
+               'chunk_size': self.__chunk_size(load)}
+        if 'env' not in load or load['env'] not in self.opts['file_roots']:
+            return ret
+        prefix = load.get('prefix', '')
+        for rel in self._file_list(load):
+            if not rel.startswith(prefix):
+                continue
+            fnd = self.__find_file(rel, load['env'])
+            if not fnd['path']:
+                continue
+            hsum = self.__hash_file(rel, load['env'], fnd['path'])
+            try:
+                size = os.path.getsize(fnd['path'])
+            except OSError:
+                continue
+            if hsum:
+                ret['files'][rel] = {'hsum': hsum, 'size': size}
+        for rel in self._file_list_emptydirs(load):
+            if rel.startswith(prefix):
+                ret['emptydirs'].append(rel)
+        return ret
+
+    def _file_delta(self, load):
+        '''
+        Return the operations which rebuild a file from the minion's old
+        copy of it, the minion sends the signatures of the blocks of its
+        copy. The data which was not found in the old copy is sent along
+        with the operations up to a chunk of it, the rest is left for the
+        minion to fetch with _serve_file. Only the hash is sent if the file
+        has not changed, and no operations are sent if the file has changed
+        too much for a delta to pay off
+        '''
+        if 'path' not in load or 'env' not in load \
+                or 'signatures' not in load or 'block_size' not in load:
+            return {}
+        fnd = self.__find_file(load['path'], load['env'])
+        if not fnd['path']:
+            return {}
+        ret = {'hsum': self.__hash_file(load['path'], load['env'], fnd['path']),
+               'hash_type': self.opts['hash_type']}
+        if not ret['hsum']:
+            return {}
+        try:
+            size = os.path.getsize(fnd['path'])
+        except OSError:
+            return {}
+        if ret['hsum'] == load.get('hsum') \
+                and load.get('hash_type') == self.opts['hash_type']:
+            ret['unchanged'] = True
+            if self.stats:
+                self.stats.incr('file_unchanged')
+                self.stats.incr('file_bytes_saved', size)
+            return ret
+        block = int(load['block_size'])
+        if block < salt.utils.delta.MIN_BLOCK:
+            return ret
+        chunk_size = self.__chunk_size(load)
+        try:
+            ops = salt.utils.delta.delta(
+                    fnd['path'],
+                    load['signatures'],
+                    block,
+                    min(size // 2, salt.utils.delta.MAX_LITERAL))
+            if ops is None:
+                return ret
+            ret['ops'] = salt.utils.delta.inline(fnd['path'], ops, chunk_size)
+        except (IOError, OSError, ValueError) as exc:
+            log.error('Failed to make a delta of {0}: {1}'.format(
+                fnd['path'], exc))
+            return ret
+        ret['size'] = size
+        ret['chunk_size'] = chunk_size
+        if self.stats:
+            self.stats.incr('file_delta')
+            self.stats.incr(
+                    'file_bytes_saved',
+                    size - sum(op_[1] for op_ in ops if isinstance(op_, list)))
+        return ret
+
+    def __open_file(self, path):
+        '''
+        Return an open handle and the size of a file being served, the
+        handles of the most recently served files are kept open across the
+        chunks of a transfer. A handle is reopened when the file is replaced
+        or modified
+        '''
+        stat = os.stat(path)
+        key = (stat.st_ino, stat.st_mtime, stat.st_size)
+        cached = self.file_handles.pop(path, None)
+        if cached and cached[1] == key:
+            fp_ = cached[0]
+        else:
+            if cached:
+                cached[0].close()
+            fp_ = open(path, 'rb')
+        self.file_handles[path] = (fp_, key)
+        while len(self.file_handles) > FILE_HANDLES:
+            self.file_handles.popitem(last=False)[1][0].close()
+        return fp_, stat.st_size
+
     def _file_hash(self, load):
         '''
         Return a file hash, the hash type is set in the master config file
@@ -483,12 +1135,11 @@ class AESFuncs(object):
         path = self.__find_file(load['path'], load['env'])['path']
         if not path:
             return {}
-        ret = {}
-        with open(path, 'rb') as fp_:
-            ret['hsum'] = getattr(hashlib, self.opts['hash_type'])(
-                    fp_.read()).hexdigest()
-        ret['hash_type'] = self.opts['hash_type']
-        return ret
+        hsum = self.__hash_file(load['path'], load['env'], path)
+        if not hsum:
+            return {}
+        return {'hsum': hsum,
+                'hash_type': self.opts['hash_type']}
 
     def _file_list(self, load):
         '''
@@ -498,6 +1149,10 @@ class AESFuncs(object):
         ret = []
         if load['env'] not in self.opts['file_roots']:
             return ret
+        if self.file_index.load():
+            indexed = self.file_index.file_list(load['env'])
+            if indexed is not None:
+                return indexed
         for path in self.opts['file_roots'][load['env']]:
             for root, dirs, files in os.walk(path, followlinks=True):
                 for fn in files:
@@ -519,6 +1174,10 @@ class AESFuncs(object):
         ret = []
         if load['env'] not in self.opts['file_roots']:
             return ret
+        if self.file_index.load():
+            indexed = self.file_index.file_list_emptydirs(load['env'])
+            if indexed is not None:
+                return indexed
         for path in self.opts['file_roots'][load['env']]:
             for root, dirs, files in os.walk(path, followlinks=True):
                 if len(dirs)==0 and len(files)==0:
@@ -531,12 +1190,33 @@ class AESFuncs(object):
         '''
         return self.opts
 
+    def __store_grains(self, load):
+        '''
+        Keep the grains sent by a minion
+        '''
+        try:
+            return self.grains.store(load['id'], load['grains'])
+        except sqlite3.Error as exc:
+            log.error('Failed to store the grains of {0}: {1}'.format(
+                load['id'], exc))
+            return False
+
+    def _grains(self, load):
+        '''
+        Receive the grains of a minion, the minions send them when they
+        change
+        '''
+        if 'id' not in load or 'grains' not in load:
+            return False
+        return self.__store_grains(load)
+
     def _pillar(self, load):
         '''
         Return the pillar data for the minion
         '''
         if 'id' not in load or 'grains' not in load or 'env' not in load:
             return False
+        self.__store_grains(load)
         pillar = salt.pillar.Pillar(
                 self.opts,
                 load['grains'],
@@ -559,40 +1239,48 @@ class AESFuncs(object):
 
     def _return(self, load):
         '''
-        Handle the return data sent from the minions
+        Handle the return data sent from the minions. A minion sends a return
+        again when the master is slow to reply, the job cache only saves the
+        first copy and only that one is announced
         '''
         # If the return data is invalid, just ignore it
         if 'return' not in load or 'jid' not in load or 'id' not in load:
             return False
         log.info('Got return from %(id)s for job %(jid)s', load)
-        jid_dir = salt.utils.jid_dir(
-                load['jid'],
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
-        if not os.path.isdir(jid_dir):
-            log.error(
-                'An inconsistency occurred, a job was received with a job id '
-                'that is not present on the master: %(jid)s', load
-            )
+        if not self.job_cache.save_return(load):
             return False
-        hn_dir = os.path.join(jid_dir, load['id'])
-        if not os.path.isdir(hn_dir):
-            os.makedirs(hn_dir)
-        # Otherwise the minion has already returned this jid and it should
-        # be dropped
-        else:
-            log.error(
-                    ('An extra return was detected from minion {0}, please'
-                    ' verify the minion, this could be a replay'
-                    ' attack').format(load['id'])
-                    )
+        self.__fire_return(load)
+        return True
+
+    def _return_batch(self, load):
+        '''
+        Handle a list of returns sent in a single message, the returns are
+        saved to the job cache together
+        '''
+        if not isinstance(load.get('returns'), list):
             return False
-        self.serial.dump(load['return'],
-                open(os.path.join(hn_dir, 'return.p'), 'w+'))
+        loads = []
+        for ret in load['returns']:
+            # If the return data is invalid, just ignore it
+            if not isinstance(ret, dict) or 'return' not in ret \
+                    or 'jid' not in ret or 'id' not in ret:
+                continue
+            log.info('Got return from %(id)s for job %(jid)s', ret)
+            loads.append(ret)
+        for ret in self.job_cache.save_returns(loads):
+            self.__fire_return(ret)
+        return True
+
+    def __fire_return(self, load):
+        '''
+        Let the clients waiting on a job know that a return is in
+        '''
+        event = {'jid': load['jid'],
+                 'id': load['id'],
+                 'return': load['return']}
         if 'out' in load:
-            self.serial.dump(load['out'],
-                    open(os.path.join(hn_dir, 'out.p'), 'w+'))
+            event['out'] = load['out']
+        self.event.fire_event(event, load['jid'])
 
     def _syndic_return(self, load):
         '''
@@ -603,22 +1291,15 @@ class AESFuncs(object):
         if 'return' not in load or 'jid' not in load or 'id' not in load:
             return None
         # set the write flag
-        jid_dir = salt.utils.jid_dir(
-                load['jid'],
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
-        if not os.path.isdir(jid_dir):
+        if not self.job_cache.jid_exists(load['jid']):
             log.error(
                 'An inconsistency occurred, a job was received with a job id '
                 'that is not present on the master: %(jid)s', load
             )
             return False
-        wtag = os.path.join(jid_dir, 'wtag_{0}'.format(load['id']))
         try:
-            with open(wtag, 'w+') as fp_:
-                fp_.write('')
-        except (IOError, OSError):
+            self.job_cache.add_wtag(load['jid'], load['id'])
+        except Exception:
             log.error(
                     ('Failed to commit the write tag for the syndic return,'
                     ' are permissions correct in the cache dir:'
@@ -626,14 +1307,14 @@ class AESFuncs(object):
                     )
             return False
 
-        # Format individual return loads
+        # Format individual return loads and save them together
+        returns = []
         for key, item in load['return'].items():
-            ret = {'jid': load['jid'],
-                   'id': key,
-                   'return': item}
-            self._return(ret)
-        if os.path.isfile(wtag):
-            os.remove(wtag)
+            returns.append({'jid': load['jid'],
+                            'id': key,
+                            'return': item})
+        self._return_batch({'returns': returns})
+        self.job_cache.del_wtag(load['jid'], load['id'])
 
     def minion_publish(self, clear_load):
         '''
@@ -702,10 +1383,7 @@ class AESFuncs(object):
         if not good:
             return {}
         # Set up the publication payload
-        jid = salt.utils.prep_jid(
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
+        jid = self.job_cache.prep_jid()
         load = {
                 'fun': clear_load['fun'],
                 'arg': clear_load['arg'],
@@ -715,18 +1393,7 @@ class AESFuncs(object):
                 'ret': clear_load['ret'],
                 'id': clear_load['id'],
                }
-        self.serial.dump(
-                load, open(
-                    os.path.join(
-                        salt.utils.jid_dir(
-                            jid,
-                            self.opts['cachedir'],
-                            self.opts['hash_type']
-                            ),
-                        '.load.p'
-                        ),
-                    'w+')
-                )
+        self.job_cache.save_load(jid, load)
         payload = {'enc': 'aes'}
         expr_form = 'glob'
         timeout = 5
@@ -744,16 +1411,13 @@ class AESFuncs(object):
             timeout = clear_load['timeout']
         # Encrypt!
         payload['load'] = self.crypticle.dumps(load)
-        # Connect to the publisher
-        context = zmq.Context(1)
-        pub_sock = context.socket(zmq.PUSH)
-        pull_uri = 'ipc://{0}'.format(
-            os.path.join(self.opts['sock_dir'], 'publish_pull.ipc')
-            )
-        pub_sock.connect(pull_uri)
+        # Subscribe to the returns before they can be sent
+        self.local.event.subscribe(jid)
         log.info(('Publishing minion job: #{0[jid]}, func: "{0[fun]}", args:'
                   ' "{0[arg]}", target: "{0[tgt]}"').format(load))
-        pub_sock.send(self.serial.dumps(payload))
+        self.pub_channel.send(
+                payload,
+                self.pub_channel.targets(load['tgt'], load['tgt_type']))
         # Run the client get_returns method based on the form data sent
         if 'form' in clear_load:
             ret_form = clear_load['form']
@@ -794,12 +1458,15 @@ class AESFuncs(object):
             log.error(('Received function {0} which in unavailable on the '
                        'master, returning False').format(exc))
             return self.crypticle.dumps(False)
-        # Don't encrypt the return value for the _return func
+        # Don't encrypt the return value for the _return funcs
         # (we don't care about the return value, so why encrypt it?)
-        if func == '_return':
+        if func in ('_return', '_return_batch'):
             return ret
-        # AES Encrypt the return
-        return self.crypticle.dumps(ret)
+        # AES Encrypt the return, compressing it if the minion asked for a
+        # compressed reply
+        compress = bool(self.compression) \
+                and load.get('compress') == self.compression
+        return self.crypticle.dumps(ret, compress=compress)
 
 
 class ClearFuncs(object):
@@ -811,14 +1478,55 @@ class ClearFuncs(object):
     # the clear:
     # publish (The publish from the LocalClient)
     # _auth
-    def __init__(self, opts, key, master_key, crypticle):
+    def __init__(self, opts, key, master_key, crypticle, pub_channel=None):
         self.opts = opts
         self.serial = salt.payload.Serial(opts)
         self.key = key
         self.master_key = master_key
         self.crypticle = crypticle
+        if pub_channel is None:
+            pub_channel = PubChannel(self.opts)
+        self.pub_channel = pub_channel
         # Make a client
         self.local = salt.client.LocalClient(self.opts['conf_file'])
+        self.job_cache = salt.jobcache.get_job_cache(self.opts)
+        self.compression = salt.crypt.compression(self.opts)
+        # The accepted keys which were checked, by path, with the stat they
+        # were checked against
+        self.accepted = {}
+        # The aes key encrypted with the public keys of the minions, by the
+        # path of the key, with the key it was encrypted with
+        self.aes_blobs = {}
+
+    def __same_key(self, pubfn, pub):
+        '''
+        Return True if the key stored at pubfn is the given public key, the
+        file is only read again when it has changed
+        '''
+        try:
+            stat = os.stat(pubfn)
+        except OSError:
+            return False
+        stamp = (stat.st_mtime, stat.st_size, stat.st_ino)
+        if self.accepted.get(pubfn) == (stamp, pub):
+            return True
+        with open(pubfn, 'r') as fp_:
+            if fp_.read() != pub:
+                return False
+        self.accepted[pubfn] = (stamp, pub)
+        return True
+
+    def __aes_blob(self, pubfn, pub):
+        '''
+        Return the aes key encrypted with the public key of a minion, it is
+        only encrypted again when the minion's key changes
+        '''
+        blob = self.aes_blobs.get(pubfn)
+        if blob is None or blob[0] != pub:
+            key = salt.crypt.load_pub_key(pubfn)
+            blob = (pub, key.public_encrypt(self.opts['aes'], 4))
+            self.aes_blobs[pubfn] = blob
+        return blob[1]
 
     def _send_cluster(self):
         '''
@@ -879,7 +1587,7 @@ class ClearFuncs(object):
             pass
         elif os.path.isfile(pubfn):
             # The key has been accepted check it
-            if not open(pubfn, 'r').read() == load['pub']:
+            if not self.__same_key(pubfn, load['pub']):
                 log.error(
                     'Authentication attempt from %(id)s failed, the public '
                     'keys did not match. This may be an attempt to compromise '
@@ -934,17 +1642,21 @@ class ClearFuncs(object):
                     'load': {'ret': False}}
 
         log.info('Authentication accepted from %(id)s', load)
-        with open(pubfn, 'w+') as fp_:
-            fp_.write(load['pub'])
-        key = RSA.load_pub_key(pubfn)
+        if not self.__same_key(pubfn, load['pub']):
+            with open(pubfn, 'w+') as fp_:
+                fp_.write(load['pub'])
         ret = {'enc': 'pub',
                'pub_key': self.master_key.pub_str,
                'token': self.master_key.token,
                'publish_port': self.opts['publish_port'],
               }
-        ret['aes'] = key.public_encrypt(self.opts['aes'], 4)
-        if self.opts['cluster_masters']:
-            self._send_cluster()
+        if self.compression:
+            # Let the minion know it can send compressed messages
+            ret['compression'] = [self.compression]
+        if self.pub_channel.topics:
+            # Jobs are published under topics the minion has to subscribe to
+            ret['publish_topics'] = True
+        ret['aes'] = self.__aes_blob(pubfn, load['pub'])
         return ret
 
     def publish(self, clear_load):
@@ -955,19 +1667,8 @@ class ClearFuncs(object):
         # Verify that the caller has root on master
         if not clear_load.pop('key') == self.key:
             return ''
-        jid_dir = salt.utils.jid_dir(
-                clear_load['jid'],
-                self.opts['cachedir'],
-                self.opts['hash_type']
-                )
-        # Verify the jid dir
-        if not os.path.isdir(jid_dir):
-            os.makedirs(jid_dir)
         # Save the invocation information
-        self.serial.dump(
-                clear_load,
-                open(os.path.join(jid_dir, '.load.p'), 'w+')
-                )
+        self.job_cache.save_load(clear_load['jid'], clear_load)
         # Set up the payload
         payload = {'enc': 'aes'}
         # Altering the contents of the publish load is serious!! Changes here
@@ -1002,12 +1703,9 @@ class ClearFuncs(object):
 
         payload['load'] = self.crypticle.dumps(load)
         # Send 0MQ to the publisher
-        context = zmq.Context(1)
-        pub_sock = context.socket(zmq.PUSH)
-        pull_uri = 'ipc://{0}'.format(
-            os.path.join(self.opts['sock_dir'], 'publish_pull.ipc')
-            )
-        pub_sock.connect(pull_uri)
-        pub_sock.send(self.serial.dumps(payload))
+        self.pub_channel.send(
+                payload,
+                self.pub_channel.targets(
+                    load['tgt'], load.get('tgt_type', 'glob')))
         return {'enc': 'clear',
                 'load': {'jid': clear_load['jid']}}
@@ -8,6 +8,7 @@ import logging
 import multiprocessing
 
 import fnmatch
+import hashlib
 import os
 import re
 import threading
@@ -20,7 +21,7 @@ import zmq
 # Import salt libs
 from salt.exceptions import AuthenticationError, MinionError, \
     CommandExecutionError, CommandNotFoundError, SaltInvocationError, \
-    SaltClientError
+    SaltClientError, SaltReqTimeoutError
 import salt.client
 import salt.crypt
 import salt.loader
@@ -127,6 +128,19 @@ class Minion(object):
         self.functions, self.returners = self.__load_modules()
         self.matcher = Matcher(self.opts, self.functions)
         self.proc_dir = get_proc_dir(opts['cachedir'])
+        # The returns are sent over a connection which is kept open
+        self.ret_channel = salt.payload.SREQ(
+                self.opts['master_uri'],
+                timeout=self.opts['return_timeout'],
+                serial=self.opts.get('serial', 'msgpack'))
+        # Job processes hand their returns to the main minion process, which
+        # sends them over its return channel
+        self.ret_pull_uri = 'ipc://{0}'.format(
+                os.path.join(self.opts['cachedir'], 'minion_returns.ipc'))
+        self.ret_forward = False
+        self.__main_pid = os.getpid()
+        self.__ret_push = None
+        self.__ret_lock = threading.Lock()
         if hasattr(self,'_syndic') and self._syndic:
             log.warn('Starting the Salt Syndic Minion')
         else:
@@ -138,6 +152,8 @@ class Minion(object):
             opts['id'],
             opts['environment'],
             ).compile_pillar()
+        # The master keeps the grains sent with the pillar request
+        self.grains_hash = self.__grains_hash()
 
     def __prep_mod_opts(self):
         '''
@@ -160,6 +176,27 @@ class Minion(object):
         returners = salt.loader.returners(self.opts)
         return functions, returners
 
+    def __grains_hash(self):
+        '''
+        Return the hash of the grains, the master keeps them to resolve grain
+        targets and is sent them again when they change
+        '''
+        return hashlib.md5(
+                repr(sorted(self.opts['grains'].items()))).hexdigest()
+
+    def _report_grains(self):
+        '''
+        Send the grains to the master if they have changed since they were
+        last sent
+        '''
+        hsum = self.__grains_hash()
+        if hsum == self.grains_hash:
+            return
+        self._push_return({'cmd': '_grains',
+                           'id': self.opts['id'],
+                           'grains': self.opts['grains']})
+        self.grains_hash = hsum
+
     def _handle_payload(self, payload):
         '''
         Takes a payload from the master publisher and does whatever the
@@ -366,10 +403,6 @@ class Minion(object):
             if os.path.isfile(fn_):
                 os.remove(fn_)
         log.info('Returning information for job: {0}'.format(ret['jid']))
-        context = zmq.Context()
-        socket = context.socket(zmq.REQ)
-        socket.connect(self.opts['master_uri'])
-        payload = {'enc': 'aes'}
         if ret_cmd == '_syndic_return':
             load = {'cmd': ret_cmd,
                     'jid': ret['jid'],
@@ -389,19 +422,12 @@ class Minion(object):
                 oput = self.functions[ret['fun']].__outputter__
                 if isinstance(oput, basestring):
                     load['out'] = oput
-        except KeyError:
+        except (KeyError, TypeError):
             pass
-        payload['load'] = self.crypticle.dumps(load)
-        data = self.serial.dumps(payload)
-        socket.send(data)
-        ret_val = self.serial.loads(socket.recv())
-        if isinstance(ret_val, basestring) and not ret_val:
-            # The master AES key has changed, reauth
-            self.authenticate()
-            payload['load'] = self.crypticle.dumps(load)
-            data = self.serial.dumps(payload)
-            socket.send(data)
-            ret_val = self.serial.loads(socket.recv())
+        if self.ret_forward:
+            ret_val = self._push_return(load)
+        else:
+            ret_val = self._send_return(load)
         if self.opts['cache_jobs']:
             # Local job cache has been enabled
             fn_ = os.path.join(
@@ -415,6 +441,94 @@ class Minion(object):
             open(fn_, 'w+').write(self.serial.dumps(ret))
         return ret_val
 
+    def _send_return(self, load):
+        '''
+        Send a return load to the master over the return channel
+        '''
+        ret_val = self.ret_channel.send('aes', self.crypticle.dumps(load))
+        if isinstance(ret_val, basestring) and not ret_val:
+            # The master AES key has changed, reauth
+            self.authenticate()
+            ret_val = self.ret_channel.send('aes', self.crypticle.dumps(load))
+        return ret_val
+
+    def _push_return(self, load):
+        '''
+        Hand a return load to the main minion process to be sent on
+        '''
+        if os.getpid() != self.__main_pid:
+            # This is a job process which exits once the return is handed
+            # over, so the socket is flushed and closed right away
+            context = zmq.Context()
+            socket = context.socket(zmq.PUSH)
+            socket.linger = self.opts['return_timeout'] * 1000
+            socket.connect(self.ret_pull_uri)
+            socket.send(self.serial.dumps(load))
+            socket.close()
+            context.term()
+            return True
+        with self.__ret_lock:
+            if self.__ret_push is None:
+                self.__ret_push = zmq.Context().socket(zmq.PUSH)
+                self.__ret_push.connect(self.ret_pull_uri)
+            self.__ret_push.send(self.serial.dumps(load))
+        return True
+
+    def _forward_returns(self, pull_sock):
+        '''
+        Send the returns handed over by the jobs to the master. When the
+        return_batch option is set the returns which queue up while a send
+        is in flight are coalesced into a single message
+        '''
+        while True:
+            loads = [self.serial.loads(pull_sock.recv())]
+            while len(loads) < self.opts['return_batch']:
+                try:
+                    loads.append(self.serial.loads(pull_sock.recv(zmq.NOBLOCK)))
+                except zmq.core.error.ZMQError:
+                    break
+            batch = []
+            for load in loads:
+                if load['cmd'] == '_return':
+                    batch.append(load)
+                    continue
+                self.__forward(load)
+            if len(batch) > 1:
+                self.__forward({'cmd': '_return_batch',
+                                'id': self.opts['id'],
+                                'returns': batch})
+            elif batch:
+                self.__forward(batch[0])
+
+    def __forward(self, load):
+        '''
+        Send a load on to the master, a failure is logged and the load is
+        dropped so that the jobs behind it are not held up
+        '''
+        try:
+            self._send_return(load)
+        except SaltReqTimeoutError as exc:
+            log.error('Failed to send a return to the master: {0}'.format(exc))
+        except Exception:
+            log.error(
+                'Failed to send a return to the master: {0}'.format(
+                    traceback.format_exc()))
+
+    def start_return_forwarder(self):
+        '''
+        Bind the socket the job returns are handed over on and start the
+        thread which sends them to the master
+        '''
+        context = zmq.Context()
+        pull_sock = context.socket(zmq.PULL)
+        pull_sock.bind(self.ret_pull_uri)
+        thread = threading.Thread(
+                target=self._forward_returns,
+                args=(pull_sock,))
+        thread.daemon = True
+        thread.start()
+        self.ret_forward = True
+
     @property
     def master_pub(self):
         return 'tcp://{ip}:{port}'.format(ip=self.opts['master_ip'],
@@ -434,11 +548,21 @@ class Minion(object):
             if creds != 'retry':
                 log.info('Authentication with master successful!')
                 break
+            if auth.retry_after:
+                time.sleep(auth.retry_after)
+                continue
             log.info('Waiting for minion key to be accepted by the master.')
             time.sleep(self.opts['acceptance_wait_time'])
         self.aes = creds['aes']
         self.publish_port = creds['publish_port']
-        self.crypticle = salt.crypt.Crypticle(self.opts, self.aes)
+        self.publish_topics = creds['publish_topics']
+        self.crypticle = salt.crypt.Crypticle(
+                self.opts,
+                self.aes,
+                compress=creds['compress'])
+        # The file client, the pillar and the jobs use this session rather
+        # than signing in again
+        salt.crypt.set_session(self.opts, self.crypticle)
 
     def passive_refresh(self):
         '''
@@ -461,21 +585,43 @@ class Minion(object):
             except OSError:
                 pass
             self.functions, self.returners = self.__load_modules()
+            self._report_grains()
+
+    def __sub_socket(self, context):
+        '''
+        Return a socket connected to the master publisher. When the master
+        publishes under topics only the publications for every minion and
+        for this minion are subscribed to, a syndic passes every publication
+        on so it subscribes to all of them
+        '''
+        socket = context.socket(zmq.SUB)
+        if self.publish_topics and not getattr(self, '_syndic', False):
+            # Publications without a topic start with the first byte of a
+            # serialized payload, they still arrive if the master stops
+            # publishing under topics
+            for topic in (salt.payload.topic(),
+                          salt.payload.topic(self.opts['id']),
+                          self.serial.dumps({'enc': '', 'load': ''})[:1]):
+                socket.setsockopt(zmq.SUBSCRIBE, topic)
+        else:
+            socket.setsockopt(zmq.SUBSCRIBE, '')
+        socket.connect(self.master_pub)
+        return socket
 
     def tune_in(self):
         '''
         Lock onto the publisher. This is the main event loop for the minion
         '''
+        self.start_return_forwarder()
         context = zmq.Context()
-        socket = context.socket(zmq.SUB)
-        socket.setsockopt(zmq.SUBSCRIBE, '')
-        socket.connect(self.master_pub)
+        socket = self.__sub_socket(context)
         if self.opts['sub_timeout']:
             last = time.time()
             while True:
                 payload = None
                 try:
-                    payload = self.serial.loads(socket.recv(1))
+                    # The payload is the last frame, after the topic
+                    payload = self.serial.loads(socket.recv_multipart(1)[-1])
                     self._handle_payload(payload)
                     last = time.time()
                 except:
@@ -492,9 +638,7 @@ class Minion(object):
                             # Failed to update the dns, keep the old addr
                             pass
                     socket.close()
-                    socket = context.socket(zmq.SUB)
-                    socket.setsockopt(zmq.SUBSCRIBE, '')
-                    socket.connect(self.master_pub)
+                    socket = self.__sub_socket(context)
                     last = time.time()
                 time.sleep(0.05)
                 multiprocessing.active_children()
@@ -503,7 +647,7 @@ class Minion(object):
             while True:
                 payload = None
                 try:
-                    payload = self.serial(socket.recv(1))
+                    payload = self.serial.loads(socket.recv_multipart(1)[-1])
                     self._handle_payload(payload)
                 except:
                     pass
@@ -6,7 +6,6 @@ import zmq
 import ast
 
 import salt.crypt
-import salt.payload
 
 def _get_socket():
     '''
@@ -42,7 +41,6 @@ def _publish(
 
         salt system.example.com publish.publish '*' cmd.run 'ls -la /tmp'
     '''
-    serial = salt.payload.Serial(__opts__)
     if fun == 'publish.publish':
         # Need to log something here
         return {}
@@ -70,10 +68,7 @@ def _publish(
             'tmo': timeout,
             'form': form,
             'id': __opts__['id']}
-    payload['load'] = auth.crypticle.dumps(load)
-    socket = _get_socket()
-    socket.send(serial.dumps(payload))
-    return auth.crypticle.loads(serial.loads(socket.recv()))
+    return auth.request(_get_socket(), payload, load)
 
 def publish(tgt, fun, arg=None, expr_form='glob', returner='', timeout=5):
     '''
@@ -4,8 +4,16 @@ encrypted keys to general payload dynamics and packaging, these happen
 in here
 '''
 
+import os
+import threading
 import cPickle as pickle
 
+# Import zeromq
+import zmq
+
+# Import salt libs
+from salt.exceptions import SaltReqTimeoutError
+
 try:
     # Attempt to import msgpack
     import msgpack
@@ -41,6 +49,16 @@ def format_payload(enc, **kwargs):
     payload['load'] = load
     return package(payload)
 
+
+def topic(id_=''):
+    '''
+    Return the topic a publication for a minion is sent under, publications
+    for every minion are sent under the topic of the empty id. The topic is
+    terminated so that the topic of one id is never a prefix of another
+    '''
+    return '{0}\0'.format(id_)
+
+
 class Serial(object):
     '''
     Create a serialization object, this object manages all message
@@ -85,3 +103,66 @@ class Serial(object):
         '''
         fn_.write(self.dumps(msg))
         fn_.close()
+
+
+class SREQ(object):
+    '''
+    Create a generic interface to wrap salt zeromq req calls. The connection
+    is made once and reused for every request, requests from multiple
+    threads are serialized on the socket
+    '''
+    def __init__(self, master, tries=3, timeout=60, serial='msgpack'):
+        self.master = master
+        self.tries = tries
+        self.timeout = timeout
+        self.serial = Serial({'serial': serial})
+        self.lock = threading.Lock()
+        self.pid = None
+        self.context = None
+        self.socket = None
+        self.poller = None
+
+    def __prep_socket(self):
+        '''
+        Connect the socket, zeromq contexts can not be carried over a fork so
+        a forked process makes a connection of its own
+        '''
+        if self.pid != os.getpid():
+            self.context = zmq.Context()
+            self.poller = zmq.Poller()
+            self.socket = None
+            self.pid = os.getpid()
+        if self.socket is None:
+            self.socket = self.context.socket(zmq.REQ)
+            self.socket.linger = 0
+            self.socket.connect(self.master)
+            self.poller.register(self.socket, zmq.POLLIN)
+
+    def __reset_socket(self):
+        '''
+        A REQ socket which did not get a reply can not send again, throw it
+        away so that the next request makes a fresh connection
+        '''
+        self.poller.unregister(self.socket)
+        self.socket.close()
+        self.socket = None
+
+    def send(self, enc, load, tries=None, timeout=None):
+        '''
+        Send a load to the master and return the reply, the request is sent
+        again on a fresh connection if the master does not answer within the
+        timeout
+        '''
+        tries = self.tries if tries is None else tries
+        timeout = self.timeout if timeout is None else timeout
+        payload = self.serial.dumps({'enc': enc, 'load': load})
+        with self.lock:
+            for _ in xrange(tries):
+                self.__prep_socket()
+                self.socket.send(payload)
+                if self.poller.poll(timeout * 1000):
+                    return self.serial.loads(self.socket.recv())
+                self.__reset_socket()
+        raise SaltReqTimeoutError(
+                'The master at {0} did not respond after {1} tries'.format(
+                    self.master, tries))
@@ -100,9 +100,10 @@ class RemotePillar(object):
                 'grains': self.grains,
                 'env': self.opts['environment'],
                 'cmd': '_pillar'}
-        payload['load'] = self.auth.crypticle.dumps(load)
-        self.socket.send(self.serial.dumps(payload))
-        return self.auth.crypticle.loads(self.serial.loads(self.socket.recv()))
+        if self.auth.crypticle.compress:
+            # Ask the master to compress the pillar data
+            load['compress'] = self.opts['compression']
+        return self.auth.request(self.socket, payload, load)
 
 
 class Pillar(object):
@@ -3,6 +3,7 @@ Execute salt convenience routines
 '''
 
 import sys
+import inspect
 
 # Import salt modules
 import salt.loader
@@ -47,4 +48,25 @@ class Runner(object):
             self._print_docs()
         else:
             self._verify_fun()
-            self.functions[self.opts['fun']](*self.opts['arg'])
+            args, kwargs = self._parse_args()
+            self.functions[self.opts['fun']](*args, **kwargs)
+
+    def _parse_args(self):
+        '''
+        Split the passed arguments into positional and keyword arguments,
+        an argument of the form key=value is passed as a keyword if the
+        runner function accepts an argument called key
+        '''
+        args = []
+        kwargs = {}
+        try:
+            argspec = inspect.getargspec(self.functions[self.opts['fun']])
+        except TypeError:
+            return self.opts['arg'], kwargs
+        for arg in self.opts['arg']:
+            key, sep, val = arg.partition('=')
+            if sep and key in argspec.args:
+                kwargs[key] = val
+            else:
+                args.append(arg)
+        return args, kwargs
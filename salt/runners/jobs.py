@@ -3,11 +3,11 @@ A conveniance system to manage jobs, both active and already run
 '''
 
 # Import Python Modules
-import os
+import collections
 
 # Import Salt Modules
 import salt.client
-import salt.payload
+import salt.jobcache
 import salt.utils
 from salt.exceptions import SaltException
 
@@ -20,7 +20,7 @@ def active():
     perspective
     '''
     ret = {}
-    job_dir = os.path.join(__opts__['cachedir'], 'jobs')
+    job_cache = salt.jobcache.get_job_cache(__opts__)
     client = salt.client.LocalClient(__opts__['conf_file'])
     active_ = client.cmd('*', 'saltutil.running', timeout=1)
     for minion, data in active_.items():
@@ -37,18 +37,8 @@ def active():
             else:
                 ret[job['jid']]['Running'].append({minion: job['pid']})
     for jid in ret:
-        jid_dir = salt.utils.jid_dir(
-                jid,
-                __opts__['cachedir'],
-                __opts__['hash_type']
-                )
-        if not os.path.isdir(jid_dir):
-            continue
-        for minion in os.listdir(jid_dir):
-            if minion.startswith('.'):
-                continue
-            if os.path.exists(os.path.join(jid_dir, minion)):
-                ret[jid]['Returned'].append(minion)
+        for minion in job_cache.get_returns(jid):
+            ret[jid]['Returned'].append(minion)
     print yaml.dump(ret)
 
 
@@ -56,28 +46,15 @@ def lookup_jid(jid):
     '''
     Return the printout from a previousely executed job
     '''
-
+    job_cache = salt.jobcache.get_job_cache(__opts__)
+    ret = {}
     out = None
+    for minion, data in job_cache.get_returns(jid).items():
+        ret[minion] = data['ret']
+        if 'out' in data:
+            out = data['out']
 
-    def _format_ret(full_ret):
-        '''
-        Take the full return data and format it to simple output
-        '''
-        ret = {}
-        for key, data in full_ret.items():
-            ret[key] = data['ret']
-            if 'out' in data:
-                out = data['out']
-            return ret, out
-
-    client = salt.client.LocalClient(__opts__['conf_file'])
-    full_ret = client.get_full_returns(jid, [], 0)
-    formatted = _format_ret(full_ret)
-
-    if formatted:
-        ret = formatted[0]
-        out = formatted[1]
-    else:
+    if not ret:
         ret = SaltException('Job {0} hasn\'t finished. No data yet :('.format(jid))
         out = ''
 
@@ -93,25 +70,68 @@ def lookup_jid(jid):
     printout(ret)
     return ret
 
-def list_jobs():
+
+def _format_job(jid, load):
     '''
-    List all detectable jobs and associated functions
+    Format a job load for printing
     '''
-    serial = salt.payload.Serial(__opts__)
-    ret = {}
-    job_dir = os.path.join(__opts__['cachedir'], 'jobs')
-    for top in os.listdir(job_dir):
-        t_path = os.path.join(job_dir, top)
-        for final in os.listdir(t_path):
-            loadpath = os.path.join(t_path, final, '.load.p')
-            if not os.path.isfile(loadpath):
-                continue
-            load = serial.load(open(loadpath, 'rb'))
-            jid = load['jid']
-            ret[jid] = {'Start Time': salt.utils.jid_to_time(jid),
-                        'Function': load['fun'],
-                        'Arguments': list(load['arg']),
-                        'Target': load['tgt'],
-                        'Target-type': load['tgt_type']}
-    print yaml.dump(ret)
+    return {'Start Time': salt.utils.jid_to_time(jid),
+            'Function': load['fun'],
+            'Arguments': list(load['arg']),
+            'Target': load['tgt'],
+            'Target-type': load.get('tgt_type', 'glob')}
+
+
+def _print_jobs(jobs):
+    '''
+    Print the jobs in their order, yaml would sort the job ids
+    '''
+    for jid, job in jobs.items():
+        print yaml.dump({jid: job}),
+
+
+def list_jobs(limit=None, page=1):
+    '''
+    List all detectable jobs and associated functions, pass a limit to list
+    the jobs a page at a time, newest first
+    '''
+    ret = collections.OrderedDict()
+    job_cache = salt.jobcache.get_job_cache(__opts__)
+    limit = int(limit) if limit else None
+    offset = (int(page) - 1) * limit if limit else 0
+    for jid, load in job_cache.find_jobs(limit=limit, offset=offset):
+        ret[jid] = _format_job(jid, load)
+    _print_jobs(ret)
+    return ret
+
+
+def find(fun=None,
+         tgt=None,
+         minion=None,
+         start=None,
+         end=None,
+         limit=50,
+         page=1):
+    '''
+    Find the jobs which ran a function, on a target, which were returned by a
+    minion and which were started in a time window. The start and end are
+    time stamps such as "2012-06-01 14:30", the jobs are listed newest first
+    a page of limit jobs at a time:
 
+        salt-run jobs.find fun=test.ping minion=web1 start=2012-06-01 page=2
+    '''
+    ret = collections.OrderedDict()
+    job_cache = salt.jobcache.get_job_cache(__opts__)
+    limit = int(limit) if limit else None
+    offset = (int(page) - 1) * limit if limit else 0
+    for jid, load in job_cache.find_jobs(
+            fun=fun,
+            tgt=tgt,
+            minion=minion,
+            start=start,
+            end=end,
+            limit=limit,
+            offset=offset):
+        ret[jid] = _format_job(jid, load)
+    _print_jobs(ret)
+    return ret
@@ -5,6 +5,10 @@ and what hosts are down
 
 import salt.cli.key
 import salt.client
+import salt.utils.stats
+
+# Import Third party libs
+import yaml
 
 
 def down():
@@ -29,3 +33,19 @@ def up():
 
     for minion in sorted(minions):
         print minion
+
+
+def stats(dump=None):
+    '''
+    Print the request statistics of the master workers, the number of
+    requests, errors, bytes in and out and the latency of each command, the
+    counters such as the file bytes which did not need to be sent and the
+    state of the worker queues. Pass a file name as dump to also write
+    the statistics to the file for offline analysis
+    '''
+    ret = salt.utils.stats.aggregate(__opts__)
+    if dump:
+        with open(dump, 'w+') as fp_:
+            fp_.write(yaml.dump(ret))
+    print yaml.dump(ret)
+    return ret
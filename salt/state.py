@@ -1016,7 +1016,9 @@ class State(object):
         # the low data chunks
         if errors:
             return errors
-        ret = self.format_verbosity(self.call_chunks(chunks))
+        # The hashes of the files the states look at are saved once
+        with salt.fileclient.hash_batch(self.opts):
+            ret = self.format_verbosity(self.call_chunks(chunks))
         return ret
 
     def call_template(self, template):
@@ -1565,6 +1567,4 @@ class RemoteHighState(object):
         load = {'grains': self.grains,
                 'opts': self.opts,
                 'cmd': '_master_state'}
-        payload['load'] = self.auth.crypticle.dumps(load)
-        self.socket.send(self.serial.dumps(payload))
-        return self.auth.crypticle.loads(self.serial.loads(self.socket.recv()))
+        return self.auth.request(self.socket, payload, load)
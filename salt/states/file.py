@@ -81,7 +81,6 @@ from contextlib import nested  # For < 2.7 compat
 import os
 import shutil
 import difflib
-import hashlib
 import imp
 import logging
 import tempfile
@@ -90,6 +89,8 @@ import urlparse
 import copy
 
 # Import Salt libs
+import salt.fileclient
+import salt.utils
 import salt.utils.templates
 
 logger = logging.getLogger(__name__)
@@ -137,6 +138,27 @@ def _is_bin(path):
         return '\0' in f.read(2048)
 
 
+def _diff(name, sfn):
+    '''
+    Return a diff of the changes replacing the file name with the file sfn
+    would make, equivalent to diff -u. Binary files and files larger than
+    the file_diff_max_size option are not diffed, so the files never have to
+    be read into memory in full
+    '''
+    max_size = __opts__['file_diff_max_size']
+    if _is_bin(sfn) or _is_bin(name):
+        return 'Replace binary file'
+    sizes = (os.path.getsize(name), os.path.getsize(sfn))
+    if max(sizes) > max_size:
+        return ('Replace file of {0} bytes with a file of {1} bytes, files '
+                'larger than {2} bytes are not diffed').format(
+                    sizes[0], sizes[1], max_size)
+    with nested(open(sfn, 'rb'), open(name, 'rb')) as (src, name_):
+        slines = src.readlines()
+        nlines = name_.readlines()
+    return ''.join(difflib.unified_diff(nlines, slines))
+
+
 def _gen_keep_files(name, require):
     '''
     Generate the list of files that need to be kept when a dir based function
@@ -519,11 +541,13 @@ def managed(name,
 
         if data['result']:
             sfn = data['data']
-            hsum = ''
-            with open(sfn, 'r') as source:
-                hsum = hashlib.md5(source.read()).hexdigest()
-            source_sum = {'hash_type': 'md5',
-                          'hsum': hsum}
+            if 'hsum' in data:
+                # The renderer hashed the output as it wrote it out
+                source_sum = {'hash_type': data['hash_type'],
+                              'hsum': data['hsum']}
+            else:
+                source_sum = {'hash_type': 'md5',
+                              'hsum': salt.utils.get_hash(sfn, 'md5')}
         else:
             __clean_tmp(sfn)
             return _error(ret, data['data'])
@@ -576,10 +600,11 @@ def managed(name,
     if os.path.isfile(name):
         # Only test the checksums on files with managed contents
         if source:
-            name_sum = ''
-            hash_func = getattr(hashlib, source_sum['hash_type'])
-            with open(name, 'rb') as namefile:
-                name_sum = hash_func(namefile.read()).hexdigest()
+            # The hash of the file is cached by its size, mtime and inode, a
+            # large file is only read again when it has changed
+            hashes = salt.fileclient.hash_cache(__opts__)
+            name_sum = hashes.get(name, form=source_sum['hash_type'])
+            salt.fileclient.save_hashes(__opts__)
 
         # Check if file needs to be replaced
         if source and source_sum['hsum'] != name_sum:
@@ -589,17 +614,7 @@ def managed(name,
                 return _error(
                     ret, 'Source file {0} not found'.format(source))
 
-            # Check to see if the files are bins
-            if _is_bin(sfn) or _is_bin(name):
-                ret['changes']['diff'] = 'Replace binary file'
-            else:
-                with nested(open(sfn, 'rb'), open(name, 'rb')) as (src, name_):
-                    slines = src.readlines()
-                    nlines = name_.readlines()
-                # Print a diff equivalent to diff -u old new
-                    ret['changes']['diff'] = (''.join(difflib
-                                                      .unified_diff(nlines,
-                                                                    slines)))
+            ret['changes']['diff'] = _diff(name, sfn)
             # Pre requisites are met, and the file needs to be replaced, do it
             if not __opts__['test']:
                 shutil.copyfile(sfn, name)
@@ -909,6 +924,8 @@ def recurse(name,
                 ret, 'The path {0} exists and is not a directory'.format(name))
         os.makedirs(name)
     vdir = set()
+    # The hashes are shared with the file client which caches the files
+    hashes = salt.fileclient.hash_cache(__opts__)
     for fn_ in __salt__['cp.cache_dir'](source, env):
         if not fn_.strip():
             continue
@@ -938,23 +955,31 @@ def recurse(name,
             if _ret['changes']:
                 ret['changes'][dest] = 'updated'
             keep.add(dest)
-            srch = ''
-            dsth = ''
-            # The file is present, if the sum differes replace it
-            with nested(open(fn_, 'r'), open(dest, 'r')) as (src_, dst_):
-                srch = hashlib.md5(src_.read()).hexdigest()
-                dsth = hashlib.md5(dst_.read()).hexdigest()
-            if srch != dsth:
-                # The downloaded file differes, replace!
-                # FIXME: no metadata (ownership, permissions) available
-                shutil.copyfile(fn_, dest)
-                ret['changes'][dest] = 'updated'
+            # The file is present, if the sum differs replace it. The hashes
+            # are cached by size, mtime and inode so files which have not
+            # changed since the last run are not read again, they are
+            # compared with the type the master sent the source hash in
+            src_stat = os.stat(fn_)
+            dst_stat = os.stat(dest)
+            form = hashes.cached_form(fn_, src_stat)
+            if src_stat.st_size == dst_stat.st_size \
+                    and hashes.get(fn_, src_stat, form) \
+                    == hashes.get(dest, dst_stat, form):
+                continue
+            # The downloaded file differs, replace!
+            # FIXME: no metadata (ownership, permissions) available
+            shutil.copyfile(fn_, dest)
+            hashes.set(dest, hashes.get(fn_, src_stat, form), form=form)
+            ret['changes'][dest] = 'updated'
         else:
             keep.add(dest)
             # The destination file is not present, make it
             # FIXME: no metadata (ownership, permissions) available
             shutil.copyfile(fn_, dest)
+            form = hashes.cached_form(fn_)
+            hashes.set(dest, hashes.get(fn_, form=form), form=form)
             ret['changes'][dest] = 'new'
+    salt.fileclient.save_hashes(__opts__)
     keep = list(keep)
     if clean:
         keep += _gen_keep_files(name, require)
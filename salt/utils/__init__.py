@@ -371,3 +371,14 @@ def check_or_die(command):
 
     if not __salt__['cmd.has_exec'](command):
         raise CommandNotFoundError(command)
+
+def get_hash(path, form='md5', chunk_size=65536):
+    '''
+    Return the hash of a file, the file is read a chunk at a time so that
+    large files are never held in memory
+    '''
+    hash_obj = getattr(hashlib, form)()
+    with open(path, 'rb') as ifile:
+        for chunk in iter(lambda: ifile.read(chunk_size), ''):
+            hash_obj.update(chunk)
+    return hash_obj.hexdigest()
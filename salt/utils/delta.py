@@ -0,0 +1,163 @@
+'''
+Work out the difference between two copies of a file, rsync style
+
+The side with the old copy of the file splits it into blocks and sends a
+signature of each block, a weak checksum which can be rolled along a file a
+byte at a time and a strong hash. The side with the new copy rolls the weak
+checksum over its copy, a block which matches both checksums does not need
+to be sent. The result is a list of operations which rebuild the new copy
+from the blocks of the old one and the data which was not found in it.
+
+The weak checksum is the adler32 checksum computed by zlib, so the blocks
+are only summed in python while rolling over data which has changed.
+'''
+
+# Import python libs
+import os
+import math
+import mmap
+import zlib
+import hashlib
+
+# The adler32 modulus
+MOD = 65521
+
+# The bounds of the size of the blocks
+MIN_BLOCK = 4096
+MAX_BLOCK = 131072
+
+# The most data a delta may carry, past this rolling over the file in python
+# costs more than sending all of it
+MAX_LITERAL = 1048576
+
+
+def block_size(size):
+    '''
+    Return the block size to use for a file of the given size, the square
+    root of the size keeps the signature and the data resent around each
+    change small
+    '''
+    block = int(math.sqrt(size)) // 1024 * 1024
+    return min(max(block, MIN_BLOCK), MAX_BLOCK)
+
+
+def _strong(data):
+    '''
+    Return the strong hash of a block
+    '''
+    return hashlib.md5(data).digest()
+
+
+def signature(path, block):
+    '''
+    Return the signatures of the blocks of a file, a list of the weak
+    checksum and the strong hash of each block
+    '''
+    ret = []
+    with open(path, 'rb') as fp_:
+        while True:
+            data = fp_.read(block)
+            if not data:
+                break
+            ret.append([zlib.adler32(data) & 0xffffffff, _strong(data)])
+    return ret
+
+
+def delta(path, signatures, block, max_literal=None):
+    '''
+    Return the operations which turn the file the signatures were made from
+    into the file at path. An operation is the index of a block of the old
+    file to copy, or the offset and length of data in the new file which was
+    not found in the old one. None is returned if more than max_literal
+    bytes of the new file would have to be sent
+    '''
+    if max_literal is None:
+        max_literal = MAX_LITERAL
+    blocks = {}
+    for index, (weak, strong) in enumerate(signatures):
+        blocks.setdefault(weak, {}).setdefault(strong, index)
+    size = os.path.getsize(path)
+    ops = []
+    if not size:
+        return ops
+    with open(path, 'rb') as fp_:
+        data = mmap.mmap(fp_.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        # The window over the new file is data[pos:pos + win], the data
+        # since lit has not been found in the old file
+        pos = lit = literal = 0
+        win = min(block, size)
+        adler = zlib.adler32(data[0:win]) & 0xffffffff
+        a_sum, b_sum = adler & 0xffff, adler >> 16
+        while win:
+            end = pos + win
+            found = blocks.get((b_sum << 16) | a_sum)
+            if found:
+                index = found.get(_strong(data[pos:end]))
+                if index is not None:
+                    if lit < pos:
+                        ops.append([lit, pos - lit])
+                        literal += pos - lit
+                    ops.append(index)
+                    pos = lit = end
+                    win = min(block, size - pos)
+                    adler = zlib.adler32(data[pos:pos + win]) & 0xffffffff
+                    a_sum, b_sum = adler & 0xffff, adler >> 16
+                    continue
+            if literal + end - lit > max_literal:
+                return None
+            out = ord(data[pos])
+            if end < size:
+                # Roll the window along a byte
+                a_sum = (a_sum - out + ord(data[end])) % MOD
+                b_sum = (b_sum - win * out + a_sum - 1) % MOD
+            else:
+                # Shrink the window at the end of the file, the last block
+                # of the old file may be short
+                a_sum = (a_sum - out) % MOD
+                b_sum = (b_sum - win * out - 1) % MOD
+                win -= 1
+            pos += 1
+        if lit < size:
+            ops.append([lit, size - lit])
+    finally:
+        data.close()
+    return ops
+
+
+def inline(path, ops, limit):
+    '''
+    Replace the ranges of the new file in the operations with the data in
+    them, until limit bytes have been inlined. Returns the new operations
+    '''
+    ret = []
+    with open(path, 'rb') as fp_:
+        for op_ in ops:
+            if isinstance(op_, list) and op_[1] <= limit:
+                fp_.seek(op_[0])
+                data = fp_.read(op_[1])
+                if len(data) != op_[1]:
+                    raise IOError('{0} changed while it was read'.format(path))
+                limit -= len(data)
+                ret.append(data)
+            else:
+                ret.append(op_)
+    return ret
+
+
+def patch(path, ops, block, fp_, fetch):
+    '''
+    Write the new file out to the open file fp_ from the old file at path
+    and the operations, fetch is called with the offset and length of each
+    range of the new file which was not inlined and returns its data
+    '''
+    with open(path, 'rb') as old:
+        for op_ in ops:
+            if isinstance(op_, basestring):
+                data = op_
+            elif isinstance(op_, list):
+                data = fetch(op_[0], op_[1])
+            else:
+                old.seek(op_ * block)
+                data = old.read(block)
+            fp_.write(data)
@@ -0,0 +1,193 @@
+'''
+Manage events
+
+Events are sent over a local ipc bus on the master. When a minion return is
+written to the job cache an event tagged with the job id is fired, so clients
+waiting on a job can collect the returns as they arrive instead of scanning
+the job cache.
+
+The bus is made of two sockets, a PULL socket that the master workers push
+events into and a PUB socket that clients subscribe to. Both are bound by the
+EventPublisher process, which runs alongside the other master processes.
+'''
+
+# Import python libs
+import os
+import logging
+import multiprocessing
+
+# Import zeromq
+import zmq
+
+# Import salt libs
+import salt.payload
+
+log = logging.getLogger(__name__)
+
+# The tag is framed in front of the serialized event data, the separator can
+# not show up in a jid or a minion id
+TAGEND = '\n\n'
+
+
+class SaltEvent(object):
+    '''
+    The base class used to manage salt events
+    '''
+    def __init__(self, sock_dir, node='master'):
+        self.serial = salt.payload.Serial({'serial': 'msgpack'})
+        self.pub_path = os.path.join(
+                sock_dir,
+                '{0}_event_pub.ipc'.format(node)
+                )
+        self.pull_path = os.path.join(
+                sock_dir,
+                '{0}_event_pull.ipc'.format(node)
+                )
+        self.puburi = 'ipc://{0}'.format(self.pub_path)
+        self.pulluri = 'ipc://{0}'.format(self.pull_path)
+        self.pid = None
+        self.context = None
+        self.poller = None
+        self.sub = None
+        self.push = None
+        self.tags = set()
+
+    def __prep_context(self):
+        '''
+        ZeroMQ contexts can not be carried over a fork, the event objects are
+        created before the master forks the workers, so the sockets are made
+        lazily by the process which uses them
+        '''
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.context = zmq.Context()
+        self.poller = zmq.Poller()
+        self.sub = None
+        self.push = None
+        self.tags = set()
+
+    def connect_pub(self):
+        '''
+        Establish the subscription connection to the event bus
+        '''
+        self.__prep_context()
+        if self.sub is None:
+            self.sub = self.context.socket(zmq.SUB)
+            self.sub.linger = 0
+            self.sub.connect(self.puburi)
+            self.poller.register(self.sub, zmq.POLLIN)
+
+    def connect_pull(self):
+        '''
+        Establish the connection used to fire events
+        '''
+        self.__prep_context()
+        if self.push is None:
+            self.push = self.context.socket(zmq.PUSH)
+            self.push.linger = 0
+            self.push.connect(self.pulluri)
+
+    def subscribe(self, tag):
+        '''
+        Subscribe to the events sent with the given tag, subscribe before the
+        event source is started to make sure no events are missed
+        '''
+        self.connect_pub()
+        if tag in self.tags:
+            return
+        self.sub.setsockopt(zmq.SUBSCRIBE, tag + TAGEND)
+        self.tags.add(tag)
+
+    def unsubscribe(self, tag):
+        '''
+        Stop receiving the events sent with the given tag
+        '''
+        if self.pid != os.getpid() or tag not in self.tags:
+            return
+        self.sub.setsockopt(zmq.UNSUBSCRIBE, tag + TAGEND)
+        self.tags.discard(tag)
+
+    def get_event(self, wait=5):
+        '''
+        Get a single event from the bus, wait is the number of seconds to
+        wait for an event to arrive. Returns a tuple of the tag and the event
+        data, or None if no event arrived in time
+        '''
+        self.connect_pub()
+        socks = dict(self.poller.poll(int(wait * 1000)))
+        if socks.get(self.sub) != zmq.POLLIN:
+            return None
+        raw = self.sub.recv()
+        tag, _, mdata = raw.partition(TAGEND)
+        try:
+            return tag, self.serial.loads(mdata)
+        except Exception:
+            log.error('Received malformed event with tag {0}'.format(tag))
+            return None
+
+    def fire_event(self, data, tag):
+        '''
+        Send an event out on the bus, if the bus is backed up the event is
+        dropped, the job cache is always the authoritative source of returns
+        '''
+        self.connect_pull()
+        try:
+            self.push.send(tag + TAGEND + self.serial.dumps(data), zmq.NOBLOCK)
+        except zmq.core.error.ZMQError:
+            log.debug('Unable to fire event with tag {0}'.format(tag))
+            return False
+        return True
+
+    def destroy(self):
+        '''
+        Close the sockets owned by this process
+        '''
+        if self.pid != os.getpid():
+            return
+        if self.sub is not None:
+            self.poller.unregister(self.sub)
+            self.sub.close()
+        if self.push is not None:
+            self.push.close()
+        self.context.term()
+        self.pid = None
+
+
+class MasterEvent(SaltEvent):
+    '''
+    Create a master event management object
+    '''
+    def __init__(self, sock_dir):
+        super(MasterEvent, self).__init__(sock_dir, 'master')
+
+
+class EventPublisher(multiprocessing.Process):
+    '''
+    The interface that takes the events fired by the master workers and
+    publishes them to the subscribed clients
+    '''
+    def __init__(self, opts):
+        super(EventPublisher, self).__init__()
+        self.opts = opts
+
+    def run(self):
+        '''
+        Bind the event sockets and start forwarding events
+        '''
+        event = MasterEvent(self.opts['sock_dir'])
+        context = zmq.Context(1)
+        epub_sock = context.socket(zmq.PUB)
+        epull_sock = context.socket(zmq.PULL)
+        log.info('Starting the Salt event publisher on {0}'.format(
+            event.puburi))
+        epub_sock.bind(event.puburi)
+        epull_sock.bind(event.pulluri)
+
+        try:
+            while True:
+                package = epull_sock.recv()
+                epub_sock.send(package)
+        except KeyboardInterrupt:
+            epub_sock.close()
+            epull_sock.close()
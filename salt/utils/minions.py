@@ -0,0 +1,376 @@
+'''
+Resolve the minions matched by a target on the master
+
+The ids of the accepted minions are kept in memory and the directory of
+accepted keys is only listed again when it changes, so resolving a target
+does not list the directory on every publish.
+
+The minions send their grains to the master, which keeps them in an indexed
+sqlite database, so grain and compound targets resolve to the minions they
+match. The minions which have not sent their grains may match any grain.
+'''
+
+# Import python libs
+import os
+import re
+import time
+import bisect
+import hashlib
+import fnmatch
+import logging
+import threading
+import sqlite3
+
+log = logging.getLogger(__name__)
+
+# The ids of the accepted minions, by the directory of accepted keys, with
+# the stat of the directory they were listed with and the sorted ids
+INDEX = {}
+
+# The characters which make a glob match more than one name
+GLOB_CHARS = re.compile(r'[*?[]')
+
+# The compiled glob targets
+GLOBS = {}
+
+
+def _compile_glob(expr):
+    '''
+    Return the compiled regular expression for a glob, the minions match a
+    glob with fnmatch
+    '''
+    if expr not in GLOBS:
+        if len(GLOBS) > 1000:
+            GLOBS.clear()
+        GLOBS[expr] = re.compile(fnmatch.translate(expr))
+    return GLOBS[expr]
+
+
+def _grain_values(val):
+    '''
+    Return the values of a grain the way the minions compare them
+    '''
+    if not isinstance(val, list):
+        val = [val]
+    ret = set()
+    for member in val:
+        try:
+            ret.add(str(member).lower())
+        except UnicodeError:
+            # The minion can not compare the value either
+            continue
+    return ret
+
+
+def _evaluate(results, universe):
+    '''
+    Evaluate the sets of minions matched by the parts of a compound target,
+    joined with and, or and not the way the minions evaluate the matches.
+    A part is either the set of minions it matches or, when some minions
+    may or may not match it, a pair of the minions which surely match and
+    the minions which may match. Returns the minions which may match
+    '''
+    groups = [[]]
+    negate = False
+    operand = True
+    for result in results:
+        if result == 'not':
+            if not operand:
+                raise ValueError('Misplaced not')
+            negate = not negate
+        elif result in ('and', 'or'):
+            if operand:
+                raise ValueError('Misplaced {0}'.format(result))
+            if result == 'or':
+                groups.append([])
+            operand = True
+        else:
+            if not operand:
+                raise ValueError('Missing operator')
+            if isinstance(result, tuple):
+                sure, may = result
+            else:
+                sure = may = result
+            if negate:
+                sure, may = universe - may, universe - sure
+            groups[-1].append(may)
+            negate = False
+            operand = False
+    if operand:
+        raise ValueError('Missing operand')
+    ret = set()
+    for group in groups:
+        ret.update(reduce(set.intersection, group))
+    return ret
+
+
+class GrainsCache(object):
+    '''
+    Store the grains sent by the minions in an sqlite database, every value
+    of every grain is indexed so that the minions matching a grain are found
+    without reading the grains of all of them
+    '''
+    def __init__(self, opts):
+        self.opts = opts
+        self.db_path = os.path.join(self.opts['cachedir'], 'grains.db')
+        # The hash of the grains stored for each minion by this process
+        self.hashes = {}
+        # A connection per process and thread, sqlite connections can not be
+        # shared over a fork or between threads
+        self.__local = threading.local()
+
+    @property
+    def conn(self):
+        '''
+        The sqlite connection for this process and thread
+        '''
+        local = self.__local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.conn = self.__connect()
+            local.pid = os.getpid()
+        return local.conn
+
+    def __connect(self):
+        '''
+        Open the database and make sure that the schema is in place
+        '''
+        conn = sqlite3.connect(
+                self.db_path,
+                timeout=self.opts.get('job_cache_timeout', 30)
+                )
+        conn.text_factory = str
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS minions ('
+                         'id TEXT PRIMARY KEY, '
+                         'hash TEXT)')
+            conn.execute('CREATE TABLE IF NOT EXISTS grains ('
+                         'id TEXT, '
+                         'grain TEXT, '
+                         'value TEXT)')
+            conn.execute('CREATE INDEX IF NOT EXISTS grains_value '
+                         'ON grains (grain, value)')
+            conn.execute('CREATE INDEX IF NOT EXISTS grains_id '
+                         'ON grains (id)')
+        return conn
+
+    def store(self, id_, grains):
+        '''
+        Store the grains of a minion, nothing is written when they have not
+        changed
+        '''
+        if not isinstance(grains, dict):
+            return False
+        hsum = hashlib.md5(repr(sorted(grains.items()))).hexdigest()
+        if self.hashes.get(id_) == hsum:
+            return True
+        row = self.conn.execute(
+                'SELECT hash FROM minions WHERE id = ?', (id_,)).fetchone()
+        if not row or row[0] != hsum:
+            rows = []
+            for grain, val in grains.items():
+                for value in _grain_values(val):
+                    rows.append((id_, str(grain), value))
+            with self.conn as conn:
+                conn.execute('DELETE FROM grains WHERE id = ?', (id_,))
+                conn.executemany(
+                    'INSERT INTO grains (id, grain, value) VALUES (?, ?, ?)',
+                    rows)
+                conn.execute(
+                    'INSERT OR REPLACE INTO minions (id, hash) VALUES (?, ?)',
+                    (id_, hsum))
+        self.hashes[id_] = hsum
+        return True
+
+    def known(self):
+        '''
+        Return the ids of the minions whose grains are known
+        '''
+        if not os.path.isfile(self.db_path):
+            return set()
+        return set([row[0] for row in self.conn.execute(
+            'SELECT id FROM minions')])
+
+    def match(self, expr, pcre=False):
+        '''
+        Return the ids of the minions with a grain matching the target, a
+        grain name and a glob or a regular expression separated by a colon
+        '''
+        comps = expr.split(':')
+        if len(comps) < 2 or not os.path.isfile(self.db_path):
+            return set()
+        grain, tgt = comps[0], comps[1].lower()
+        if not pcre and not GLOB_CHARS.search(tgt):
+            return set([row[0] for row in self.conn.execute(
+                'SELECT id FROM grains WHERE grain = ? AND value = ?',
+                (grain, tgt))])
+        if pcre:
+            reg = re.compile(tgt)
+        else:
+            reg = _compile_glob(tgt)
+        ret = set()
+        for id_, value in self.conn.execute(
+                'SELECT id, value FROM grains WHERE grain = ?', (grain,)):
+            if reg.match(value):
+                ret.add(id_)
+        return ret
+
+
+class CkMinions(object):
+    '''
+    Check the ids of the accepted minions against targets
+    '''
+    def __init__(self, opts):
+        self.opts = opts
+        self.minion_dir = os.path.join(self.opts['pki_dir'], 'minions')
+        self.grains = GrainsCache(self.opts)
+
+    def _index(self):
+        '''
+        Return the set of the ids of the accepted minions and the ids
+        sorted, a key being accepted or deleted changes the directory, which
+        is then listed again
+        '''
+        try:
+            stat = os.stat(self.minion_dir)
+        except OSError:
+            return frozenset(), ()
+        stamp = (stat.st_mtime, stat.st_ino)
+        cached = INDEX.get(self.minion_dir)
+        # Changes made within the same tick of the clock leave the mtime
+        # alone, a directory changed in the last second is always listed
+        if cached and cached[0] == stamp and time.time() - stat.st_mtime > 1:
+            return cached[1:]
+        ids = sorted([
+            fn_ for fn_ in os.listdir(self.minion_dir)
+            if not fn_.startswith('.')])
+        INDEX[self.minion_dir] = (stamp, frozenset(ids), tuple(ids))
+        return INDEX[self.minion_dir][1:]
+
+    def ids(self):
+        '''
+        Return the set of the ids of the accepted minions
+        '''
+        return self._index()[0]
+
+    def check_glob_minions(self, expr):
+        '''
+        Return the minions found by looking via globs
+        '''
+        ids, ordered = self._index()
+        wild = GLOB_CHARS.search(expr)
+        if not wild:
+            return set([expr]) if expr in ids else set()
+        # Only the ids starting with the text before the first wildcard can
+        # match, they are next to each other in the sorted ids
+        prefix = expr[:wild.start()]
+        reg = _compile_glob(expr)
+        ret = set()
+        for ind in xrange(bisect.bisect_left(ordered, prefix), len(ordered)):
+            id_ = ordered[ind]
+            if not id_.startswith(prefix):
+                break
+            if reg.match(id_):
+                ret.add(id_)
+        return ret
+
+    def check_pcre_minions(self, expr):
+        '''
+        Return the minions found by looking via regular expressions
+        '''
+        reg = re.compile(expr)
+        return set([id_ for id_ in self.ids() if reg.match(id_)])
+
+    def check_list_minions(self, expr):
+        '''
+        Return the minions found by looking via a list
+        '''
+        if isinstance(expr, basestring):
+            expr = expr.split(',')
+        return set(self.ids().intersection(expr))
+
+    def check_grain_minions(self, expr):
+        '''
+        Return the minions found by looking via grains
+        '''
+        ids = self.ids()
+        return (self.grains.match(expr) & ids) | (ids - self.grains.known())
+
+    def check_grain_pcre_minions(self, expr):
+        '''
+        Return the minions found by looking via grains with regular
+        expressions
+        '''
+        ids = self.ids()
+        return (self.grains.match(expr, True) & ids) | \
+                (ids - self.grains.known())
+
+    def check_exsel_minions(self, expr):
+        '''
+        Return the minions found by running a function, the function is run
+        on the minions so all of them may match
+        '''
+        return set(self.ids())
+
+    def check_compound_minions(self, expr):
+        '''
+        Return the minions found by looking via a compound target
+        '''
+        if not isinstance(expr, basestring):
+            return set()
+        ids = set(self.ids())
+        # The minions which have not sent their grains may match any grain
+        unknown = ids - self.grains.known()
+
+        def grain(tgt, pcre=False):
+            sure = self.grains.match(tgt, pcre) & ids
+            return (sure, sure | unknown)
+
+        ref = {'G': grain,
+               'P': lambda tgt: grain(tgt, True),
+               # The minions look for their id in the string
+               'L': lambda tgt: set([id_ for id_ in ids if id_ in tgt]),
+               'E': self.check_pcre_minions}
+        results = []
+        for match in expr.split():
+            if '@' in match and match[1] == '@':
+                comps = match.split('@')
+                if comps[0] == 'X':
+                    return ids
+                if comps[0] not in ref:
+                    # The minions do not match an unknown matcher
+                    return set()
+                results.append(ref[comps[0]]('@'.join(comps[1:])))
+            elif match in ('and', 'or', 'not'):
+                results.append(match)
+            else:
+                results.append(self.check_glob_minions(match))
+        try:
+            matched = _evaluate(results, ids)
+        except (ValueError, TypeError):
+            log.error('Invalid compound target: {0}'.format(expr))
+            return set()
+        return matched
+
+    def check_minions(self, expr, expr_form='glob'):
+        '''
+        Check the passed regex against the available minions' public keys
+        stored for authentication. This should return a set of ids which
+        match the regex, this will then be used to parse the returns to
+        make sure everyone has checked back in.
+        '''
+        try:
+            return {'glob': self.check_glob_minions,
+                    'pcre': self.check_pcre_minions,
+                    'list': self.check_list_minions,
+                    'grain': self.check_grain_minions,
+                    'grain_pcre': self.check_grain_pcre_minions,
+                    'exsel': self.check_exsel_minions,
+                    'compound': self.check_compound_minions,
+                    }[expr_form](expr)
+        except re.error as exc:
+            # The minions do not match an invalid regular expression either
+            log.error('Invalid regular expression in target {0}: {1}'.format(
+                expr, exc))
+            return set()
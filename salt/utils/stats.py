@@ -0,0 +1,205 @@
+'''
+Collect statistics on the requests served by the master workers
+
+Every worker keeps counters for each command it serves, the number of
+requests, errors, bytes in and out and a histogram of the time taken. The
+counters are written out to ``cachedir/stats/<pid>.p`` every few seconds and
+are added up across the workers by the ``manage.stats`` runner.
+'''
+
+# Import python libs
+import os
+import time
+import logging
+
+# Import salt libs
+import salt.payload
+
+log = logging.getLogger(__name__)
+
+# The upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+# Seconds between writes of the worker stats
+DUMP_INTERVAL = 10
+
+
+def stats_dir(opts):
+    '''
+    Return the directory the stats files are kept in
+    '''
+    return os.path.join(opts['cachedir'], 'stats')
+
+
+def clear(opts):
+    '''
+    Remove the stats left behind by a previous run of the master
+    '''
+    s_dir = stats_dir(opts)
+    if not os.path.isdir(s_dir):
+        return
+    for fn_ in os.listdir(s_dir):
+        try:
+            os.remove(os.path.join(s_dir, fn_))
+        except OSError:
+            pass
+
+
+def _new_counters():
+    '''
+    Return an empty set of counters for a command
+    '''
+    return {'requests': 0,
+            'errors': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+            'time_total': 0.0,
+            'time_max': 0.0,
+            'decrypt_total': 0.0,
+            'serialize_total': 0.0,
+            'histogram': [0] * (len(BUCKETS) + 1)}
+
+
+def _percentile(histogram, fraction):
+    '''
+    Estimate a percentile from a histogram, the upper bound of the bucket the
+    percentile falls in is returned
+    '''
+    total = sum(histogram)
+    if not total:
+        return 0.0
+    target = total * fraction
+    seen = 0
+    for ind, count in enumerate(histogram):
+        seen += count
+        if seen >= target:
+            if ind < len(BUCKETS):
+                return BUCKETS[ind]
+            break
+    return float('inf')
+
+
+class Stats(object):
+    '''
+    The request counters of a single worker process
+    '''
+    def __init__(self, opts):
+        self.opts = opts
+        self.serial = salt.payload.Serial({'serial': 'msgpack'})
+        self.cmds = {}
+        self.counters = {}
+        self.last_dump = time.time()
+        self.path = None
+
+    def record(
+            self,
+            cmd,
+            duration,
+            bytes_in=0,
+            bytes_out=0,
+            error=False,
+            decrypt=0.0,
+            serialize=0.0):
+        '''
+        Add a served request to the counters of the command
+        '''
+        if cmd not in self.cmds:
+            self.cmds[cmd] = _new_counters()
+        counters = self.cmds[cmd]
+        counters['requests'] += 1
+        counters['bytes_in'] += bytes_in
+        counters['bytes_out'] += bytes_out
+        counters['time_total'] += duration
+        counters['decrypt_total'] += decrypt
+        counters['serialize_total'] += serialize
+        counters['time_max'] = max(counters['time_max'], duration)
+        if error:
+            counters['errors'] += 1
+        for ind, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                counters['histogram'][ind] += 1
+                break
+        else:
+            counters['histogram'][-1] += 1
+
+    def incr(self, name, amount=1):
+        '''
+        Add to a named counter, these count events which are not requests,
+        such as the bytes a file server request did not need to send
+        '''
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def maybe_dump(self):
+        '''
+        Write the counters out if they have not been written recently
+        '''
+        if time.time() - self.last_dump > DUMP_INTERVAL:
+            self.dump()
+
+    def dump(self):
+        '''
+        Write the counters to the stats file of this process
+        '''
+        self.last_dump = time.time()
+        s_dir = stats_dir(self.opts)
+        path = os.path.join(s_dir, '{0}.p'.format(os.getpid()))
+        try:
+            if not os.path.isdir(s_dir):
+                os.makedirs(s_dir)
+            tmp = path + '.tmp'
+            self.serial.dump(
+                    {'pid': os.getpid(),
+                     'time': self.last_dump,
+                     'cmds': self.cmds,
+                     'counters': self.counters},
+                    open(tmp, 'w+'))
+            os.rename(tmp, path)
+        except (IOError, OSError) as exc:
+            log.error('Failed to write the worker stats: {0}'.format(exc))
+
+
+def aggregate(opts):
+    '''
+    Add up the counters written by all of the workers, the latency summary
+    of each command is worked out from the merged histograms
+    '''
+    serial = salt.payload.Serial({'serial': 'msgpack'})
+    ret = {'cmds': {}, 'counters': {}, 'workers': 0, 'dispatcher': {}}
+    s_dir = stats_dir(opts)
+    if not os.path.isdir(s_dir):
+        return ret
+    for fn_ in os.listdir(s_dir):
+        if not fn_.endswith('.p'):
+            continue
+        try:
+            data = serial.load(open(os.path.join(s_dir, fn_), 'rb'))
+        except Exception:
+            continue
+        if fn_ == 'dispatcher.p':
+            ret['dispatcher'] = data
+            continue
+        ret['workers'] += 1
+        for name, val in data.get('counters', {}).items():
+            ret['counters'][name] = ret['counters'].get(name, 0) + val
+        for cmd, counters in data.get('cmds', {}).items():
+            if cmd not in ret['cmds']:
+                ret['cmds'][cmd] = _new_counters()
+            total = ret['cmds'][cmd]
+            for key, val in counters.items():
+                if key == 'histogram':
+                    for ind, count in enumerate(val):
+                        total['histogram'][ind] += count
+                elif key == 'time_max':
+                    total[key] = max(total[key], val)
+                else:
+                    total[key] += val
+    for counters in ret['cmds'].values():
+        if counters['requests']:
+            counters['time_avg'] = (
+                    counters['time_total'] / counters['requests'])
+        counters['time_p50'] = _percentile(counters['histogram'], 0.5)
+        counters['time_p99'] = _percentile(counters['histogram'], 0.99)
+        labels = ['<={0}'.format(bound) for bound in BUCKETS]
+        labels.append('>{0}'.format(BUCKETS[-1]))
+        counters['histogram'] = dict(zip(labels, counters['histogram']))
+    return ret
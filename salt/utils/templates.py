@@ -14,6 +14,17 @@ import copy
 logger = logging.getLogger(__name__)
 
 
+def _rendered(tgt, data):
+    '''
+    Return the result of rendering a template to the file tgt, with the hash
+    of the data written to it so that it does not need to be read back in
+    '''
+    return {'result': True,
+            'data': tgt,
+            'hash_type': 'md5',
+            'hsum': hashlib.md5(data).hexdigest()}
+
+
 def mako(sfn, string=False, **kwargs):
     '''
     Render a mako template, returns the location of the rendered file,
@@ -46,8 +57,7 @@ def mako(sfn, string=False, **kwargs):
                     'data': data}
         with open(tgt, 'w+') as target:
             target.write(data)
-        return {'result': True,
-                'data': tgt}
+        return _rendered(tgt, data)
     except:
         trb = traceback.format_exc()
         return {'result': False,
@@ -87,17 +97,18 @@ def jinja(sfn, string=False, **kwargs):
             if string:
                 return {'result': True,
                         'data': data}
+            if newline:
+                data += '\n'
             with open(tgt, 'w+') as target:
                 target.write(data)
-                if newline:
-                    target.write('\n')
         except UnicodeEncodeError:
+            data = template.render(**passthrough)
+            if newline:
+                data += '\n'
             with codecs.open(tgt, encoding='utf-8', mode='w+') as target:
-                target.write(template.render(**passthrough))
-                if newline:
-                    target.write('\n')
-        return {'result': True,
-                    'data': tgt}
+                target.write(data)
+            data = data.encode('utf-8')
+        return _rendered(tgt, data)
     except:
         trb = traceback.format_exc()
         return {'result': False,
@@ -131,8 +142,7 @@ def py(sfn, string=False, **kwargs):
         tgt = tempfile.mkstemp()[1]
         with open(tgt, 'w+') as target:
             target.write(data)
-        return {'result': True,
-                'data': tgt}
+        return _rendered(tgt, data)
     except:
         trb = traceback.format_exc()
         return {'result': False,
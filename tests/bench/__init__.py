@@ -0,0 +1,463 @@
+'''
+Set up the Salt benchmark suite
+
+A real master is started in a temporary root and is driven by swarms of fake
+minions. The fake minions are cheap, many of them run in a single process,
+but they speak the same protocol as a real minion: they sign in with
+``_auth``, listen on the publisher, send their returns with ``_return`` and
+fetch files and pillar data over the request server.
+'''
+
+# Import Python libs
+import os
+import time
+import fnmatch
+import shutil
+import socket
+import tempfile
+import collections
+import multiprocessing
+import Queue
+
+# Import third party libs
+import zmq
+import yaml
+from M2Crypto import RSA
+
+# Import Salt libs
+import salt.config
+import salt.crypt
+import salt.log
+import salt.master
+import salt.payload
+from salt.utils.verify import verify_env
+
+
+def text_data(size):
+    '''
+    Return text which compresses like a log file or a config tree
+    '''
+    lines = []
+    total = 0
+    ind = 0
+    while total < size:
+        line = '{0} host{1}.example.com service[{2}]: request {3} took {4}ms\n'.format(
+                time.strftime('%b %d %H:%M:%S'),
+                ind % 97,
+                ind % 3001,
+                os.urandom(4).encode('hex'),
+                ind % 250)
+        lines.append(line)
+        total += len(line)
+        ind += 1
+    return ''.join(lines)[:size]
+
+
+def free_port():
+    '''
+    Return a free tcp port on localhost
+    '''
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def percentile(values, fraction):
+    '''
+    Return the given percentile of a list of values
+    '''
+    if not values:
+        return 0.0
+    values = sorted(values)
+    ind = int(round(fraction * (len(values) - 1)))
+    return values[ind]
+
+
+def summarize(latencies, duration):
+    '''
+    Return the throughput and latency summary of a benchmark run
+    '''
+    return {'requests': len(latencies),
+            'per_sec': len(latencies) / duration if duration else 0.0,
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'max': max(latencies) if latencies else 0.0}
+
+
+class ProcStats(object):
+    '''
+    Read the cpu time and memory use of a process and all of its children
+    from /proc
+    '''
+    def __init__(self, pid):
+        self.pid = pid
+        self.tick = float(os.sysconf('SC_CLK_TCK'))
+
+    def _stat(self, pid):
+        '''
+        Return the fields of /proc/<pid>/stat after the command name
+        '''
+        with open('/proc/{0}/stat'.format(pid), 'r') as fp_:
+            return fp_.read().rsplit(')', 1)[1].split()
+
+    def pids(self):
+        '''
+        Return the pid of the process and the pids of all of its children
+        '''
+        parents = {}
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                parents.setdefault(int(self._stat(pid)[1]), []).append(int(pid))
+            except (IOError, OSError, IndexError):
+                continue
+        ret = [self.pid]
+        ind = 0
+        while ind < len(ret):
+            ret.extend(parents.get(ret[ind], []))
+            ind += 1
+        return ret
+
+    def cpu(self):
+        '''
+        Return the cpu seconds used by the process tree
+        '''
+        total = 0.0
+        for pid in self.pids():
+            try:
+                fields = self._stat(pid)
+            except (IOError, OSError):
+                continue
+            total += (int(fields[11]) + int(fields[12])) / self.tick
+        return total
+
+    def rss(self):
+        '''
+        Return the resident memory of the process tree in bytes
+        '''
+        total = 0
+        for pid in self.pids():
+            try:
+                with open('/proc/{0}/status'.format(pid), 'r') as fp_:
+                    for line in fp_:
+                        if line.startswith('VmRSS:'):
+                            total += int(line.split()[1]) * 1024
+            except (IOError, OSError):
+                continue
+        return total
+
+
+class BenchDaemon(object):
+    '''
+    Start a master in a temporary root directory to run the benchmarks on
+    '''
+    def __init__(
+            self,
+            worker_threads=5,
+            file_size=1048576,
+            opts=None,
+            file_data='random'):
+        self.worker_threads = worker_threads
+        self.file_size = file_size
+        self.file_data = file_data
+        self.extra_opts = opts or {}
+        self.root_dir = None
+        self.conf_file = None
+        self.master_opts = None
+        self.master_process = None
+
+    def __enter__(self):
+        '''
+        Lay down the file and pillar roots and start the master
+        '''
+        self.root_dir = tempfile.mkdtemp(prefix='saltbench-')
+        file_root = os.path.join(self.root_dir, 'files')
+        pillar_root = os.path.join(self.root_dir, 'pillar')
+        os.makedirs(os.path.join(file_root, 'bench'))
+        os.makedirs(pillar_root)
+        with open(os.path.join(file_root, 'bench', 'data'), 'wb') as fp_:
+            if self.file_data == 'text':
+                fp_.write(text_data(self.file_size))
+            else:
+                fp_.write(os.urandom(self.file_size))
+        with open(os.path.join(pillar_root, 'top.sls'), 'w+') as fp_:
+            fp_.write("base:\n  '*':\n    - bench\n")
+        with open(os.path.join(pillar_root, 'bench.sls'), 'w+') as fp_:
+            fp_.write(
+                "{% for ind in range(50) %}\n"
+                "key{{ ind }}: {{ grains['id'] }}-{{ ind }}\n"
+                "{% endfor %}\n")
+        conf = {'interface': '127.0.0.1',
+                'publish_port': free_port(),
+                'ret_port': free_port(),
+                'root_dir': self.root_dir,
+                'pki_dir': 'pki',
+                'cachedir': 'cache',
+                'sock_dir': 'sock',
+                'log_file': 'master.log',
+                'open_mode': True,
+                'worker_threads': self.worker_threads,
+                'file_roots': {'base': [file_root]},
+                'pillar_roots': {'base': [pillar_root]}}
+        conf.update(self.extra_opts)
+        self.conf_file = os.path.join(self.root_dir, 'master')
+        with open(self.conf_file, 'w+') as fp_:
+            fp_.write(yaml.dump(conf))
+        self.master_opts = salt.config.master_config(self.conf_file)
+        verify_env([
+                    os.path.join(self.master_opts['pki_dir'], 'minions'),
+                    os.path.join(self.master_opts['pki_dir'], 'minions_pre'),
+                    os.path.join(self.master_opts['pki_dir'], 'minions_rejected'),
+                    os.path.join(self.master_opts['cachedir'], 'jobs'),
+                    os.path.dirname(self.master_opts['log_file']),
+                    self.master_opts['sock_dir'],
+                    ])
+        # Lay down a smaller master key than the master would generate, the
+        # benchmarks do not need a 4096 bit key
+        key = RSA.gen_key(2048, 65537, callback=lambda *args: None)
+        key.save_key(
+                os.path.join(self.master_opts['pki_dir'], 'master.pem'), None)
+        key.save_pub_key(
+                os.path.join(self.master_opts['pki_dir'], 'master.pub'))
+        salt.log.setup_logfile_logger(
+                self.master_opts['log_file'], self.master_opts['log_level'])
+        master = salt.master.Master(self.master_opts)
+        self.master_process = multiprocessing.Process(target=master.start)
+        self.master_process.start()
+        # Wait for the publisher and the workers to come up
+        time.sleep(2)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        '''
+        Stop the master and remove the temporary root
+        '''
+        self.master_process.terminate()
+        self.master_process.join(10)
+        shutil.rmtree(self.root_dir, ignore_errors=True)
+
+    def master_uri(self):
+        '''
+        Return the uri of the master request server
+        '''
+        return 'tcp://127.0.0.1:{0}'.format(self.master_opts['ret_port'])
+
+    def stats(self):
+        '''
+        Return a ProcStats object for the master process tree
+        '''
+        return ProcStats(self.master_process.pid)
+
+
+class FakeMinionSwarm(multiprocessing.Process):
+    '''
+    Run a group of fake minions in a single process. Every fake minion has a
+    connection of its own to the publisher and to the request server, so the
+    master sees the same number of connections as it would from real
+    minions
+    '''
+    def __init__(
+            self,
+            uri,
+            publish_port,
+            ids,
+            key_path,
+            tasks,
+            results,
+            compress=False):
+        multiprocessing.Process.__init__(self)
+        self.uri = uri
+        self.publish_port = publish_port
+        self.ids = ids
+        self.key_path = key_path
+        self.tasks = tasks
+        self.results = results
+        self.compress = compress
+        self.serial = salt.payload.Serial({'serial': 'msgpack'})
+        self.crypticle = None
+        self.topics = False
+        self.last_pub = None
+        self.last_data = None
+
+    def _auth(self, context, id_, key, pub):
+        '''
+        Sign a fake minion in with the master and return its crypticle
+        '''
+        sock = context.socket(zmq.REQ)
+        sock.connect(self.uri)
+        while True:
+            sock.send(self.serial.dumps({'enc': 'clear',
+                                         'load': {'cmd': '_auth',
+                                                  'id': id_,
+                                                  'pub': pub}}))
+            ret = self.serial.loads(sock.recv())
+            if 'retry_after' not in ret.get('load', {}):
+                break
+            # The master is busy, wait the time it asked for
+            time.sleep(ret['load']['retry_after'])
+        sock.close()
+        aes = key.private_decrypt(ret['aes'], 4)
+        compress = self.compress and 'zlib' in ret.get('compression', [])
+        self.topics = ret.get('publish_topics', False)
+        return salt.crypt.Crypticle({}, aes, compress=compress)
+
+    def _send(self, ind, load, kind, lane=None):
+        '''
+        Send an aes load to the master for the fake minion at ind
+        '''
+        if self.crypticle.compress and kind[0] != 'ret':
+            # Ask for a compressed reply
+            load['compress'] = 'zlib'
+        payload = {'enc': 'aes', 'load': self.crypticle.dumps(load)}
+        if lane:
+            payload['lane'] = lane
+        self.reqs[ind].send_multipart(['', self.serial.dumps(payload)])
+        self.pending[ind].append(kind)
+
+    def _handle_pub(self, ind):
+        '''
+        Answer a publication the way a minion running test.ping would
+        '''
+        msg = self.subs[ind].recv_multipart()[-1]
+        if msg != self.last_pub:
+            # All of the fake minions get the same message, decrypt it once
+            self.last_pub = msg
+            self.last_data = self.crypticle.loads(self.serial.loads(msg)['load'])
+        data = self.last_data
+        tgt_type = data.get('tgt_type', 'glob')
+        if tgt_type == 'glob' \
+                and not fnmatch.fnmatch(self.ids[ind], data['tgt']):
+            return
+        if tgt_type == 'list' and self.ids[ind] not in data['tgt']:
+            return
+        load = {'cmd': '_return',
+                'id': self.ids[ind],
+                'jid': data['jid'],
+                'return': data['arg'][0] if data['arg'] else True}
+        self._send(ind, load, ('ret',))
+
+    def _start_task(self, task):
+        '''
+        Start a file or pillar fetch on all of the fake minions
+        '''
+        self.task = {'name': task[0],
+                     'rounds': task[1],
+                     'left': len(self.ids) * task[1],
+                     'done': [0] * len(self.ids),
+                     'latencies': [],
+                     'bytes': 0,
+                     'wire_bytes': 0,
+                     'errors': 0,
+                     'start': time.time()}
+        for ind in range(len(self.ids)):
+            self._next_fetch(ind)
+
+    def _next_fetch(self, ind, loc=0, start=None):
+        '''
+        Send the next request of the running task for a fake minion
+        '''
+        start = start or time.time()
+        if self.task['name'] == 'files':
+            load = {'cmd': '_serve_file',
+                    'path': 'bench/data',
+                    'env': 'base',
+                    'loc': loc}
+            self._send(ind, load, ('file', start, loc), 'file')
+        else:
+            load = {'cmd': '_pillar',
+                    'id': self.ids[ind],
+                    'grains': {'id': self.ids[ind],
+                               'os': 'Linux',
+                               'os_family': 'Debian',
+                               'kernel': 'Linux',
+                               'cpuarch': 'x86_64'},
+                    'env': 'base'}
+            self._send(ind, load, ('pillar', start))
+
+    def _handle_reply(self, ind):
+        '''
+        Handle a reply from the master, a file fetch asks for the next chunk
+        until the file is complete
+        '''
+        reply = self.reqs[ind].recv_multipart()[-1]
+        kind = self.pending[ind].popleft()
+        if kind[0] == 'ret':
+            return
+        self.task['wire_bytes'] += len(reply)
+        data = self.serial.loads(reply)
+        if isinstance(data, basestring):
+            data = self.crypticle.loads(data)
+        else:
+            # The master failed to serve the request and sent back an empty
+            # reply in the clear, it is left out of the latencies
+            self.task['errors'] += 1
+            data = None
+        if kind[0] == 'file' and data and data.get('data'):
+            self.task['bytes'] += len(data['data'])
+            self._next_fetch(ind, kind[2] + len(data['data']), kind[1])
+            return
+        if data is not None:
+            self.task['latencies'].append(time.time() - kind[1])
+        self.task['left'] -= 1
+        self.task['done'][ind] += 1
+        if self.task['done'][ind] < self.task['rounds']:
+            self._next_fetch(ind)
+        elif self.task['left'] <= 0:
+            self.results.put((self.task['name'],
+                              self.task['latencies'],
+                              self.task['bytes'],
+                              self.task['wire_bytes'],
+                              self.task['errors']))
+            self.task = None
+
+    def run(self):
+        '''
+        Sign the fake minions in and serve publications and tasks until told
+        to stop
+        '''
+        context = zmq.Context()
+        key = RSA.load_key(self.key_path)
+        pub = open('{0}.pub'.format(self.key_path), 'r').read()
+        for id_ in self.ids:
+            self.crypticle = self._auth(context, id_, key, pub)
+        self.subs = []
+        self.reqs = []
+        self.pending = []
+        self.task = None
+        poller = zmq.Poller()
+        index = {}
+        for ind, id_ in enumerate(self.ids):
+            sub = context.socket(zmq.SUB)
+            if self.topics:
+                # Subscribe the way a minion does
+                sub.setsockopt(zmq.SUBSCRIBE, salt.payload.topic())
+                sub.setsockopt(zmq.SUBSCRIBE, salt.payload.topic(id_))
+            else:
+                sub.setsockopt(zmq.SUBSCRIBE, '')
+            sub.connect('tcp://127.0.0.1:{0}'.format(self.publish_port))
+            req = context.socket(zmq.DEALER)
+            req.connect(self.uri)
+            self.subs.append(sub)
+            self.reqs.append(req)
+            self.pending.append(collections.deque())
+            index[sub] = (ind, self._handle_pub)
+            index[req] = (ind, self._handle_reply)
+            poller.register(sub, zmq.POLLIN)
+            poller.register(req, zmq.POLLIN)
+        self.results.put(('ready', len(self.ids), 0, 0, 0))
+        while True:
+            if self.task is None:
+                try:
+                    task = self.tasks.get_nowait()
+                except Queue.Empty:
+                    pass
+                else:
+                    if task[0] == 'stop':
+                        break
+                    self._start_task(task)
+            for sock, _ in poller.poll(100):
+                ind, handler = index[sock]
+                handler(ind)
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+'''
+Benchmark the master with a swarm of fake minions.
+
+The benchmarks measure publish to return round trips through the Publisher,
+the request server and the LocalClient, file serving and pillar compiles,
+and report the throughput, the latency and the cpu and memory used by the
+master processes.
+
+Every fake minion holds two connections to the master, raise the open file
+limit before running with thousands of minions.
+'''
+# Import python libs
+import os
+import sys
+import time
+import optparse
+import tempfile
+import multiprocessing
+
+TEST_DIR = os.path.dirname(os.path.normpath(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+
+# Import third party libs
+import yaml
+from M2Crypto import RSA
+
+# Import salt libs
+import salt.client
+from bench import BenchDaemon, FakeMinionSwarm, summarize
+
+PNUM = 50
+
+
+def start_swarms(daemon, opts, key_path):
+    '''
+    Start the fake minion swarms and wait for all of them to sign in
+    '''
+    ids = ['bench-{0}'.format(ind) for ind in range(opts['minions'])]
+    results = multiprocessing.Queue()
+    swarms = []
+    for ind in range(opts['procs']):
+        swarm = FakeMinionSwarm(
+                daemon.master_uri(),
+                daemon.master_opts['publish_port'],
+                ids[ind::opts['procs']],
+                key_path,
+                multiprocessing.Queue(),
+                results,
+                opts['compress'])
+        swarm.start()
+        swarms.append(swarm)
+    for swarm in swarms:
+        results.get(timeout=opts['timeout'] * 10)
+    # Give the subscriptions time to reach the publisher
+    time.sleep(1)
+    return swarms, results
+
+
+def bench_publish(daemon, opts, swarms, results):
+    '''
+    Publish jobs to all of the fake minions and wait for every return
+    '''
+    client = salt.client.LocalClient(daemon.conf_file)
+    latencies = []
+    missing = 0
+    start = time.time()
+    if opts['targets']:
+        # Target a list of a few of the minions
+        tgt = ['bench-{0}'.format(ind) for ind in range(opts['targets'])]
+        expr_form = 'list'
+    else:
+        tgt = 'bench-*'
+        expr_form = 'glob'
+    expected = len(tgt) if expr_form == 'list' else opts['minions']
+    for ind in range(opts['jobs']):
+        job_start = time.time()
+        ret = client.cmd(
+                tgt, 'test.ping', timeout=opts['timeout'], expr_form=expr_form)
+        latencies.append(time.time() - job_start)
+        missing += expected - len(ret)
+    ret = summarize(latencies, time.time() - start)
+    ret['returns_per_sec'] = (expected * opts['jobs'] - missing) / \
+            (time.time() - start)
+    ret['missing_returns'] = missing
+    return ret
+
+
+def bench_fetch(name, daemon, opts, swarms, results):
+    '''
+    Have every fake minion fetch the benchmark file or compile its pillar
+    '''
+    start = time.time()
+    for swarm in swarms:
+        swarm.tasks.put((name, opts['rounds']))
+    latencies = []
+    total = 0
+    wire = 0
+    errors = 0
+    for swarm in swarms:
+        _, lat, bytes_, wire_bytes, errs = results.get(
+                timeout=opts['timeout'] * 60)
+        latencies.extend(lat)
+        total += bytes_
+        wire += wire_bytes
+        errors += errs
+    duration = time.time() - start
+    ret = summarize(latencies, duration)
+    ret['errors'] = errors
+    ret['wire_bytes'] = wire
+    if total:
+        ret['mb_per_sec'] = total / duration / 1048576
+    return ret
+
+
+def run_benchmarks(opts):
+    '''
+    Start a master and the fake minions and run the selected benchmarks
+    '''
+    key_dir = tempfile.mkdtemp(prefix='saltbench-key-')
+    key_path = os.path.join(key_dir, 'minion.pem')
+    # The fake minions share a key, generating thousands of keys would take
+    # longer than the benchmarks
+    key = RSA.gen_key(2048, 65537, callback=lambda *args: None)
+    key.save_key(key_path, None)
+    key.save_pub_key('{0}.pub'.format(key_path))
+    report = {'minions': opts['minions'], 'procs': opts['procs']}
+    report['compress'] = opts['compress']
+    report['topics'] = opts['topics']
+    report['auth_rate'] = opts['auth_rate']
+    with BenchDaemon(
+            opts['workers'],
+            opts['file_size'],
+            {'publish_topics': opts['topics'],
+             'auth_rate': opts['auth_rate']},
+            file_data=opts['file_data']) as daemon:
+        stats = daemon.stats()
+        start = time.time()
+        swarms, results = start_swarms(daemon, opts, key_path)
+        report['sign_in_secs'] = time.time() - start
+        benches = {'publish': lambda: bench_publish(
+                       daemon, opts, swarms, results),
+                   'files': lambda: bench_fetch(
+                       'files', daemon, opts, swarms, results),
+                   'pillar': lambda: bench_fetch(
+                       'pillar', daemon, opts, swarms, results)}
+        for name in opts['bench']:
+            print '~' * PNUM
+            print 'Running the {0} benchmark'.format(name)
+            print '~' * PNUM
+            cpu = stats.cpu()
+            start = time.time()
+            report[name] = benches[name]()
+            duration = time.time() - start
+            report[name]['master_cpu'] = (stats.cpu() - cpu) / duration
+            report[name]['master_rss'] = stats.rss()
+            print yaml.dump(report[name], default_flow_style=False)
+        for swarm in swarms:
+            swarm.tasks.put(('stop',))
+        for swarm in swarms:
+            swarm.join(5)
+            if swarm.is_alive():
+                swarm.terminate()
+    os.remove(key_path)
+    os.remove('{0}.pub'.format(key_path))
+    os.rmdir(key_dir)
+    return report
+
+
+def parse_opts():
+    '''
+    Parse command line options for the benchmarks
+    '''
+    parser = optparse.OptionParser()
+    parser.add_option('-m',
+            '--minions',
+            dest='minions',
+            default=1000,
+            type='int',
+            help='The number of fake minions to start, default 1000')
+    parser.add_option('-p',
+            '--procs',
+            dest='procs',
+            default=multiprocessing.cpu_count(),
+            type='int',
+            help='The number of processes to run the fake minions in')
+    parser.add_option('-w',
+            '--workers',
+            dest='workers',
+            default=5,
+            type='int',
+            help='The worker_threads of the master, default 5')
+    parser.add_option('-j',
+            '--jobs',
+            dest='jobs',
+            default=20,
+            type='int',
+            help='The number of jobs to publish, default 20')
+    parser.add_option('-r',
+            '--rounds',
+            dest='rounds',
+            default=1,
+            type='int',
+            help='The number of file and pillar fetches per minion')
+    parser.add_option('-s',
+            '--file-size',
+            dest='file_size',
+            default=1048576,
+            type='int',
+            help='The size of the file served to the minions in bytes')
+    parser.add_option('-d',
+            '--file-data',
+            dest='file_data',
+            default='random',
+            choices=['random', 'text'],
+            help=('Serve random data, which does not compress, or text which '
+                  'compresses like a log file, default random'))
+    parser.add_option('-c',
+            '--compress',
+            dest='compress',
+            default=False,
+            action='store_true',
+            help='Have the fake minions ask for compressed replies')
+    parser.add_option('-T',
+            '--topics',
+            dest='topics',
+            default=False,
+            action='store_true',
+            help='Have the master publish jobs under topics')
+    parser.add_option('-l',
+            '--targets',
+            dest='targets',
+            default=0,
+            type='int',
+            help=('Publish the jobs to a list of this many minions rather than '
+                  'to all of them'))
+    parser.add_option('-a',
+            '--auth-rate',
+            dest='auth_rate',
+            default=0,
+            type='int',
+            help='The auth_rate of the master, default 0')
+    parser.add_option('-t',
+            '--timeout',
+            dest='timeout',
+            default=30,
+            type='int',
+            help='The timeout of a published job in seconds')
+    parser.add_option('-b',
+            '--bench',
+            dest='bench',
+            default='publish,files,pillar',
+            help='A comma delimited list of the benchmarks to run')
+    parser.add_option('-o',
+            '--output',
+            dest='output',
+            default='',
+            help='Write the report to the named file as yaml')
+
+    options, args = parser.parse_args()
+    opts = dict(options.__dict__)
+    opts['bench'] = [name for name in opts['bench'].split(',') if name]
+    opts['procs'] = max(1, min(opts['procs'], opts['minions']))
+    return opts
+
+
+if __name__ == "__main__":
+    opts = parse_opts()
+    report = run_benchmarks(opts)
+    print '~' * PNUM
+    print 'Benchmark Report'
+    print '~' * PNUM
+    print yaml.dump(report, default_flow_style=False)
+    if opts['output']:
+        with open(opts['output'], 'w+') as fp_:
+            fp_.write(yaml.dump(report, default_flow_style=False))
+    failed = [name for name in opts['bench'] if report[name].get('errors')]
+    if failed:
+        # The master failed requests, the numbers can not be trusted
+        print 'The master failed requests in: {0}'.format(', '.join(failed))
+        sys.exit(1)
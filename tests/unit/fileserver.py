@@ -0,0 +1,170 @@
+# Import python libs
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+
+# Import salt libs
+from saltunittest import TestCase
+import salt.fileserver
+
+
+class HashCacheTest(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.opts = {'hash_type': 'md5'}
+        self.path = os.path.join(self.tmp, 'file')
+        self._write('foo')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _write(self, data):
+        with open(self.path, 'w+') as fp_:
+            fp_.write(data)
+
+    def test_get(self):
+        '''
+        Files are hashed again only after they change
+        '''
+        cache = salt.fileserver.HashCache(self.opts)
+        self.assertEqual(cache.get(self.path), hashlib.md5('foo').hexdigest())
+        self.assertEqual(
+                cache.get(self.path, form='sha256'),
+                hashlib.sha256('foo').hexdigest())
+        cache.set(self.path, 'cached')
+        self.assertEqual(cache.get(self.path), 'cached')
+        self._write('changed')
+        self.assertEqual(
+                cache.get(self.path), hashlib.md5('changed').hexdigest())
+
+    def test_cached_form(self):
+        '''
+        The hash type of a cached hash is found while the file is unchanged
+        '''
+        cache = salt.fileserver.HashCache(self.opts)
+        self.assertEqual(cache.cached_form(self.path), 'md5')
+        cache.set(self.path, 'cached', form='sha256')
+        self.assertEqual(cache.cached_form(self.path), 'sha256')
+        cache.get(self.path)
+        self.assertEqual(cache.cached_form(self.path), 'md5')
+        self._write('changed')
+        self.assertEqual(cache.cached_form(self.path), 'md5')
+
+    def test_save(self):
+        '''
+        The hashes are kept across instances and pruned
+        '''
+        cache_path = os.path.join(self.tmp, 'cache', 'hashes.p')
+        cache = salt.fileserver.HashCache(self.opts, cache_path)
+        cache.set(self.path, 'cached')
+        cache.save()
+        cache = salt.fileserver.HashCache(self.opts, cache_path)
+        self.assertEqual(cache.get(self.path), 'cached')
+        cache.prune([])
+        self.assertEqual(cache.cache, {})
+        assert cache.dirty
+
+
+class FileIndexTest(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.roots = [os.path.join(self.tmp, 'first'),
+                      os.path.join(self.tmp, 'second')]
+        self._write(0, 'top.sls', 'base')
+        self._write(0, 'web/init.sls', 'web')
+        self._write(1, 'web/init.sls', 'shadowed')
+        self._write(1, 'db/init.sls', 'db')
+        os.makedirs(os.path.join(self.roots[1], 'empty'))
+        self.opts = {'cachedir': os.path.join(self.tmp, 'cache'),
+                     'hash_type': 'md5',
+                     'file_roots': {'base': self.roots}}
+        self.index = salt.fileserver.FileIndex(self.opts)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _write(self, root, path, data):
+        full = os.path.join(self.roots[root], path)
+        if not os.path.isdir(os.path.dirname(full)):
+            os.makedirs(os.path.dirname(full))
+        with open(full, 'w+') as fp_:
+            fp_.write(data)
+        return full
+
+    def _age(self):
+        '''
+        Move the mtimes of the directories back, so that they are not
+        listed again because they changed within the last second
+        '''
+        old = time.time() - 10
+        for root in self.roots:
+            for dirpath, dirs, files in os.walk(root):
+                os.utime(dirpath, (old, old))
+
+    def test_refresh(self):
+        '''
+        The index serves the files of the first root they are found in
+        '''
+        assert self.index.refresh()
+        self.assertEqual(
+                self.index.file_list(),
+                ['db/init.sls', 'top.sls', 'web/init.sls'])
+        self.assertEqual(self.index.file_list_emptydirs(), ['empty'])
+        self.assertEqual(
+                self.index.find('web/init.sls')['path'],
+                os.path.join(self.roots[0], 'web', 'init.sls'))
+        self.assertEqual(
+                self.index.file_hash('web/init.sls'),
+                hashlib.md5('web').hexdigest())
+        self.assertEqual(self.index.find('web/init.sls', 'dev'), None)
+        self.assertEqual(self.index.file_list('dev'), None)
+
+    def test_load(self):
+        '''
+        The index written by the refresh is read back by the workers
+        '''
+        worker = salt.fileserver.FileIndex(self.opts)
+        assert not worker.load()
+        self.index.refresh()
+        assert worker.load()
+        self.assertEqual(worker.file_list(), self.index.file_list())
+
+    def test_changes(self):
+        '''
+        Added, changed and removed files are picked up
+        '''
+        self.index.refresh()
+        self._age()
+        assert not self.index.refresh()
+        self._write(1, 'db/new.sls', 'new')
+        path = self._write(0, 'top.sls', 'changed')
+        os.utime(path, (time.time() + 5, time.time() + 5))
+        shutil.rmtree(os.path.join(self.roots[0], 'web'))
+        assert self.index.refresh()
+        self.assertEqual(
+                self.index.file_list(),
+                ['db/init.sls', 'db/new.sls', 'top.sls', 'web/init.sls'])
+        self.assertEqual(
+                self.index.find('web/init.sls')['path'],
+                os.path.join(self.roots[1], 'web', 'init.sls'))
+        self.assertEqual(
+                self.index.file_hash('top.sls'),
+                hashlib.md5('changed').hexdigest())
+
+    def test_incremental(self):
+        '''
+        Only the directories which changed are listed again
+        '''
+        self._age()
+        self.index.refresh()
+        self._write(1, 'db/new.sls', 'new')
+        listed = []
+        listdir = os.listdir
+        os.listdir = lambda path: listed.append(path) or listdir(path)
+        try:
+            self.index.refresh()
+        finally:
+            os.listdir = listdir
+        self.assertEqual(listed, [os.path.join(self.roots[1], 'db')])
@@ -0,0 +1,237 @@
+# Import python libs
+import os
+import shutil
+import tempfile
+import threading
+
+# Import salt libs
+from saltunittest import TestCase
+import salt.jobcache
+
+# A job id from long before the keep_jobs cutoff
+OLD_JID = '20000101000000000000'
+
+
+class JobCacheMixin(object):
+    '''
+    The tests which every job cache backend needs to pass
+    '''
+    job_cache = None
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.cachedir, 'jobs'))
+        self.opts = {'cachedir': self.cachedir,
+                     'hash_type': 'md5',
+                     'serial': 'msgpack',
+                     'keep_jobs': 24,
+                     'job_cache': self.job_cache}
+        self.cache = salt.jobcache.get_job_cache(self.opts)
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir, ignore_errors=True)
+
+    def _job(self, fun='test.ping', tgt='*'):
+        jid = self.cache.prep_jid()
+        self.cache.save_load(
+                jid,
+                {'jid': jid, 'fun': fun, 'arg': [], 'tgt': tgt})
+        return jid
+
+    def test_load(self):
+        '''
+        The load of a job is saved and read back
+        '''
+        jid = self.cache.prep_jid()
+        assert self.cache.jid_exists(jid)
+        self.assertEqual(self.cache.get_load(jid), {})
+        load = {'jid': jid, 'fun': 'test.echo', 'arg': ['foo'], 'tgt': 'web*'}
+        self.cache.save_load(jid, load)
+        self.assertEqual(self.cache.get_load(jid), load)
+        assert not self.cache.jid_exists(OLD_JID)
+        self.assertEqual(self.cache.get_load(OLD_JID), {})
+
+    def test_returns(self):
+        '''
+        The returns of the minions are saved once and read back
+        '''
+        jid = self._job()
+        assert self.cache.save_return(
+                {'jid': jid, 'id': 'web1', 'return': True})
+        assert self.cache.save_return(
+                {'jid': jid, 'id': 'web2', 'return': {'a': 1}, 'out': 'txt'})
+        # A second return from a minion is dropped
+        assert not self.cache.save_return(
+                {'jid': jid, 'id': 'web1', 'return': False})
+        # As are the returns of unknown jobs
+        assert not self.cache.save_return(
+                {'jid': OLD_JID, 'id': 'web1', 'return': True})
+        self.assertEqual(
+                self.cache.get_returns(jid),
+                {'web1': {'ret': True},
+                 'web2': {'ret': {'a': 1}, 'out': 'txt'}})
+        self.assertEqual(
+                self.cache.get_returns(jid, set(['web1'])),
+                {'web2': {'ret': {'a': 1}, 'out': 'txt'}})
+
+    def test_save_returns(self):
+        '''
+        Only the new returns of known jobs are saved from a batch
+        '''
+        jid = self._job()
+        loads = [{'jid': jid, 'id': 'web1', 'return': 1},
+                 {'jid': jid, 'id': 'web1', 'return': 2},
+                 {'jid': OLD_JID, 'id': 'web2', 'return': 3},
+                 {'jid': jid, 'id': 'web3', 'return': 4}]
+        self.assertEqual(self.cache.save_returns(loads), [loads[0], loads[3]])
+        self.assertEqual(sorted(self.cache.get_returns(jid)), ['web1', 'web3'])
+
+    def test_resent_return(self):
+        '''
+        A return which is sent again while the first copy is being saved is
+        only saved once
+        '''
+        jid = self._job()
+        saved = []
+
+        def worker():
+            saved.append(self.cache.save_return(
+                    {'jid': jid, 'id': 'web1', 'return': True}))
+
+        threads = [threading.Thread(target=worker) for ind in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(saved), [False, False, False, True])
+        self.assertEqual(self.cache.get_returns(jid), {'web1': {'ret': True}})
+
+    def test_find_jobs(self):
+        '''
+        The jobs are found by function and minion, newest first
+        '''
+        jids = [self._job('test.ping'),
+                self._job('state.highstate'),
+                self._job('test.ping')]
+        self.cache.save_return({'jid': jids[0], 'id': 'web1', 'return': 1})
+        self.assertEqual(
+                [jid for jid, load in self.cache.find_jobs()],
+                jids[::-1])
+        self.assertEqual(
+                [jid for jid, load in self.cache.find_jobs(fun='test.ping')],
+                [jids[2], jids[0]])
+        self.assertEqual(
+                [jid for jid, load in self.cache.find_jobs(minion='web1')],
+                [jids[0]])
+        self.assertEqual(
+                [jid for jid, load in self.cache.find_jobs(limit=1, offset=1)],
+                [jids[1]])
+        self.assertEqual(
+                self.cache.find_jobs(fun='test.ping')[0][1]['fun'],
+                'test.ping')
+
+    def test_wtags(self):
+        '''
+        The wait tags of a job are set and removed
+        '''
+        jid = self._job()
+        assert not self.cache.has_wtag(jid)
+        self.cache.add_wtag(jid, 'web1')
+        assert self.cache.has_wtag(jid)
+        self.cache.del_wtag(jid, 'web1')
+        assert not self.cache.has_wtag(jid)
+
+    def test_clean_old_jobs(self):
+        '''
+        Only the jobs older than keep_jobs are removed
+        '''
+        self.cache.save_load(OLD_JID, {'jid': OLD_JID, 'fun': 'test.ping'})
+        self.cache.save_return({'jid': OLD_JID, 'id': 'web1', 'return': 1})
+        jid = self._job()
+        ret = self.cache.clean_old_jobs()
+        self.assertEqual(ret['jobs'], 1)
+        assert ret['bytes'] > 0
+        self.assertEqual(self.cache.get_load(OLD_JID), {})
+        self.assertEqual(self.cache.get_returns(OLD_JID), {})
+        assert self.cache.get_load(jid)
+
+    def test_threads(self):
+        '''
+        A job cache can be used from several threads
+        '''
+        jid = self._job()
+        errors = []
+
+        def worker(id_):
+            try:
+                self.cache.save_return(
+                        {'jid': jid, 'id': id_, 'return': id_})
+                self.cache.get_returns(jid)
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=worker, args=('web{0}'.format(ind),))
+                   for ind in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.cache.get_returns(jid)), 4)
+
+
+class LocalJobCacheTest(JobCacheMixin, TestCase):
+    job_cache = 'local'
+
+    def test_unindexed_jobs(self):
+        '''
+        The jobs cached before the index was kept are found
+        '''
+        jids = [self._job(), self._job()]
+        shutil.rmtree(self.cache.index_dir)
+        if os.path.isfile(self.cache.index_mark):
+            os.remove(self.cache.index_mark)
+        cache = salt.jobcache.get_job_cache(self.opts)
+        self.assertEqual(
+                [jid for jid, load in cache.find_jobs()],
+                jids[::-1])
+
+    def test_offset_skips_removed_jobs(self):
+        '''
+        Jobs which were removed do not use up the offset
+        '''
+        jids = [self._job(), self._job(), self._job()]
+        shutil.rmtree(self.cache._jid_dir(jids[2]))
+        self.assertEqual(
+                [jid for jid, load in self.cache.find_jobs(limit=1, offset=1)],
+                [jids[0]])
+
+
+class SQLiteJobCacheTest(JobCacheMixin, TestCase):
+    job_cache = 'sqlite'
+
+    def test_clean_legacy_jobs(self):
+        '''
+        The jobs left by the local job cache are expired
+        '''
+        local = salt.jobcache.LocalJobCache(self.opts)
+        local.save_load(OLD_JID, {'jid': OLD_JID, 'fun': 'test.ping'})
+        self._job()
+        ret = self.cache.clean_old_jobs()
+        self.assertEqual(ret['jobs'], 1)
+        assert not os.path.isdir(local._jid_dir(OLD_JID))
+
+
+class GetJobCacheTest(TestCase):
+    def test_default(self):
+        '''
+        The local job cache is used unless another one is set
+        '''
+        opts = {'cachedir': '/tmp', 'serial': 'msgpack'}
+        assert isinstance(
+                salt.jobcache.get_job_cache(opts),
+                salt.jobcache.LocalJobCache)
+        opts['job_cache'] = 'nosuch'
+        assert isinstance(
+                salt.jobcache.get_job_cache(opts),
+                salt.jobcache.LocalJobCache)
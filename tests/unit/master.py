@@ -0,0 +1,69 @@
+# Import python libs
+import os
+import shutil
+import tempfile
+
+# Import zeromq
+import zmq
+
+# Import salt libs
+from saltunittest import TestCase
+import salt.master
+import salt.payload
+
+
+class PubChannelTest(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmp, 'minions'))
+        self.opts = {'sock_dir': self.tmp,
+                     'pki_dir': self.tmp,
+                     'cachedir': self.tmp,
+                     'serial': 'msgpack',
+                     'publish_topics': True,
+                     'order_masters': False}
+        self.context = zmq.Context()
+        self.pull_sock = self.context.socket(zmq.PULL)
+        self.pull_sock.linger = 0
+        self.pull_sock.bind('ipc://{0}'.format(
+            os.path.join(self.tmp, 'publish_pull.ipc')))
+        self.channel = salt.master.PubChannel(self.opts)
+
+    def tearDown(self):
+        if self.channel.pub_sock:
+            self.channel.pub_sock.close()
+        self.pull_sock.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _recv(self):
+        '''
+        Return the frames of the next package handed to the Publisher, or
+        None when nothing comes through
+        '''
+        if not self.pull_sock.poll(500):
+            return None
+        return self.pull_sock.recv_multipart()
+
+    def test_send(self):
+        '''
+        A job is sent under the topics of its minions, or under the topic
+        of every minion when they are not known
+        '''
+        serial = salt.payload.Serial(self.opts)
+        self.channel.send({'jid': '1'}, ['web1', 'web2'])
+        frames = self._recv()
+        self.assertEqual(
+                frames[:-1],
+                [salt.payload.topic('web1'), salt.payload.topic('web2')])
+        self.assertEqual(serial.loads(frames[-1]), {'jid': '1'})
+        self.channel.send({'jid': '2'})
+        self.assertEqual(self._recv()[:-1], [salt.payload.topic()])
+
+    def test_no_minions(self):
+        '''
+        A job which matched no minions is not published
+        '''
+        self.channel.send({'jid': '1'}, set())
+        self.assertEqual(self._recv(), None)
+        self.channel.send({'jid': '2'}, ['web1'])
+        self.assertEqual(self._recv()[:-1], [salt.payload.topic('web1')])
@@ -0,0 +1,96 @@
+# Import python libs
+import threading
+
+# Import zeromq
+import zmq
+
+# Import salt libs
+from saltunittest import TestCase
+import salt.payload
+from salt.exceptions import SaltReqTimeoutError
+
+
+class EchoServer(threading.Thread):
+    '''
+    Reply to every request with its load, the first drop requests are
+    ignored
+    '''
+    def __init__(self, drop=0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.drop = drop
+        self.requests = 0
+        self.peers = set()
+        self.serial = salt.payload.Serial({'serial': 'msgpack'})
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.linger = 0
+        port = self.socket.bind_to_random_port('tcp://127.0.0.1')
+        self.uri = 'tcp://127.0.0.1:{0}'.format(port)
+        self.running = True
+
+    def run(self):
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        while self.running:
+            if not poller.poll(100):
+                continue
+            frames = self.socket.recv_multipart()
+            self.requests += 1
+            self.peers.add(frames[0])
+            if self.drop:
+                self.drop -= 1
+                continue
+            payload = self.serial.loads(frames[-1])
+            self.socket.send_multipart(
+                    frames[:-1] + [self.serial.dumps(payload['load'])])
+        self.socket.close()
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+
+class SREQTest(TestCase):
+    def setUp(self):
+        self.server = None
+
+    def tearDown(self):
+        if self.server:
+            self.server.stop()
+
+    def _start(self, drop=0):
+        self.server = EchoServer(drop)
+        self.server.start()
+        return self.server
+
+    def test_send(self):
+        '''
+        The requests are sent over a single connection
+        '''
+        server = self._start()
+        sreq = salt.payload.SREQ(server.uri)
+        for ind in range(3):
+            self.assertEqual(sreq.send('clear', {'ind': ind}), {'ind': ind})
+        self.assertEqual(server.requests, 3)
+        self.assertEqual(len(server.peers), 1)
+
+    def test_retry(self):
+        '''
+        A request the master does not answer is sent again
+        '''
+        server = self._start(drop=1)
+        sreq = salt.payload.SREQ(server.uri, tries=2, timeout=0.5)
+        self.assertEqual(sreq.send('clear', 'foo'), 'foo')
+        self.assertEqual(server.requests, 2)
+        # The next request goes out on the new connection
+        self.assertEqual(sreq.send('clear', 'bar'), 'bar')
+        self.assertEqual(len(server.peers), 2)
+
+    def test_timeout(self):
+        '''
+        The master not answering any of the tries raises an error
+        '''
+        server = self._start(drop=3)
+        sreq = salt.payload.SREQ(server.uri, tries=3, timeout=0.2)
+        self.assertRaises(SaltReqTimeoutError, sreq.send, 'clear', 'foo')
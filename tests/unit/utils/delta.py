@@ -0,0 +1,110 @@
+# Import python libs
+import os
+import random
+import shutil
+import tempfile
+from cStringIO import StringIO
+
+# Import salt libs
+from saltunittest import TestCase
+import salt.utils.delta
+
+BLOCK = salt.utils.delta.MIN_BLOCK
+
+
+class DeltaTest(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.rand = random.Random(4)
+        self.old = self._data(BLOCK * 10 + 123)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _data(self, size):
+        return ''.join([chr(self.rand.randint(0, 255)) for ind in xrange(size)])
+
+    def _write(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as fp_:
+            fp_.write(data)
+        return path
+
+    def _round_trip(self, new, limit=0):
+        '''
+        Build the new data from the old data and its delta, returns the
+        operations and the new data which was built
+        '''
+        old_path = self._write('old', self.old)
+        new_path = self._write('new', new)
+        sigs = salt.utils.delta.signature(old_path, BLOCK)
+        ops = salt.utils.delta.delta(new_path, sigs, BLOCK)
+        ops = salt.utils.delta.inline(new_path, ops, limit)
+        out = StringIO()
+        salt.utils.delta.patch(
+                old_path,
+                ops,
+                BLOCK,
+                out,
+                lambda loc, length: new[loc:loc + length])
+        return ops, out.getvalue()
+
+    def test_block_size(self):
+        '''
+        The block size grows with the file and stays within its bounds
+        '''
+        self.assertEqual(
+                salt.utils.delta.block_size(0),
+                salt.utils.delta.MIN_BLOCK)
+        self.assertEqual(
+                salt.utils.delta.block_size(10 ** 12),
+                salt.utils.delta.MAX_BLOCK)
+        self.assertEqual(salt.utils.delta.block_size(2 ** 30), 32768)
+
+    def test_unchanged(self):
+        '''
+        An unchanged file is rebuilt from the old blocks alone
+        '''
+        ops, new = self._round_trip(self.old)
+        self.assertEqual(new, self.old)
+        self.assertEqual(ops, range(11))
+
+    def test_changes(self):
+        '''
+        Files with data inserted, removed and replaced are rebuilt
+        '''
+        mid = BLOCK * 5 + 17
+        changes = [
+            self.old[:mid] + 'inserted' + self.old[mid:],
+            self.old[:mid] + self.old[mid + BLOCK * 2:],
+            self.old[:mid] + self._data(300) + self.old[mid + 300:],
+            self._data(99) + self.old,
+            self.old + self._data(BLOCK + 5),
+            self.old[:BLOCK * 3],
+            self.old[BLOCK * 2 + 1:],
+            '',
+            ]
+        for new in changes:
+            ops, built = self._round_trip(new)
+            self.assertEqual(built, new)
+            literal = sum([op_[1] for op_ in ops if isinstance(op_, list)])
+            assert literal <= max(len(new) - len(self.old), 0) + BLOCK * 2
+
+    def test_inline(self):
+        '''
+        Inlined data is written out without being fetched
+        '''
+        new = self.old[:BLOCK] + 'inserted' + self.old[BLOCK:]
+        ops, built = self._round_trip(new, limit=100)
+        self.assertEqual(built, new)
+        self.assertEqual(ops, [0, 'inserted'] + range(1, 11))
+
+    def test_max_literal(self):
+        '''
+        No delta is made when too much of the file has changed
+        '''
+        old_path = self._write('old', self.old)
+        new_path = self._write('new', self._data(len(self.old)))
+        sigs = salt.utils.delta.signature(old_path, BLOCK)
+        self.assertEqual(
+                salt.utils.delta.delta(new_path, sigs, BLOCK, BLOCK), None)
@@ -0,0 +1,68 @@
+# Import python libs
+import os
+import time
+import shutil
+import tempfile
+
+# Import salt libs
+from saltunittest import TestCase
+import salt.utils.event
+
+
+class EventTest(TestCase):
+    def setUp(self):
+        self.sock_dir = tempfile.mkdtemp()
+        self.publisher = salt.utils.event.EventPublisher(
+                {'sock_dir': self.sock_dir})
+        self.publisher.start()
+        self.sub = salt.utils.event.MasterEvent(self.sock_dir)
+        self.pub = salt.utils.event.MasterEvent(self.sock_dir)
+        start = time.time()
+        while not os.path.exists(self.sub.pull_path) \
+                and time.time() - start < 10:
+            time.sleep(0.05)
+
+    def tearDown(self):
+        self.sub.destroy()
+        self.pub.destroy()
+        self.publisher.terminate()
+        self.publisher.join()
+        shutil.rmtree(self.sock_dir, ignore_errors=True)
+
+    def _get(self, data, tag, wait=0.2):
+        '''
+        Fire an event until the subscription has been set up and it comes
+        through, returns the first event received or None. The copies which
+        came through late are dropped
+        '''
+        for ind in range(25):
+            self.pub.fire_event(data, tag)
+            event = self.sub.get_event(wait)
+            if event is not None:
+                while self.sub.get_event(wait) is not None:
+                    pass
+                return event
+        return None
+
+    def test_fire(self):
+        '''
+        An event is received by the processes subscribed to its tag
+        '''
+        self.sub.subscribe('20120601')
+        self.assertEqual(
+                self._get({'id': 'web1', 'return': True}, '20120601'),
+                ('20120601', {'id': 'web1', 'return': True}))
+
+    def test_tags(self):
+        '''
+        Only the events with the subscribed tags are received
+        '''
+        self.sub.subscribe('2012')
+        self.sub.subscribe('first')
+        self.assertEqual(self._get('a', 'first'), ('first', 'a'))
+        self.pub.fire_event('b', '2012060')
+        self.pub.fire_event('c', 'first')
+        self.assertEqual(self.sub.get_event(1), ('first', 'c'))
+        self.sub.unsubscribe('first')
+        self.pub.fire_event('d', 'first')
+        self.assertEqual(self.sub.get_event(0.5), None)
@@ -0,0 +1,230 @@
+# Import python libs
+import os
+import shutil
+import tempfile
+import threading
+
+# Import salt libs
+from saltunittest import TestCase
+import salt.utils.minions
+
+IDS = ['db1', 'db2', 'web1', 'web2', 'web10', 'webby']
+
+
+class CkMinionsTest(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmp, 'minions'))
+        for id_ in IDS:
+            self._accept(id_)
+        self.opts = {'pki_dir': self.tmp, 'cachedir': self.tmp}
+        self.ckminions = salt.utils.minions.CkMinions(self.opts)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _accept(self, id_):
+        open(os.path.join(self.tmp, 'minions', id_), 'w+').close()
+
+    def _check(self, expr, expr_form):
+        return sorted(self.ckminions.check_minions(expr, expr_form))
+
+    def test_glob(self):
+        '''
+        Glob targets match the ids the way the minions do
+        '''
+        self.assertEqual(self._check('*', 'glob'), sorted(IDS))
+        self.assertEqual(self._check('web?', 'glob'), ['web1', 'web2'])
+        self.assertEqual(self._check('web1*', 'glob'), ['web1', 'web10'])
+        self.assertEqual(self._check('*1', 'glob'), ['db1', 'web1'])
+        self.assertEqual(self._check('[dw]*2', 'glob'), ['db2', 'web2'])
+        self.assertEqual(self._check('db1', 'glob'), ['db1'])
+        self.assertEqual(self._check('db3', 'glob'), [])
+
+    def test_pcre(self):
+        '''
+        Regular expression targets match from the start of the ids
+        '''
+        self.assertEqual(self._check(r'web\d+$', 'pcre'),
+                         ['web1', 'web10', 'web2'])
+        self.assertEqual(self._check('b', 'pcre'), [])
+        self.assertEqual(self._check('web[', 'pcre'), [])
+
+    def test_list(self):
+        '''
+        List targets match the accepted ids in the list
+        '''
+        self.assertEqual(self._check(['db1', 'web9'], 'list'), ['db1'])
+        self.assertEqual(self._check('db1,web1', 'list'), ['db1', 'web1'])
+
+    def test_new_keys(self):
+        '''
+        Keys which are accepted or deleted are picked up
+        '''
+        self.assertEqual(self._check('new*', 'glob'), [])
+        self._accept('new1')
+        self.assertEqual(self._check('new*', 'glob'), ['new1'])
+        os.remove(os.path.join(self.tmp, 'minions', 'db1'))
+        self.assertEqual(self._check('db*', 'glob'), ['db2'])
+
+
+class EvaluateTest(TestCase):
+    def test_evaluate(self):
+        '''
+        The parts of a compound target are joined like python booleans
+        '''
+        universe = set(['a', 'b', 'c'])
+        evaluate = salt.utils.minions._evaluate
+        self.assertEqual(
+                evaluate([set(['a', 'b']), 'and', set(['b', 'c'])], universe),
+                set(['b']))
+        self.assertEqual(
+                evaluate([set(['a']), 'or', set(['b']), 'and', set(['c'])],
+                         universe),
+                set(['a']))
+        self.assertEqual(
+                evaluate(['not', set(['a']), 'and', 'not', set(['b'])],
+                         universe),
+                set(['c']))
+        self.assertEqual(
+                evaluate(['not', 'not', set(['a'])], universe),
+                set(['a']))
+
+    def test_maybe(self):
+        '''
+        The minions which may match a part are kept, also under not
+        '''
+        universe = set(['a', 'b', 'c'])
+        evaluate = salt.utils.minions._evaluate
+        part = (set(['a']), set(['a', 'b']))
+        self.assertEqual(evaluate([part], universe), set(['a', 'b']))
+        self.assertEqual(evaluate(['not', part], universe), set(['b', 'c']))
+        self.assertEqual(
+                evaluate([part, 'and', set(['a', 'c'])], universe),
+                set(['a']))
+
+    def test_malformed(self):
+        '''
+        Malformed compound targets are refused
+        '''
+        for results in ([set(), 'and'],
+                        ['or', set()],
+                        [set(), set()],
+                        [set(), 'not', set()],
+                        []):
+            self.assertRaises(
+                    ValueError,
+                    salt.utils.minions._evaluate,
+                    results,
+                    set())
+
+
+class GrainsTest(TestCase):
+    GRAINS = {'db1': {'os': 'CentOS', 'roles': ['db']},
+              'db2': {'os': 'CentOS', 'roles': ['db', 'Web'], 'num': 2},
+              'web1': {'os': 'Ubuntu', 'roles': ['web', 'cache'], 'num': 1},
+              'web2': {'os': 'Ubuntu', 'roles': ['web'], 'num': 12}}
+    TARGETS = ['G@os:CentOS',
+               'G@os:cent*',
+               'G@roles:web',
+               'P@os:(Cent|Ubu)',
+               'G@os:CentOS and G@roles:web',
+               'G@os:CentOS or web1',
+               'not G@os:Ubuntu',
+               'web* and not G@roles:cache',
+               'L@db1,web2 or E@web[12]',
+               'not L@db1,web2 and not G@num:1?',
+               'db* or not G@roles:db and not G@num:2']
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmp, 'minions'))
+        for id_ in IDS:
+            open(os.path.join(self.tmp, 'minions', id_), 'w+').close()
+        self.opts = {'pki_dir': self.tmp, 'cachedir': self.tmp}
+        self.ckminions = salt.utils.minions.CkMinions(self.opts)
+        for id_, grains in self.GRAINS.items():
+            self.ckminions.grains.store(id_, grains)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _check(self, expr, expr_form):
+        return sorted(self.ckminions.check_minions(expr, expr_form))
+
+    def test_store(self):
+        '''
+        The grains of a minion are replaced when they change
+        '''
+        grains = salt.utils.minions.GrainsCache(self.opts)
+        self.assertEqual(grains.known(), set(self.GRAINS))
+        grains.store('db1', {'os': 'Debian'})
+        self.assertEqual(grains.match('os:debian'), set(['db1']))
+        self.assertEqual(grains.match('roles:db'), set(['db2']))
+
+    def test_grain(self):
+        '''
+        Grain targets match the minions with the grain and the minions
+        which have not sent their grains
+        '''
+        unknown = ['web10', 'webby']
+        self.assertEqual(self._check('os:centos', 'grain'),
+                         sorted(['db1', 'db2'] + unknown))
+        self.assertEqual(self._check('roles:w*', 'grain'),
+                         sorted(['db2', 'web1', 'web2'] + unknown))
+        self.assertEqual(self._check('os:^ubu', 'grain_pcre'),
+                         sorted(['web1', 'web2'] + unknown))
+        self.assertEqual(self._check('os:(ubu', 'grain_pcre'), [])
+        self.assertEqual(self._check('web* and E@(web', 'compound'), [])
+
+    def test_threads(self):
+        '''
+        Grain targets can be resolved from several threads
+        '''
+        results = []
+
+        def worker():
+            try:
+                results.append(self._check('os:ubuntu', 'grain'))
+            except Exception as exc:
+                results.append(exc)
+
+        threads = [threading.Thread(target=worker) for ind in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [['web1', 'web10', 'web2', 'webby']] * 4)
+
+    def test_compound_matcher(self):
+        '''
+        The minions with known grains are matched by a compound target
+        exactly when the minion matcher matches them
+        '''
+        import salt.minion
+        for id_, grains in self.GRAINS.items():
+            matcher = salt.minion.Matcher(
+                    {'id': id_, 'grains': grains},
+                    functions={'test.ping': None})
+            for tgt in self.TARGETS:
+                self.assertEqual(
+                        id_ in self.ckminions.check_minions(tgt, 'compound'),
+                        matcher.compound_match(tgt),
+                        '{0} {1}'.format(id_, tgt))
+
+    def test_compound_unknown(self):
+        '''
+        The minions without grains are only kept where a grain decides
+        '''
+        self.assertEqual(self._check('web*', 'compound'),
+                         ['web1', 'web10', 'web2', 'webby'])
+        self.assertEqual(self._check('L@db1,webby or E@web10', 'compound'),
+                         ['db1', 'web10', 'webby'])
+        self.assertEqual(self._check('webb* and G@os:CentOS', 'compound'),
+                         ['webby'])
+        self.assertEqual(self._check('webb* and not G@os:CentOS', 'compound'),
+                         ['webby'])
+        self.assertEqual(self._check('db* and G@os:Ubuntu', 'compound'), [])
+        self.assertEqual(self._check('X@test.ping', 'compound'), sorted(IDS))
+        self.assertEqual(self._check('Z@foo', 'compound'), [])
+        self.assertEqual(self._check('G@os:CentOS and', 'compound'), [])
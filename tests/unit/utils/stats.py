@@ -0,0 +1,77 @@
+# Import python libs
+import os
+import shutil
+import tempfile
+
+# Import salt libs
+from saltunittest import TestCase
+import salt.utils.stats
+
+
+class StatsTest(TestCase):
+    def setUp(self):
+        self.opts = {'cachedir': tempfile.mkdtemp()}
+
+    def tearDown(self):
+        shutil.rmtree(self.opts['cachedir'], ignore_errors=True)
+
+    def _dump(self, stats, pid):
+        '''
+        Write the stats out as if they came from the worker with the pid
+        '''
+        stats.dump()
+        s_dir = salt.utils.stats.stats_dir(self.opts)
+        os.rename(
+                os.path.join(s_dir, '{0}.p'.format(os.getpid())),
+                os.path.join(s_dir, '{0}.p'.format(pid)))
+
+    def test_empty(self):
+        '''
+        No stats are reported before the workers write any
+        '''
+        ret = salt.utils.stats.aggregate(self.opts)
+        self.assertEqual(ret['workers'], 0)
+        self.assertEqual(ret['cmds'], {})
+
+    def test_aggregate(self):
+        '''
+        The counters of the workers are added up
+        '''
+        first = salt.utils.stats.Stats(self.opts)
+        first.record('_return', 0.0005, bytes_in=100, bytes_out=10)
+        first.record('_return', 0.002, bytes_in=200, bytes_out=10)
+        first.record('_pillar', 2, error=True)
+        first.incr('file_unchanged')
+        self._dump(first, 1)
+        second = salt.utils.stats.Stats(self.opts)
+        second.record('_return', 0.003, bytes_in=300, bytes_out=10)
+        second.record('_return', 60, bytes_in=400, bytes_out=10)
+        second.incr('file_unchanged', 2)
+        self._dump(second, 2)
+        ret = salt.utils.stats.aggregate(self.opts)
+        self.assertEqual(ret['workers'], 2)
+        self.assertEqual(ret['counters'], {'file_unchanged': 3})
+        ret_cmd = ret['cmds']['_return']
+        self.assertEqual(ret_cmd['requests'], 4)
+        self.assertEqual(ret_cmd['errors'], 0)
+        self.assertEqual(ret_cmd['bytes_in'], 1000)
+        self.assertEqual(ret_cmd['bytes_out'], 40)
+        self.assertEqual(ret_cmd['time_max'], 60)
+        self.assertAlmostEqual(ret_cmd['time_avg'], 60.0055 / 4)
+        self.assertEqual(ret_cmd['time_p50'], 0.005)
+        self.assertEqual(ret_cmd['time_p99'], float('inf'))
+        self.assertEqual(ret_cmd['histogram']['<=0.001'], 1)
+        self.assertEqual(ret_cmd['histogram']['<=0.005'], 2)
+        self.assertEqual(ret_cmd['histogram']['>30'], 1)
+        self.assertEqual(ret['cmds']['_pillar']['errors'], 1)
+        self.assertEqual(ret['cmds']['_pillar']['time_p50'], 5)
+
+    def test_clear(self):
+        '''
+        The stats of a previous run are removed
+        '''
+        stats = salt.utils.stats.Stats(self.opts)
+        stats.record('_return', 0.001)
+        stats.dump()
+        salt.utils.stats.clear(self.opts)
+        self.assertEqual(salt.utils.stats.aggregate(self.opts)['workers'], 0)